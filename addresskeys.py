@@ -0,0 +1,166 @@
+# This module contains the codec of compact binary keys of addresses, used instead of address
+# strings in the address book and by the dict engine of calc_top_balances.py. Addresses are encoded
+# in batches with numpy:
+#   - Ethereum-like hex addresses ("0x" and 40 lowercase hex digits) become 20 bytes;
+#   - base58 addresses (Bitcoin-like P2PKH/P2SH) become the bytes of their base58 number;
+#   - bech32 and cashaddr addresses with a known prefix become their 5-bit groups packed to bytes;
+#   - anything else (e.g. addresses of multisig inputs joined with commas by the queries in
+#     "extract/btc_like") becomes a 16-byte BLAKE2 hash.
+# The first one or two bytes of a key tell its kind and length, so keys of different addresses
+# differ (except for hash collisions of the last kind, which are negligible at 128 bits). Keys are
+# not decoded back, the address book keeps the strings in its text file.
+
+import math
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+HEX = '0123456789abcdef'
+BASE58 = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+BECH32 = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+# human-readable parts of bech32 (SegWit) and cashaddr addresses, the index of a prefix is a part
+# of keys and must not change
+PREFIXES = ['bc1', 'ltc1', 'bitcoincash:', 'tb1', 'tltc1', 'bchtest:']
+
+# first bytes of keys
+HASH_KEY = 0
+HEX_KEY = 1
+BECH32_KEY = 2
+BASE58_KEY = 0x80
+HASH_SIZE = 16
+
+
+def _table(alphabet):
+    # digit of every ASCII character (255 for characters out of the alphabet)
+    table = np.full(256, 255, dtype=np.uint8)
+    table[np.frombuffer(alphabet.encode(), dtype=np.uint8)] = np.arange(len(alphabet))
+    return table
+
+
+HEX_TABLE = _table(HEX)
+BASE58_TABLE = _table(BASE58)
+BECH32_TABLE = _table(BECH32)
+
+
+def _n_bytes(length, base):
+    return math.ceil(length * math.log2(base) / 8 - 1e-9)
+
+
+def pack(digits, base):
+    # fixed-length numbers given by rows of DIGITS (most significant first) in BASE as big-endian
+    # bytes, all rows of the same width
+    n, length = digits.shape
+    n_bytes = _n_bytes(length, base)
+    if not base & (base - 1):
+        # digits of power-of-two bases are concatenated bits, G digits make whole bytes
+        bits = base.bit_length() - 1
+        g = 8 // math.gcd(bits, 8)
+        digits = np.hstack([np.zeros((n, -length % g), dtype=np.uint64),
+            digits.astype(np.uint64)])
+        groups = np.zeros((n, digits.shape[1] // g), dtype=np.uint64)
+        for d in range(g):
+            groups |= digits[:, d::g] << np.uint64(bits * (g - 1 - d))
+        packed = groups.astype('>u8').view(np.uint8).reshape(n, groups.shape[1], 8)
+        packed = packed[:, :, 8 - g * bits // 8:].reshape(n, -1)
+        return packed[:, packed.shape[1] - n_bytes:]
+
+    # G digits are combined to a value below 2**24, which is added to the number accumulated in
+    # 32-bit limbs (the least significant first)
+    g = int(24 // math.log2(base))
+    digits = np.hstack([np.zeros((n, -length % g), dtype=np.int64), digits.astype(np.int64)])
+    n_limbs = -(-n_bytes // 4)
+    limbs = np.zeros((n_limbs, n), dtype=np.int64)
+    for j in range(0, digits.shape[1], g):
+        carry = digits[:, j]
+        for d in range(1, g):
+            carry = carry * base + digits[:, j + d]
+        # only limbs that may be non-zero after these digits are updated
+        for k in range(min(n_limbs, int((j + g) * math.log2(base) // 32) + 1)):
+            t = limbs[k] * base**g + carry
+            limbs[k] = t & 0xFFFFFFFF
+            carry = t >> 32
+    packed = limbs[::-1].T.astype('>u4', order='C').view(np.uint8).reshape(n, 4 * n_limbs)
+    return packed[:, 4 * n_limbs - n_bytes:]
+
+
+def _keys(header, packed):
+    # bytes keys of rows of PACKED prefixed by HEADER
+    rows = np.hstack([np.tile(np.asarray(header, dtype=np.uint8), (packed.shape[0], 1)), packed])
+    return np.ascontiguousarray(rows).view('V{}'.format(rows.shape[1])).ravel().tolist()
+
+
+def hash_key(address):
+    return bytes([HASH_KEY]) + hashlib.blake2b(address.encode(), digest_size=HASH_SIZE).digest()
+
+
+def _encode_length(addresses, length, keys, positions):
+    # encodes ADDRESSES of the same LENGTH to KEYS at POSITIONS
+    # characters out of ASCII are replaced by '?', which is not a digit of any alphabet
+    data = ''.join(addresses).encode('ascii', errors='replace')
+    chars = np.frombuffer(data, dtype=np.uint8).reshape(len(addresses), length)
+    todo = np.ones(len(addresses), dtype=bool)
+
+    def assign(rows, keys_):
+        keys[positions[rows]] = keys_
+        todo[rows] = False
+
+    if length == 42:
+        rows = np.flatnonzero((chars[:, 0] == ord('0')) & (chars[:, 1] == ord('x')))
+        digits = HEX_TABLE[chars[rows, 2:]]
+        valid = (digits != 255).all(axis=1)
+        if valid.any():
+            assign(rows[valid], _keys([HEX_KEY], pack(digits[valid], 16)))
+    for p, prefix in enumerate(PREFIXES):
+        if length <= len(prefix) or length - len(prefix) > 255:
+            continue
+        rows = np.flatnonzero(todo & (chars[:, :len(prefix)] ==
+            np.frombuffer(prefix.encode(), dtype=np.uint8)).all(axis=1))
+        digits = BECH32_TABLE[chars[rows, len(prefix):]]
+        valid = (digits != 255).all(axis=1)
+        if valid.any():
+            assign(rows[valid], _keys([BECH32_KEY + p, length - len(prefix)],
+                pack(digits[valid], 32)))
+    if length < 0x80:
+        rows = np.flatnonzero(todo)
+        digits = BASE58_TABLE[chars[rows]]
+        valid = (digits != 255).all(axis=1)
+        if valid.any():
+            assign(rows[valid], _keys([BASE58_KEY | length], pack(digits[valid], 58)))
+    for i in np.flatnonzero(todo).tolist():
+        keys[positions[i]] = hash_key(addresses[i])
+
+
+def address_keys(addresses):
+    # compact bytes keys of a list of address strings, addresses of the same length are encoded
+    # together
+    addresses = list(addresses)
+    keys = np.empty(len(addresses), dtype=object)
+    if not addresses:
+        return []
+    lengths = np.fromiter(map(len, addresses), dtype=np.int64, count=len(addresses))
+    order = np.argsort(lengths, kind='stable')
+    lengths = lengths[order]
+    starts = np.flatnonzero(np.r_[True, lengths[1:] != lengths[:-1]])
+    bounds = np.r_[starts, len(addresses)]
+    for j, length in enumerate(lengths[starts].tolist()):
+        positions = order[bounds[j]:bounds[j + 1]]
+        group = [addresses[i] for i in positions.tolist()]
+        if length == 0:
+            for i, address in zip(positions, group):
+                keys[i] = hash_key(address)
+        else:
+            _encode_length(group, length, keys, positions)
+    return keys.tolist()
+
+
+def row_keys(addresses):
+    # keys of rows of addresses, every distinct address is encoded once
+    codes, uniques = pd.factorize(np.asarray(addresses, dtype=object))
+    uniques = list(uniques)
+    if (codes < 0).any():
+        codes = np.where(codes < 0, len(uniques), codes)
+        uniques.append('')
+    keys = np.empty(len(uniques), dtype=object)
+    keys[:] = address_keys(uniques)
+    return keys[codes].tolist()
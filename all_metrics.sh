@@ -1,23 +1 @@
-./metric.py --dir='data/coins' --N=30 --metric='entropy' --latex
-./metric.py --dir='data/coins' --N=30 --metric='gini' --latex
-./metric.py --dir='data/coins' --N=30 --metric='nakamoto' --latex
-./metric.py --dir='data/coins' --N=30 --metric='robin' --latex
-./metric.py --dir='data/coins' --N=30 --metric='efficiency' --latex
-
-./metric.py --dir='data/coins' --N=100 --metric='entropy' --latex
-./metric.py --dir='data/coins' --N=100 --metric='gini' --latex
-./metric.py --dir='data/coins' --N=100 --metric='nakamoto' --latex
-./metric.py --dir='data/coins' --N=100 --metric='robin' --latex
-./metric.py --dir='data/coins' --N=100 --metric='efficiency' --latex
-
-./metric.py --dir='data/coins' --N=1000 --metric='entropy' --latex
-./metric.py --dir='data/coins' --N=1000 --metric='gini' --latex
-./metric.py --dir='data/coins' --N=1000 --metric='nakamoto' --latex
-./metric.py --dir='data/coins' --N=1000 --metric='robin' --latex
-./metric.py --dir='data/coins' --N=1000 --metric='efficiency' --latex
-
-./metric.py --dir='data/coins' --N=10000 --metric='entropy' --latex
-./metric.py --dir='data/coins' --N=10000 --metric='gini' --latex
-./metric.py --dir='data/coins' --N=10000 --metric='nakamoto' --latex
-./metric.py --dir='data/coins' --N=10000 --metric='robin' --latex
-./metric.py --dir='data/coins' --N=10000 --metric='efficiency' --latex
+./metric.py --dir='data/coins' --N 30 100 1000 10000 --metric entropy gini nakamoto robin efficiency --latex
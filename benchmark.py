@@ -0,0 +1,269 @@
+#!/usr/bin/env python3.9
+
+# This script can be used to benchmark split_csv.py, calc_top_balances.py and metric.py on a
+# synthetic blockchain generated by gen_chain.py. Every script is run as a separate process with
+# telemetry enabled, and its elapsed time, rows/s, latency of weeks (or CSV files) and peak RSS are
+# saved to a JSON file, so results of different versions and machines can be compared
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import datetime
+import platform
+import subprocess
+from time import perf_counter
+
+
+# only the standard library is imported: the RSS of this process is a lower bound of the peak RSS
+# reported for the scripts it runs
+HERE = os.path.dirname(os.path.abspath(__file__))
+ENGINES = ['dict', 'array', 'disk']
+CHAINS = ['btc', 'eth']
+
+
+def read_telemetry(fname):
+    if not os.path.isfile(fname):
+        return []
+    with open(fname, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values, q):
+    # nearest-rank percentile of a non-empty list
+    values = sorted(values)
+    return values[min(int(q / 100 * len(values)), len(values) - 1)]
+
+
+def summarize(records, event):
+    # latency percentiles and total time per stage of the records of EVENT
+    records = [r for r in records if r['event'] == event]
+    if not records:
+        return None
+    seconds = [r['seconds'] for r in records]
+    stages = {}
+    for r in records:
+        for stage, t in r['stages'].items():
+            stages[stage] = stages.get(stage, 0.) + t
+    return {
+            'count': len(records),
+            'mean': sum(seconds) / len(seconds),
+            'p50': percentile(seconds, 50),
+            'p95': percentile(seconds, 95),
+            'max': max(seconds),
+            'stages': stages,
+            'peak_rss': max(r['peak_rss'] for r in records),
+            'addresses': records[-1]['addresses'],
+            }
+
+
+def run(step, args, telemetry=None, event=None):
+    # runs a script with ARGS and returns its results, the peak RSS is the maximum over the script
+    # and all its worker processes
+    print('Running {}...'.format(' '.join(args)))
+    if telemetry is not None:
+        if os.path.isfile(telemetry):
+            os.remove(telemetry)
+        args = args + ['--telemetry', telemetry]
+    start = perf_counter()
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen([sys.executable] + args, cwd=HERE, stdout=devnull)
+        _, status, usage = os.wait4(process.pid, 0)
+    seconds = perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise RuntimeError('{} failed with exit code {}!'.format(step, process.returncode))
+
+    result = {
+            'step': step,
+            'command': args,
+            'seconds': seconds,
+            # kilobytes on Linux, bytes on macOS
+            'peak_rss': usage.ru_maxrss * (1 if platform.system() == 'Darwin' else 1024),
+            }
+    if telemetry is not None:
+        records = read_telemetry(telemetry)
+        result[event + 's'] = summarize(records, event)
+        result['done'] = records[-1] if records and records[-1]['event'] == 'done' else None
+    print(' {:.4f} s, peak RSS {:.1f} MB'.format(seconds, result['peak_rss'] / 2**20))
+    return result
+
+
+def remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.isfile(path):
+        os.remove(path)
+
+
+def main():
+    formatter = lambda prog: argparse.RawTextHelpFormatter(prog, max_help_position=50)
+    parser = argparse.ArgumentParser(
+            description='Benchmarks the split/calc/metric pipeline on a synthetic blockchain',
+            add_help=False,
+            formatter_class=formatter,
+            )
+
+    # required arguments
+    required_args = parser.add_argument_group('required arguments')
+    required_args.add_argument(
+            '--dir',
+            type=str,
+            required=True,
+            help='Path to a working directory (synthetic data is generated in it)',
+            )
+
+    # optimal arguments
+    optional_args = parser.add_argument_group('optional arguments')
+    optional_args.add_argument(
+            '-h',
+            '--help',
+            action='help',
+            help='show this help message and exit',
+            )
+    optional_args.add_argument(
+            '--chain',
+            type=str,
+            choices=CHAINS,
+            default='btc',
+            help='Layout and value scale of the synthetic blockchain, defaults to btc',
+            )
+    optional_args.add_argument(
+            '--weeks',
+            type=int,
+            default=52,
+            help='Number of weeks, defaults to 52',
+            )
+    optional_args.add_argument(
+            '--rows_per_week',
+            type=int,
+            default=100000,
+            help='Number of credits and debits per week, defaults to 100000',
+            )
+    optional_args.add_argument(
+            '--addresses',
+            type=int,
+            default=1000000,
+            help='Number of distinct addresses, defaults to 1000000',
+            )
+    optional_args.add_argument(
+            '--zipf',
+            type=float,
+            default=1.2,
+            help='Exponent of the Zipf distribution of address reuse, defaults to 1.2',
+            )
+    optional_args.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Seed of the random generator, defaults to 0',
+            )
+    optional_args.add_argument(
+            '--top',
+            type=int,
+            default=10000,
+            help='How many top account balances to consider, defaults to 10000',
+            )
+    optional_args.add_argument(
+            '--engines',
+            type=str,
+            nargs='+',
+            choices=ENGINES,
+            default=ENGINES,
+            help='Engines of calc_top_balances.py to benchmark, defaults to all',
+            )
+    optional_args.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of worker processes of split_csv.py, defaults to 1',
+            )
+    optional_args.add_argument(
+            '--output',
+            type=str,
+            default='benchmark.json',
+            help='JSON file the results are appended to (one line per benchmark), defaults to '
+                'benchmark.json',
+            )
+    optional_args.add_argument(
+            '--keep',
+            action='store_true',
+            default=False,
+            help='Keep the generated blockchain and reuse it if it exists, defaults to False',
+            )
+    args = parser.parse_args()
+
+    name = '{}_synthetic'.format(args.chain)
+    DIR = os.path.abspath(args.dir)
+    PATH = os.path.join(DIR, name)
+    config = {k: getattr(args, k) for k in ['chain', 'weeks', 'rows_per_week', 'addresses',
+        'zipf', 'seed', 'top', 'workers']}
+    if not args.keep:
+        remove(PATH)
+
+    results = []
+    if not os.path.isdir(PATH):
+        results.append(run('generate', ['gen_chain.py', '--dir', DIR, '--name', name, '--chain',
+            args.chain, '--weeks', str(args.weeks), '--rows_per_week', str(args.rows_per_week),
+            '--addresses', str(args.addresses), '--zipf', str(args.zipf), '--seed',
+            str(args.seed)]))
+    else:
+        # partitions and outputs of the previous run are not reused
+        for f in os.listdir(PATH):
+            if not os.path.isdir(os.path.join(PATH, f, 'csv')):
+                remove(os.path.join(PATH, f))
+
+    results.append(run('split', ['split_csv.py', '--dir', DIR, '--name', name, '--workers',
+        str(args.workers)], os.path.join(DIR, name + '.split.jsonl'), 'file'))
+    # rows and the start date are reported by split_csv.py
+    rows = results[-1]['done']['total_rows']
+    start_date = results[-1]['done']['start_date']
+
+    for engine in args.engines:
+        for f in os.listdir(PATH):
+            if f.startswith('top') or f.startswith('checkpoint') or f.endswith('.pickle'):
+                remove(os.path.join(PATH, f))
+        results.append(run('calc_' + engine, ['calc_top_balances.py', '--dir', DIR, '--name',
+            name, '--start_date', start_date, '--top', str(args.top), '--engine', engine],
+            os.path.join(DIR, '{}.calc_{}.jsonl'.format(name, engine)), 'week'))
+
+    # metric.py plots the stores of weekly top balances in subfolder "top" of a folder (TOP_DIR of
+    # topstore.py), loading them is measured too
+    coins = os.path.join(DIR, name + '_coins')
+    remove(coins)
+    shutil.copytree(os.path.join(PATH, 'top{}_balances'.format(args.top)),
+            os.path.join(coins, 'top', name))
+    results.append(run('metric', ['metric.py', '--dir', coins, '--metric', 'gini', 'nakamoto',
+        '--N', str(args.top)]))
+
+    for result in results:
+        result['rows'] = rows
+        result['rows_per_s'] = rows / result['seconds']
+
+    benchmark = {
+            'time': datetime.datetime.now().isoformat(),
+            'config': config,
+            'machine': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                },
+            'results': results,
+            }
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(benchmark) + '\n')
+
+    print(' ' * 50, end='\n')
+    print('Benchmark done!')
+    print('{:<12}{:>12}{:>14}{:>16}{:>14}'.format('step', 'seconds', 'rows/s', 'peak RSS (MB)',
+        'p95 week (s)'))
+    for result in results:
+        weeks = result.get('weeks')
+        print('{:<12}{:>12.4f}{:>14.0f}{:>16.1f}{:>14}'.format(result['step'], result['seconds'],
+            result['rows_per_s'], result['peak_rss'] / 2**20,
+            '{:.4f}'.format(weeks['p95']) if weeks else '-'))
+    print('Results saved in {}'.format(args.output))
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,31 @@
 #!/usr/bin/env python3.9
 
-# This script can bee used to calcualted top account balances from weekly pickle files.
+# This script can bee used to calcualted top account balances from weekly pickle or binary files.
 #
 # Author:  Roman Overko
 # Contact: roman.overko@iota.org
 # Date:    February 09, 2022
 
 import os
-import gc
 import signal
 import pickle
 import argparse
 import datetime
+import numpy as np
 import pandas as pd
 from time import time, sleep
-from collections import defaultdict
+from multiprocessing import Pool
+
+from checkpoints import CHECKPOINT_DIR, Checkpoint
+from engines import ENGINES, STORE_DIR, ArrayBalances, make_engine, value_scale
+from events import CALENDARS, EVENTS_DIR, EventStore, calendar_dates, is_event_store, parse_dates
+from fixedpoint import to_coins
+from history import HISTORY_DIR, HistoryWriter, build_history
+from sketches import SKETCH_DIR, BalanceSketch, SketchStore
+from telemetry import Profiler, Telemetry
+from topstore import TopStore
+from partitions import NET_DIR, AddressBook, detect_format, list_sub_dirs, list_weeks, \
+        read_bin_week, read_pkl_week, read_split_manifest
 
 # handler stop calculating and save dictionary to file
 global stop
@@ -24,6 +35,92 @@ def handler(signum, frame):
     stop = True
 
 
+def apply_week(balances, DIR, SUB_DIRS, FORMAT, week, shard=0, n_shards=1, telemetry=None,
+        limbs=0):
+    # applies weekly partitions of all subfolders to balances (with the event store, WEEK is a
+    # range of days), returns the number of applied rows. If N_SHARDS > 1, only addresses of the
+    # given shard (a hash-partition of the address space) are considered. Values of binary
+    # partitions are rows of LIMBS limbs if LIMBS
+    rows = 0
+    for sd in SUB_DIRS:
+        if FORMAT in ['bin', 'events']:
+            if FORMAT == 'bin':
+                ids, values = read_bin_week(os.path.join(DIR, sd), week, limbs)
+            else:
+                ids, values = EventStore(os.path.join(DIR, sd)).read(*week)
+            if n_shards > 1:
+                mask = ids % n_shards == shard
+                ids, values = ids[mask] // n_shards, values[mask]
+            if values.ndim == 2 and not balances.limbs:
+                # exact values are added up as floats in base units
+                values = to_coins(values, 1)
+            if telemetry is not None:
+                telemetry.lap('read')
+            balances.update_ids(ids, values)
+        else:
+            df = read_pkl_week(os.path.join(DIR, sd), week)
+            addresses, values = df['address'].to_numpy(), df['value'].to_numpy()
+            if n_shards > 1:
+                mask = pd.util.hash_array(addresses) % n_shards == shard
+                addresses, values = addresses[mask], values[mask]
+            if telemetry is not None:
+                telemetry.lap('read')
+            balances.update(addresses, values)
+        if telemetry is not None:
+            telemetry.lap('update')
+        rows += values.shape[0]
+    return rows
+
+
+def pickle_files(DIR, tag=''):
+    # files with balances saved by the dict engine
+    return [f for f in os.listdir(DIR) if f.endswith('pickle') and
+            f.split('.')[0].rsplit('_', 1)[0] == 'balances' + tag]
+
+
+def save_pickle(DIR, tag, balances, weeks):
+    # balances of the dict engine before week WEEKS, older pickle files are removed only after
+    # the new one is written
+    fname = 'balances{}_{}.pickle'.format(tag, weeks)
+    with open(os.path.join(DIR, fname + '.tmp'), 'wb') as f:
+        pickle.dump(balances.to_dict(), f, pickle.HIGHEST_PROTOCOL)
+    os.replace(os.path.join(DIR, fname + '.tmp'), os.path.join(DIR, fname))
+    for f in pickle_files(DIR, tag):
+        if f != fname:
+            os.remove(os.path.join(DIR, f))
+
+
+def calc_shard(task):
+    # worker of the sharded mode: returns weekly top balances of one shard of addresses together
+    # with the (global) IDs of their addresses, and weekly sketches of its balances if SKETCH
+    DIR, SUB_DIRS, FORMAT, WEEKS, scale, limbs, exact, top, shard, n_shards, sketch, verbose = task
+    balances = ArrayBalances(scale, limbs=limbs if exact else 0)
+    if sketch:
+        balances.sketch = BalanceSketch(unit=1 / scale)
+    tops = []
+    sketches = []
+    for i, week in enumerate(WEEKS):
+        if verbose and not shard:
+            print(' file {} out of {}'.format(i, len(WEEKS) - 1), end='\n')
+        apply_week(balances, DIR, SUB_DIRS, FORMAT, week, shard, n_shards, limbs=limbs)
+        ids, values = balances.top_items(top)
+        tops.append((ids * n_shards + shard, values))
+        if sketch:
+            sketches.append(balances.sketch.copy())
+    return tops, sketches
+
+
+def merge_tops(tops, top):
+    # top balances of the union of shards are the top balances of the shards' top balances
+    ids = np.concatenate([t[0] for t in tops])
+    values = np.concatenate([t[1] for t in tops])
+    if values.shape[0] > top:
+        order = np.argpartition(values, values.shape[0] - top)[values.shape[0] - top:]
+        ids, values = ids[order], values[order]
+    order = np.argsort(values, kind='stable')[::-1]
+    return ids[order], values[order]
+
+
 def main():
     formatter = lambda prog: argparse.RawTextHelpFormatter(prog, max_help_position=50)
     parser = argparse.ArgumentParser(
@@ -44,7 +141,7 @@ def main():
             '--name',
             type=str,
             required=True,
-            help='Name of blockchain (also the name of the folder with pickle files)',
+            help='Name of blockchain (also the name of the folder with weekly partitions)',
             )
     required_args.add_argument(
             '--start_date',
@@ -96,134 +193,391 @@ def main():
             '--keep_address',
             action='store_true',
             default=False,
-            help='Keep address along with its values, defaults to False'
+            help='Keep address along with its values (not with the dict engine), defaults to False'
+            )
+    optional_args.add_argument(
+            '--engine',
+            type=str,
+            choices=ENGINES,
+            default='dict',
+            help='Engine used to accumulate balances: \'dict\' updates a dictionary row by row, '
+                '\'array\' maps\naddresses to dense IDs and applies weekly files with vectorized '
+                'updates, \'disk\' does the same\nwith balances kept in files and at most '
+                'MEMORY_BUDGET of them in memory, defaults to dict',
+            )
+    optional_args.add_argument(
+            '--memory_budget',
+            type=int,
+            default=4096,
+            help='Memory in MB for balances held in memory by the disk engine (the rest is kept in '
+                'folder\n\"{}\"), defaults to 4096'.format(STORE_DIR),
+            )
+    optional_args.add_argument(
+            '--shards',
+            type=int,
+            default=1,
+            help='Number of worker processes, each owning a hash-partition of addresses (uses the '
+                'array\nengine, resuming from saved balances is not supported), defaults to 1',
+            )
+    optional_args.add_argument(
+            '--exact',
+            action='store_true',
+            default=False,
+            help='Accumulate exact integer balances in base units (satoshi or wei) and convert '
+                'them to coins\nfor the output only, requires weekly partitions split by '
+                'split_csv.py with --exact (not\nwith the disk engine), defaults to False',
+            )
+    optional_args.add_argument(
+            '--checkpoint_weeks',
+            type=int,
+            default=50,
+            help='Save balances after every CHECKPOINT_WEEKS weeks, defaults to 50',
+            )
+    optional_args.add_argument(
+            '--checkpoint_seconds',
+            type=float,
+            default=0,
+            help='Save balances also if CHECKPOINT_SECONDS seconds have passed since the last '
+                'checkpoint\n(not with the dict engine), defaults to 0 (disabled)',
+            )
+    optional_args.add_argument(
+            '--calendar',
+            type=str,
+            choices=list(CALENDARS),
+            default=None,
+            help='Take snapshots of balances at the end of every day, every 7 days from START_DATE or '
+                'at\nthe end of every month until END_DATE (reads the event store written by '
+                'split_csv.py\nwith --events), defaults to None (weekly partitions are used)',
+            )
+    optional_args.add_argument(
+            '--dates',
+            type=str,
+            default=None,
+            help='Take snapshots of balances at the end of the given dates (a comma-separated list '
+                'or a\npath to a file with one date per line, reads the event store), defaults to '
+                'None',
+            )
+    optional_args.add_argument(
+            '--incremental',
+            action='store_true',
+            default=False,
+            help='Extend the output with weeks split by split_csv.py since the last run (balances '
+                'are saved\nbefore the first week that may still be incomplete), defaults to False',
+            )
+    optional_args.add_argument(
+            '--history',
+            action='store_true',
+            default=False,
+            help='Log the balances changed in every week and build an index of balance histories '
+                'in folder\n\"{}\" (queried by query_balances.py, not with the dict engine or '
+                '--shards), defaults\nto False'.format(HISTORY_DIR),
+            )
+    optional_args.add_argument(
+            '--sketch',
+            action='store_true',
+            default=False,
+            help='Save a weekly sketch of the distribution of all balances in folder \"{}\" (used '
+                'by metric.py\nwith --population, not with the dict engine), defaults to '
+                'False'.format(SKETCH_DIR),
+            )
+    optional_args.add_argument(
+            '--telemetry',
+            type=str,
+            default=None,
+            help='Append a JSON line per week with time per stage, rows/s, the number of addresses '
+                'and RSS\nto the given file, defaults to None (disabled)',
+            )
+    optional_args.add_argument(
+            '--profile',
+            type=str,
+            default=None,
+            help='Profile the main loop by cProfile and save statistics to the given file, '
+                'defaults to None',
             )
     args = parser.parse_args()
+    if args.incremental and (args.shards > 1 or args.calendar or args.dates):
+        parser.error('--incremental works with weekly partitions and without --shards only')
+    if args.keep_address and args.engine == 'dict' and args.shards <= 1:
+        parser.error('--keep_address requires --engine array or disk')
+    if args.calendar and args.dates:
+        parser.error('--calendar and --dates are mutually exclusive')
+    if args.history and (args.engine == 'dict' or args.shards > 1):
+        parser.error('--history requires --engine array or disk and no --shards')
+    if args.sketch and args.engine == 'dict' and args.shards <= 1:
+        parser.error('--sketch requires --engine array or disk')
+    if args.exact and args.engine == 'disk' and args.shards <= 1:
+        parser.error('--exact requires --engine dict or array')
     
     DIR = os.path.join(args.dir, args.name)
     if not os.path.isdir(DIR):
         raise FileNotFoundError('Directory \"{}\" does not exist!'.format(DIR))
     
-    SUB_DIRS = [d for d in os.listdir(DIR) if os.path.isdir(os.path.join(DIR, d))]
+    SUB_DIRS = list_sub_dirs(DIR)
     if not SUB_DIRS:
         raise FileNotFoundError('Directory \"{}\" contains no subfolders!'.format(DIR))
+    if detect_format([os.path.join(DIR, NET_DIR)]) is not None:
+        # weekly net deltas pre-aggregated over all subfolders by split_csv.py
+        print('Using weekly net deltas in \"{}\"'.format(os.path.join(DIR, NET_DIR)))
+        SUB_DIRS = [NET_DIR]
     
-    n_files = []
-    for sd in SUB_DIRS:
-        sub_dir = os.path.join(DIR, sd, 'pkl')
-        # pkl_files = [f for f in os.listdir(sub_dir) if f[-3:] == 'pkl']
-        pkl_files = os.listdir(sub_dir)
-        if not pkl_files:
-            raise FileNotFoundError('Directory \"{}\" contains no pickle files!'.format(DIR))
-        n_files.append(len(pkl_files))
-    assert n_files.count(n_files[0]) == len(n_files)
+    
+    # values of partitions split with --exact are rows of LIMBS limbs in base units
+    LIMBS = (read_split_manifest(DIR) or {}).get('limbs', 0)
+    if args.exact and not LIMBS:
+        raise ValueError('Weekly partitions in \"{}\" were not split with --exact!'.format(DIR))
+    EXACT_LIMBS = LIMBS if args.exact else 0
+
+    # snapshots at other calendars than weekly partitions are taken from the event store, each
+    # calendar has its own output and saved balances
+    CALENDAR = args.calendar or ('dates' if args.dates else None)
+    TAG = '_' + CALENDAR if CALENDAR else ''
+    if CALENDAR:
+        if not is_event_store(os.path.join(DIR, EVENTS_DIR)):
+            raise FileNotFoundError('Directory \"{}\" contains no event store (run split_csv.py '
+                'with --events)!'.format(DIR))
+        SUB_DIRS = [EVENTS_DIR]
+        FORMAT = 'events'
+        if args.dates:
+            dates = parse_dates(args.dates)
+        else:
+            dates = calendar_dates(args.calendar, args.start_date, args.end_date)
+            # no snapshots after the first one that includes all events
+            last_day = EventStore(os.path.join(DIR, EVENTS_DIR)).last_day
+            dates = dates[:np.searchsorted(dates.astype(np.int64), last_day) + 1]
+        days = dates.astype(np.int64).tolist()
+        weeks = list(zip([None] + days[:-1], days))
+        DATES = [str(d) for d in dates]
+    else:
+        FORMAT = detect_format([os.path.join(DIR, sd) for sd in SUB_DIRS])
+        if FORMAT is None:
+            raise FileNotFoundError('Directory \"{}\" contains no weekly partitions!'.format(DIR))
+        n_files = []
+        for sd in SUB_DIRS:
+            weeks = list_weeks(os.path.join(DIR, sd), FORMAT)
+            n_files.append(len(weeks))
+        assert n_files.count(n_files[0]) == len(n_files)
+        START_DATE = datetime.datetime.strptime(args.start_date, '%Y-%m-%d')
+        DELTA = datetime.timedelta(weeks=1)
+        DATES = [(START_DATE + DELTA * i).strftime('%Y-%m-%d') for i in range(len(weeks))]
+    
+    # the array and disk engines save balances to incremental checkpoints, the dict engine to
+    # pickle files
+    CHECKPOINT = Checkpoint(os.path.join(DIR, CHECKPOINT_DIR + TAG)) \
+            if args.engine != 'dict' else None
+    if FORMAT in ['bin', 'events']:
+        BOOK = AddressBook(DIR)
+    elif CHECKPOINT is not None:
+        BOOK = CHECKPOINT.book()
+    else:
+        BOOK = None
     
     try:
-        BALANCES_PKL_FILE = [f for f in os.listdir(DIR) if f.endswith('pickle')][0]
+        BALANCES_PKL_FILE = pickle_files(DIR, TAG)[0]
         NUM_PROCESSED_WEEKS = int(BALANCES_PKL_FILE.split('.')[0].split('_')[-1])
     except IndexError:
         BALANCES_PKL_FILE = None
         NUM_PROCESSED_WEEKS  = 0
+    if CHECKPOINT is not None and CHECKPOINT.weeks:
+        BALANCES_PKL_FILE = None
+        NUM_PROCESSED_WEEKS = CHECKPOINT.weeks
 
-    PKL_FILES = list(sorted(pkl_files))[NUM_PROCESSED_WEEKS:]
-    N_FILES = len(PKL_FILES)
-    # print(NUM_PROCESSED_WEEKS, N_FILES, PKL_FILES[0])
-    
-    START_DATE = datetime.datetime.strptime(args.start_date, '%Y-%m-%d')
-    DELTA = datetime.timedelta(weeks=1)
+    # new rows of weeks that are already processed cannot be added to saved balances
+    SPLIT = read_split_manifest(DIR) if args.incremental else None
+    if SPLIT is not None and SPLIT['first_new_week'] < NUM_PROCESSED_WEEKS:
+        print('Week {} has changed since balances were saved, calculating all weeks again...'.\
+                format(SPLIT['first_new_week']))
+        for f in pickle_files(DIR, TAG):
+            os.remove(os.path.join(DIR, f))
+        if CHECKPOINT is not None:
+            CHECKPOINT.clear()
+        BALANCES_PKL_FILE = None
+        NUM_PROCESSED_WEEKS = 0
+    # the earliest week that may get new rows from CSV files split next time
+    OPEN_WEEK = min(SPLIT['open_week'], len(weeks) - 1) if SPLIT is not None else len(weeks) - 1
 
-    date = START_DATE + DELTA * NUM_PROCESSED_WEEKS
-    # date = START_DATE + DELTA
+    WEEKS = weeks[NUM_PROCESSED_WEEKS:]
+    # balances changed in weeks after saved balances are logged again
+    HISTORY = HistoryWriter(os.path.join(DIR, HISTORY_DIR + TAG), NUM_PROCESSED_WEEKS) \
+            if args.history else None
+    DATES = DATES[NUM_PROCESSED_WEEKS:]
+    N_FILES = len(WEEKS)
+    
+    SCALE = value_scale(args.name)
+    # the disk engine keeps balances in files, at most MEMORY_BUDGET bytes of them in memory
+    ENGINE_ARGS = {'path': os.path.join(DIR, STORE_DIR + TAG),
+            'memory_budget': args.memory_budget * 2**20}
+    fname = os.path.join(DIR, 'top{}_balances'.format(args.top) + TAG + \
+        '_addresses' * args.keep_address + '.csv')
     if BALANCES_PKL_FILE:
         with open(os.path.join(DIR, BALANCES_PKL_FILE), 'rb') as f:
-            balances = pickle.load(f)
-        os.remove(os.path.join(DIR, BALANCES_PKL_FILE))
-        fname = os.path.join(DIR, 'top{}_balances'.format(args.top) + \
-            '_addresses' * args.keep_address + '.csv')
-        main_df = pd.read_csv(fname, header=0)
+            balances = make_engine(args.engine, SCALE, pickle.load(f), BOOK, limbs=EXACT_LIMBS,
+                    **ENGINE_ARGS)
+    elif NUM_PROCESSED_WEEKS:
+        balances = make_engine(args.engine, SCALE, book=BOOK, limbs=EXACT_LIMBS, **ENGINE_ARGS)
+        print('Resuming from checkpoint at week {}...'.format(NUM_PROCESSED_WEEKS))
+        resume_time = CHECKPOINT.restore(balances)
+        print('Balances restored in {:.4f} s'.format(resume_time))
     else:
-        balances = defaultdict(float)
-        main_df = pd.DataFrame()
+        balances = make_engine(args.engine, SCALE, book=BOOK, limbs=EXACT_LIMBS, **ENGINE_ARGS)
+
+    # weekly top balances are appended to a binary store and exported to CSV at the end
+    store = TopStore(fname[:-len('.csv')], args.top, keep_ids=args.keep_address)
+    if NUM_PROCESSED_WEEKS and not len(store) and os.path.isfile(fname) and not args.keep_address:
+        # results of older versions are only saved in the CSV file
+        store.import_csv(fname)
+    if len(store) < NUM_PROCESSED_WEEKS:
+        raise ValueError('Store \"{}\" has fewer weeks than saved balances!'.format(store.path))
+    # weeks saved after the last checkpoint are calculated again
+    store.truncate(NUM_PROCESSED_WEEKS)
+    SKETCHES = SketchStore(os.path.join(DIR, SKETCH_DIR + TAG)) if args.sketch else None
+    if SKETCHES is not None:
+        if len(SKETCHES) < NUM_PROCESSED_WEEKS:
+            raise ValueError('Store \"{}\" has fewer weeks than saved balances, calculate all '
+                'weeks again!'.format(SKETCHES.path))
+        SKETCHES.truncate(NUM_PROCESSED_WEEKS)
+    if SKETCHES is not None and args.shards == 1:
+        # the sketch of restored balances is built from them, then updated with changed balances
+        balances.sketch = BalanceSketch.of(balances.nonzero_items(), 1 / SCALE)
 
     # signal.signal(signal.SIGINT, handler)
 
-    print('Calculating top account balances...')
-    start = time()
-    for i, file_ in enumerate(PKL_FILES):
-        if args.verbose:
-            print(' file {} out of {}'.format(i + NUM_PROCESSED_WEEKS,
-                N_FILES + NUM_PROCESSED_WEEKS - 1), end='\n')
+    TELEMETRY = Telemetry(args.telemetry, script='calc_top_balances', name=args.name,
+            engine=args.engine)
+    PROFILER = Profiler(args.profile)
 
-        for sd in SUB_DIRS:
-            fname = os.path.join(DIR, sd, 'pkl', file_)
-            f = open(fname, 'rb')
-            gc.disable()
-            df = pickle.load(f)
-            gc.enable()
-            f.close()
-
-            z1 = zip(*df.to_dict('list').values())
-            for address, value in z1:
-                balances[address] += (value / 10**8) if not args.name.lower().startswith('eth') \
-                        else (value / 10**18)
+    if args.shards > 1:
+        if NUM_PROCESSED_WEEKS:
+            raise ValueError('Resuming from saved balances is not supported with --shards!')
+        if args.keep_address and FORMAT == 'pkl':
+            raise ValueError('Keeping addresses with --shards requires binary weekly partitions!')
+        print('Calculating top account balances in {} shards...'.format(args.shards))
+        start = time()
+        tasks = [(DIR, SUB_DIRS, FORMAT, WEEKS, SCALE, LIMBS, args.exact, args.top, shard,
+            args.shards, args.sketch, args.verbose) for shard in range(args.shards)]
+        with Pool(args.shards) as pool:
+            shard_tops, shard_sketches = zip(*pool.map(calc_shard, tasks))
+        TELEMETRY.lap('shards')
+        for i in range(N_FILES):
+            ids, values = merge_tops([tops[i] for tops in shard_tops], args.top)
+            store.append(DATES[i], values, ids)
+            if SKETCHES is not None:
+                # sketches of disjoint shards are added up
+                sketch = BalanceSketch()
+                for sketches in shard_sketches:
+                    sketch.merge(sketches[i])
+                SKETCHES.append(DATES[i], sketch)
+        TELEMETRY.lap('merge')
+        TELEMETRY.record('shards', weeks=N_FILES, shards=args.shards)
+    else:
+        print('Calculating top account balances...')
+        start = time()
+        last_checkpoint = start
+        PROFILER.start()
+        for i, week in enumerate(WEEKS):
+            if args.verbose:
+                print(' file {} out of {}'.format(i + NUM_PROCESSED_WEEKS,
+                    N_FILES + NUM_PROCESSED_WEEKS), end='\n')
+
+            if args.incremental and i + NUM_PROCESSED_WEEKS == OPEN_WEEK:
+                # the week may be incomplete, so balances are saved before it and the next
+                # incremental run starts from this week again
+                store.flush()
+                if HISTORY is not None:
+                    HISTORY.flush()
+                if SKETCHES is not None:
+                    SKETCHES.flush()
+                if CHECKPOINT is not None:
+                    CHECKPOINT.save(balances, i + NUM_PROCESSED_WEEKS)
+                else:
+                    save_pickle(DIR, TAG, balances, i + NUM_PROCESSED_WEEKS)
+                print('\nBalances saved before week {}'.format(i + NUM_PROCESSED_WEEKS))
+                TELEMETRY.lap('checkpoint')
+
+            rows = apply_week(balances, DIR, SUB_DIRS, FORMAT, week, telemetry=TELEMETRY,
+                    limbs=LIMBS)
+            if HISTORY is not None:
+                # changed balances are taken before the top-K, which consumes them
+                HISTORY.append(DATES[i], *balances.changed_items())
+                TELEMETRY.lap('history')
+            if SKETCHES is not None:
+                SKETCHES.append(DATES[i], balances.sketch)
+                TELEMETRY.lap('sketch')
         
-        # if args.keep_address:
-            # balances = defaultdict(float, {k: v for k, v in sorted(balances.items(), reverse=True, 
-                # key=lambda item: item[1]) if v})
-            # sorted_d_len = len(balances)
-        # else:
-        if i % args.drop_step:
-            sorted_d = [v for v in balances.values() if v]
-        else:
-            balances = defaultdict(float, {k: v for k, v in balances.items() if v})
-            sorted_d = list(balances.values())
-        sorted_d.sort(reverse=True)
-        sorted_d_len = len(sorted_d)
+            if not (i % args.drop_step):
+                balances.drop_zeros()
+                TELEMETRY.lap('drop_zeros')
+            if args.keep_address:
+                # IDs of addresses come from the incrementally maintained top-K
+                ids, sorted_d = balances.top_items(args.top)
+                TELEMETRY.lap('top')
+                store.append(DATES[i], sorted_d, ids)
+            else:
+                sorted_d = balances.top(args.top)
+                TELEMETRY.lap('top')
+                store.append(DATES[i], sorted_d)
+            TELEMETRY.lap('store')
 
-        cut = args.top if sorted_d_len >= args.top else sorted_d_len
-    
-        # if not args.keep_address:
-        df = pd.DataFrame({date.strftime('%Y-%m-%d'): sorted_d[:cut]})
-        # else:
-            # df = pd.DataFrame({date.strftime('%Y-%m-%d'): list(balances.keys())[:cut]})
-            # df = pd.concat([df, pd.DataFrame({'': list(balances.values())[:cut]})], axis=1)
-        main_df = pd.concat([main_df, df], axis=1)
-        date += DELTA
-
-        # sleep(2)
-
-        # '''
-        # if stop:
-        if not (i % 50):
-            try:
-                BALANCES_PKL_FILE = [f for f in os.listdir(DIR) if f.endswith('pickle')][0]
-                os.remove(os.path.join(DIR, BALANCES_PKL_FILE))
-            except:
+            # sleep(2)
+
+            # '''
+            # if stop:
+            if args.incremental and i + NUM_PROCESSED_WEEKS >= OPEN_WEEK:
+                # balances including an incomplete week are not saved
                 pass
-            print('\nSaving balances to pkl file at week {}...'.format(i + NUM_PROCESSED_WEEKS))
-            with open(os.path.join(DIR, 'balances_{}.pickle'.format(i + NUM_PROCESSED_WEEKS + 1)), 
-                    'wb') as f:
-                pickle.dump(balances, f, pickle.HIGHEST_PROTOCOL)
-            # assert main_df.shape[1] == N_FILES if not args.keep_address else N_FILES / 2
-            fname = os.path.join(DIR, 'top{}_balances'.format(args.top) + \
-                '_addresses' * args.keep_address + '.csv')
-            main_df.to_csv(fname, index=False)
-            # print('Exiting...')
-            # exit()
-        # '''
+            elif CHECKPOINT is not None:
+                if not ((i + 1) % args.checkpoint_weeks) or (args.checkpoint_seconds and
+                        time() - last_checkpoint >= args.checkpoint_seconds):
+                    store.flush()
+                    if HISTORY is not None:
+                        HISTORY.flush()
+                    if SKETCHES is not None:
+                        SKETCHES.flush()
+                    n_bytes = CHECKPOINT.save(balances, i + NUM_PROCESSED_WEEKS + 1)
+                    last_checkpoint = time()
+                    print('\nCheckpoint at week {}: {:.2f} MB written'.format(
+                        i + NUM_PROCESSED_WEEKS, n_bytes / 2**20))
+            elif not (i % args.checkpoint_weeks):
+                print('\nSaving balances to pkl file at week {}...'.format(i + NUM_PROCESSED_WEEKS))
+                store.flush()
+                save_pickle(DIR, TAG, balances, i + NUM_PROCESSED_WEEKS + 1)
+                # print('Exiting...')
+                # exit()
+            # '''
+            TELEMETRY.lap('checkpoint')
+            TELEMETRY.record('week', rows, len(balances), week=i + NUM_PROCESSED_WEEKS,
+                    date=DATES[i])
+        PROFILER.stop()
 
     print(' ' * 50, end='\n')
     print('Calculating done! Saving data...')
-    # assert main_df.shape[1] == N_FILES if not args.keep_address else N_FILES / 2
-    fname = os.path.join(DIR, 'top{}_balances'.format(args.top) + \
-            '_addresses' * args.keep_address + '.csv')
-    # main_df = main_df / 10**8 if not args.name.lower().startswith('eth') else main_df / 10**18
-    main_df.to_csv(fname)
-    with open(os.path.join(DIR, 'balances_{}.pickle'.format(N_FILES + NUM_PROCESSED_WEEKS - 1)), 
-            'wb') as f:
-        pickle.dump(balances, f, pickle.HIGHEST_PROTOCOL)
+    store.close()
+    store.export_csv(fname, BOOK if args.keep_address else None)
+    if SKETCHES is not None:
+        SKETCHES.close()
+        print('Sketches of all balances saved in {}'.format(SKETCHES.path))
+    if args.incremental:
+        # balances are already saved before the first incomplete week
+        pass
+    elif CHECKPOINT is not None and args.shards == 1:
+        CHECKPOINT.save(balances, N_FILES + NUM_PROCESSED_WEEKS, base=True)
+        print('Checkpoints: {:.2f} MB written in {:.4f} s'.format(CHECKPOINT.bytes_written / 2**20,
+            CHECKPOINT.seconds))
+    elif args.shards == 1:
+        save_pickle(DIR, TAG, balances, N_FILES + NUM_PROCESSED_WEEKS)
+    balances.close()
     if args.verbose:
-        print(main_df.iloc[:20, :])
+        print(store.to_frame(BOOK if args.keep_address else None).iloc[:20, :])
+    TELEMETRY.lap('save')
+    if HISTORY is not None:
+        HISTORY.close()
+        # addresses of the last weeks may not be saved by a checkpoint yet
+        BOOK.save()
+        # dates of weekly partitions are the starts of weeks, rows of a week end 7 days later
+        n_points = build_history(HISTORY.path, BOOK.path, args.verbose, 0 if CALENDAR else 7)
+        print('History of {} change points saved in {}'.format(n_points, HISTORY.path))
+        TELEMETRY.lap('history')
+    TELEMETRY.record('done', weeks=N_FILES, elapsed=time() - start)
+    TELEMETRY.close()
     print('Elapsed time: {:.4f} s'.format(time() - start))
     print('Data saved in {}'.format(fname))
 
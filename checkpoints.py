@@ -0,0 +1,160 @@
+# This module contains incremental checkpoints of balances calculated by the array and disk engines
+# of calc_top_balances.py. A checkpoint is a base snapshot of all non-zero balances plus a log of
+# deltas, each holding only the balances changed since the previous checkpoint. Snapshots and
+# deltas are raw binary arrays of IDs and balances. All files are written under temporary names
+# and renamed when complete, and the list of valid files is kept in a manifest that is replaced
+# last, so a crash during saving leaves the previous checkpoint intact. Exact balances (--exact) are
+# saved as rows of limbs in base units (see fixedpoint.py).
+
+import os
+import json
+import numpy as np
+from time import time
+
+from fixedpoint import UNITS_DTYPE
+from partitions import ADDRESSES_FILE, IDS_DTYPE, AddressBook
+
+
+CHECKPOINT_DIR = 'checkpoint'
+MANIFEST_FILE = 'manifest.json'
+
+
+# rows restored at a time (the disk engine never holds a whole snapshot in memory)
+RESTORE_ROWS = 2**24
+
+
+def _write(path, name, items):
+    # ITEMS are arrays of IDs and balances, or an iterable of such pairs written one by one
+    if isinstance(items, tuple):
+        items = [items]
+    files = [(name + ext, open(os.path.join(path, name + ext + '.tmp'), 'wb'))
+            for ext in ['.ids', '.val']]
+    for ids, values in items:
+        np.ascontiguousarray(ids, dtype=IDS_DTYPE).tofile(files[0][1])
+        np.ascontiguousarray(values, dtype=UNITS_DTYPE if values.ndim == 2 else np.float64).\
+                tofile(files[1][1])
+    n_bytes = 0
+    for fname, f in files:
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.replace(os.path.join(path, fname + '.tmp'), os.path.join(path, fname))
+        n_bytes += os.path.getsize(os.path.join(path, fname))
+    return n_bytes
+
+
+def _read(path, name, limbs=0):
+    # memory-mapped IDs and balances, rows of LIMBS limbs if LIMBS (None if there are none)
+    if not os.path.getsize(os.path.join(path, name + '.ids')):
+        return None, None
+    ids = np.memmap(os.path.join(path, name + '.ids'), dtype=IDS_DTYPE, mode='r')
+    if limbs:
+        return ids, np.memmap(os.path.join(path, name + '.val'), dtype=UNITS_DTYPE, mode='r',
+                shape=(ids.shape[0], limbs))
+    return ids, np.memmap(os.path.join(path, name + '.val'), dtype=np.float64, mode='r')
+
+
+class Checkpoint:
+
+    def __init__(self, path, base_every=10):
+        # BASE_EVERY: a new base snapshot is written after this many deltas
+        self.path = path
+        self.base_every = base_every
+        self.manifest = None
+        self.bytes_written = 0
+        self.seconds = 0.
+        if os.path.isfile(os.path.join(path, MANIFEST_FILE)):
+            with open(os.path.join(path, MANIFEST_FILE), 'r') as f:
+                self.manifest = json.load(f)
+
+    @property
+    def weeks(self):
+        # number of processed weeks saved in the checkpoint
+        return self.manifest['weeks'] if self.manifest else 0
+
+    def book(self):
+        # address book owned by the checkpoint (if weekly partitions have no address IDs), lines
+        # appended by an interrupted save are dropped
+        book = AddressBook(self.path)
+        book.truncate(self.manifest['addresses'] if self.manifest else 0)
+        return book
+
+    def clear(self):
+        # drops saved balances (the address book is kept, IDs of addresses do not change)
+        if self.manifest is not None:
+            for name in [self.manifest['base']] + self.manifest['deltas']:
+                for ext in ['.ids', '.val']:
+                    if os.path.isfile(os.path.join(self.path, name + ext)):
+                        os.remove(os.path.join(self.path, name + ext))
+            os.remove(os.path.join(self.path, MANIFEST_FILE))
+        self.manifest = None
+
+    def restore(self, balances):
+        start = time()
+        limbs = self.manifest.get('limbs', 0)
+        if limbs != balances.limbs:
+            raise ValueError('Balances in \"{}\" were saved with{} --exact, calculate all weeks '
+                'again!'.format(self.path, '' if limbs else 'out'))
+        for name in [self.manifest['base']] + self.manifest['deltas']:
+            ids, values = _read(self.path, name, limbs)
+            if ids is None:
+                balances.restore(self.manifest['n'], np.empty(0, dtype=IDS_DTYPE),
+                        np.empty((0, limbs), dtype=UNITS_DTYPE) if limbs else np.empty(0))
+                continue
+            for i in range(0, ids.shape[0], RESTORE_ROWS):
+                balances.restore(self.manifest['n'], np.asarray(ids[i:i + RESTORE_ROWS]),
+                        np.asarray(values[i:i + RESTORE_ROWS]))
+        balances.clear_dirty()
+        return time() - start
+
+    def save(self, balances, weeks, base=False):
+        # saves a delta (or a new base snapshot if BASE or after BASE_EVERY deltas), returns the
+        # number of bytes written
+        start = time()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        base = base or self.manifest is None or len(self.manifest['deltas']) >= self.base_every
+        name = '{}_{:04d}'.format('base' if base else 'delta', weeks)
+        if balances.limbs:
+            # exact balances are saved in base units
+            items = balances.nonzero_items(units=True) if base else \
+                    balances.dirty_items(units=True)
+        else:
+            items = balances.nonzero_items() if base else balances.dirty_items()
+        n_bytes = _write(self.path, name, items)
+
+        book = balances.book
+        if book.path == self.path:
+            before = os.path.getsize(os.path.join(self.path, ADDRESSES_FILE)) \
+                    if book.n_saved else 0
+            book.save()
+            n_bytes += os.path.getsize(os.path.join(self.path, ADDRESSES_FILE)) - before
+
+        old = self.manifest
+        manifest = {
+                'weeks': weeks,
+                'n': len(balances),
+                'limbs': balances.limbs,
+                'addresses': len(book) if book.path == self.path else 0,
+                'base': name if base else old['base'],
+                'deltas': [] if base else old['deltas'] + [name],
+                }
+        tmp = os.path.join(self.path, MANIFEST_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, MANIFEST_FILE))
+        self.manifest = manifest
+        balances.clear_dirty()
+
+        # files of the previous checkpoint are not needed after a new base snapshot
+        if base and old is not None:
+            for old_name in [old['base']] + old['deltas']:
+                for ext in ['.ids', '.val']:
+                    if old_name != name and os.path.isfile(os.path.join(self.path, old_name + ext)):
+                        os.remove(os.path.join(self.path, old_name + ext))
+
+        self.bytes_written += n_bytes
+        self.seconds += time() - start
+        return n_bytes
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3.9
+
+# This script can be used to convert weekly pickle files (written by older versions of split_csv.py)
+# to binary files that are memory-mapped by calc_top_balances.py
+
+import os
+import argparse
+from time import time
+
+from partitions import AddressBook, list_sub_dirs, list_weeks, read_pkl_week, write_week
+
+
+def main():
+    formatter = lambda prog: argparse.RawTextHelpFormatter(prog, max_help_position=50)
+    parser = argparse.ArgumentParser(
+            description='Converts weekly pickle files to binary files',
+            add_help=False,
+            formatter_class=formatter,
+            )
+
+    # required arguments
+    required_args = parser.add_argument_group('required arguments')
+    required_args.add_argument(
+            '--dir',
+            type=str,
+            required=True,
+            help='Path to parent directory with blockchain historical data',
+            )
+    required_args.add_argument(
+            '--name',
+            type=str,
+            required=True,
+            help='Name of blockchain (also the name of the folder with pickle files)',
+            )
+
+    # optimal arguments
+    optional_args = parser.add_argument_group('optional arguments')
+    optional_args.add_argument(
+            '-h',
+            '--help',
+            action='help',
+            help='show this help message and exit',
+            )
+    optional_args.add_argument(
+            '--rm',
+            action='store_true',
+            default=False,
+            help='Remove pickle files after converting, defaults to False'
+            )
+    optional_args.add_argument(
+            '--verbose',
+            action='store_true',
+            default=False,
+            help='Print detailed output to console, defaults to False'
+            )
+    args = parser.parse_args()
+
+    DIR = os.path.join(args.dir, args.name)
+    if not os.path.isdir(DIR):
+        raise FileNotFoundError('Directory \"{}\" does not exist!'.format(DIR))
+
+    SUB_DIRS = [d for d in list_sub_dirs(DIR) if os.path.isdir(os.path.join(DIR, d, 'pkl'))]
+    if not SUB_DIRS:
+        raise FileNotFoundError('Directory \"{}\" contains no pickle files!'.format(DIR))
+
+    book = AddressBook(DIR)
+    book.clear()
+
+    start = time()
+    for sd in SUB_DIRS:
+        sub_dir = os.path.join(DIR, sd)
+        weeks = list_weeks(sub_dir, 'pkl')
+        if not os.path.isdir(os.path.join(sub_dir, 'bin')):
+            os.makedirs(os.path.join(sub_dir, 'bin'))
+
+        print('Converting data in \"{}\"...'.format(sub_dir))
+        for i, week in enumerate(weeks):
+            if args.verbose:
+                print(' file {} out of {}'.format(i, len(weeks) - 1), end='\n')
+            df = read_pkl_week(sub_dir, week)
+            write_week(sub_dir, 'bin', week, df['address'].to_numpy(), df['value'].to_numpy(), book)
+            if args.rm:
+                os.remove(os.path.join(sub_dir, 'pkl', '{:04d}.pkl'.format(week)))
+        book.save()
+
+    print(' ' * 50, end='\n')
+    print('Converting done!')
+    print('Elapsed time: {:.4f} s'.format(time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,537 @@
+# This module contains the engines used by calc_top_balances.py to accumulate account balances
+# from weekly data. Balances are floats in coins, or exact integers in base units with --exact (see
+# fixedpoint.py), which the dict engine keeps as python integers and the array engine as rows of
+# int64 limbs.
+
+import os
+import numpy as np
+from collections import OrderedDict, defaultdict
+
+from addresskeys import address_keys, row_keys
+from fixedpoint import UNITS_DTYPE, from_ints, normalize, sum_by_id, to_coins, to_ints
+from partitions import IDS_DTYPE, AddressBook
+
+
+ENGINES = ['dict', 'array', 'disk']
+# folder and files of balances of the disk engine
+STORE_DIR = 'store'
+STORE_VALUES_FILE = 'values.bin'
+STORE_DIRTY_FILE = 'dirty.bin'
+# a cold block is loaded to memory if it gets at least BLOCK / SPARSE_UPDATES updates in a week
+SPARSE_UPDATES = 64
+
+
+def value_scale(name):
+    # values are stored in satoshi-like units (10**8) or in wei (10**18) for Ethereum-like chains
+    return 10**18 if name.lower().startswith('eth') else 10**8
+
+
+def balance_ids(book, balances):
+    # IDs of balances loaded from a pickle of the dict engine, which is keyed by address keys (or
+    # by addresses if saved by older versions)
+    keys = list(balances)
+    if isinstance(keys[0], str):
+        return book.ids(keys)
+    return book.key_ids(keys)
+
+
+def check_saved(balances, limbs):
+    # balances saved by the dict engine are python integers if they were calculated exactly
+    if balances and isinstance(next(iter(balances.values())), int) != bool(limbs):
+        raise ValueError('Saved balances were calculated with{} --exact, calculate all weeks '
+            'again!'.format('out' if limbs else ''))
+
+
+def _distinct(ids):
+    # sorted distinct IDS, like np.unique (which may hash instead of sorting)
+    ids = np.sort(ids)
+    return ids[np.r_[True, ids[1:] != ids[:-1]]] if ids.shape[0] else ids
+
+
+class DictBalances:
+    # The original engine: a dictionary {address key: balance} updated row by row, addresses are
+    # replaced by their compact binary keys (see addresskeys.py). Balances are python integers in
+    # base units if LIMBS (values are given as rows of LIMBS limbs)
+
+    def __init__(self, scale, balances=None, book=None, limbs=0):
+        self.scale = scale
+        self.limbs = limbs
+        self.zero = int if limbs else float
+        check_saved(balances, limbs)
+        if balances and isinstance(next(iter(balances)), str):
+            balances = defaultdict(self.zero, zip(address_keys(list(balances)), balances.values()))
+        self.balances = balances if balances is not None else defaultdict(self.zero)
+        self.book = book
+
+    def __len__(self):
+        return len(self.balances)
+
+    def update(self, addresses, values):
+        self.update_keys(row_keys(addresses), values)
+
+    def update_ids(self, ids, values):
+        self.update_keys(self.book.keys_of(ids), values)
+
+    def update_keys(self, keys, values):
+        balances = self.balances
+        if self.limbs:
+            for key, value in zip(keys, to_ints(values)):
+                balances[key] += value
+            return
+        scale = self.scale
+        for key, value in zip(keys, np.asarray(values).tolist()):
+            balances[key] += value / scale
+
+    def drop_zeros(self):
+        self.balances = defaultdict(self.zero, {k: v for k, v in self.balances.items() if v})
+
+    def nonzero(self):
+        if self.limbs:
+            # integers are converted to coins with a single rounding
+            scale = self.scale
+            return [v / scale for v in self.balances.values() if v]
+        return [v for v in self.balances.values() if v]
+
+    def top(self, n):
+        sorted_d = self.nonzero()
+        sorted_d.sort(reverse=True)
+        return sorted_d[:n]
+
+    def to_dict(self):
+        return self.balances
+
+    def close(self):
+        pass
+
+
+class TopK:
+    # Incrementally maintained top-K: a small set of tracked IDs (at least K, at most 2 * SIZE)
+    # together with a threshold such that every untracked non-zero balance is not larger than the
+    # threshold. Only addresses changed in a week can then enter the top-K, so the weekly cost
+    # grows with the week's activity and not with the total number of addresses. A full partial
+    # selection over all balances is only needed when too many tracked balances drop below the
+    # threshold.
+
+    def __init__(self, k, reserve=None):
+        self.k = k
+        self.size = k + (k if reserve is None else reserve)
+        self.tracked = np.empty(0, dtype=np.int64)
+        self.threshold = None
+        self.rebuilds = 0
+
+    def rebuild(self, values):
+        tracked = np.flatnonzero(values)
+        if tracked.shape[0] > self.size:
+            cut = tracked.shape[0] - self.size
+            tracked = tracked[np.argpartition(values[tracked], cut)[cut:]]
+            self.threshold = values[tracked].min()
+        else:
+            self.threshold = -np.inf
+        self.tracked = tracked
+        self.rebuilds += 1
+
+    def update(self, values, changed):
+        if self.threshold is None:
+            self.rebuild(values)
+        else:
+            changed = np.unique(changed)
+            entering = changed[values[changed] > self.threshold]
+            self.tracked = np.union1d(self.tracked, entering)
+            tracked_values = values[self.tracked]
+            if self.threshold > -np.inf and \
+                    np.count_nonzero((tracked_values >= self.threshold) & (tracked_values != 0)) \
+                    < self.k:
+                self.rebuild(values)
+            elif self.tracked.shape[0] > 2 * self.size:
+                tracked = self.tracked[tracked_values != 0]
+                if tracked.shape[0] > self.size:
+                    cut = tracked.shape[0] - self.size
+                    tracked = tracked[np.argpartition(values[tracked], cut)[cut:]]
+                    self.threshold = max(self.threshold, values[tracked].min())
+                self.tracked = tracked
+
+        # IDs and values of the top-K sorted by value in descending order
+        ids = self.tracked[values[self.tracked] != 0]
+        if ids.shape[0] > self.k:
+            ids = ids[np.argpartition(values[ids], ids.shape[0] - self.k)[ids.shape[0] - self.k:]]
+        ids = ids[np.argsort(values[ids], kind='stable')[::-1]]
+        return ids, values[ids]
+
+
+class ArrayBalances:
+    # Vectorized engine: each address is mapped to a dense integer ID once, balances are kept in
+    # a numpy array indexed by that ID, and every weekly file is applied in one vectorized update.
+    # If LIMBS, exact balances in base units are kept as rows of LIMBS limbs in UNITS, and VALUES
+    # holds them in coins for the top-K, sketches and histories (a balance is zero in VALUES if and
+    # only if it is exactly zero)
+
+    def __init__(self, scale, balances=None, book=None, limbs=0):
+        self.scale = scale
+        self.limbs = limbs
+        self.book = book if book is not None else AddressBook()
+        self.n = len(self.book)
+        self.values = np.zeros(max(1024, self.n))
+        self.units = np.zeros((self.values.shape[0], limbs), dtype=UNITS_DTYPE) if limbs else None
+        # IDs changed since the last checkpoint
+        self.dirty = np.zeros(self.values.shape[0], dtype=bool)
+        self.topk = None
+        self.changed = []
+        # sketch of all balances (see sketches.py) updated with changed balances, if set
+        self.sketch = None
+        check_saved(balances, limbs)
+        if balances:
+            ids = balance_ids(self.book, balances)
+            self._reserve(len(self.book))
+            self.n = len(self.book)
+            if limbs:
+                self.restore(self.n, ids, from_ints(list(balances.values()), limbs))
+            else:
+                self.values[ids] = np.fromiter(balances.values(), dtype=float,
+                        count=len(balances))
+
+    def __len__(self):
+        return self.n
+
+    def _reserve(self, n):
+        if n > self.values.shape[0]:
+            values = np.zeros(max(n, 2 * self.values.shape[0]))
+            values[:self.values.shape[0]] = self.values
+            self.values = values
+            dirty = np.zeros(values.shape[0], dtype=bool)
+            dirty[:self.dirty.shape[0]] = self.dirty
+            self.dirty = dirty
+            if self.units is not None:
+                units = np.zeros((values.shape[0], self.limbs), dtype=UNITS_DTYPE)
+                units[:self.units.shape[0]] = self.units
+                self.units = units
+
+    def update(self, addresses, values):
+        return self.update_ids(self.book.ids(addresses), values)
+
+    def update_ids(self, ids, values):
+        # IDs are either given by the address book or dense IDs of a shard of the address space
+        self.n = max(self.n, len(self.book), int(ids.max()) + 1 if ids.shape[0] else 0)
+        self._reserve(self.n)
+        if self.units is not None:
+            # rows are summed up per ID exactly, only balances of changed IDs are converted
+            changed, sums = sum_by_id(ids, values)
+            if self.sketch is not None:
+                old = self.values[changed]
+            self.units[changed] = normalize(self.units[changed] + sums)
+            self.values[changed] = to_coins(self.units[changed], self.scale)
+        else:
+            if self.sketch is not None:
+                changed = _distinct(ids)
+                old = self.values[changed]
+            # np.add.at applies the updates unbuffered and in row order, so the resulting balances
+            # are bitwise identical to the ones of DictBalances
+            np.add.at(self.values, ids, np.asarray(values, dtype=float) / self.scale)
+        if self.sketch is not None:
+            self.sketch.update(old, self.values[changed])
+        self.dirty[ids] = True
+        self.changed.append(ids)
+        return ids
+
+    def drop_zeros(self):
+        # zero balances cost 8 bytes in the array, addresses keep their IDs
+        pass
+
+    def nonzero(self):
+        values = self.values[:self.n]
+        return values[values != 0]
+
+    def top(self, n):
+        return self.top_items(n)[1].tolist()
+
+    def top_items(self, n):
+        # IDs and values of the top N balances, only the addresses changed since the previous call
+        # are looked at
+        if self.topk is None or self.topk.k != n:
+            self.topk = TopK(n)
+        changed = np.concatenate(self.changed) if self.changed else np.empty(0, dtype=np.int64)
+        self.changed = []
+        return self.topk.update(self.values[:self.n], changed)
+
+    def changed_items(self):
+        # IDs changed since the top-K was last taken (i.e. in the current week) and their balances
+        ids = np.unique(np.concatenate(self.changed)) if self.changed else \
+                np.empty(0, dtype=IDS_DTYPE)
+        return ids, self.values[ids]
+
+    def nonzero_items(self, units=False):
+        # balances in coins, or exact balances in base units if UNITS
+        ids = np.flatnonzero(self.values[:self.n])
+        return ids, self.units[ids] if units else self.values[ids]
+
+    def dirty_items(self, units=False):
+        ids = np.flatnonzero(self.dirty[:self.n])
+        return ids, self.units[ids] if units else self.values[ids]
+
+    def clear_dirty(self):
+        self.dirty[:] = False
+
+    def restore(self, n, ids, values):
+        # restores balances saved by a checkpoint (the top-K is rebuilt at the next week), VALUES
+        # are rows of limbs if LIMBS
+        self.n = n
+        self._reserve(n)
+        if self.units is not None:
+            self.units[ids] = values
+            self.values[ids] = to_coins(values, self.scale)
+        else:
+            self.values[ids] = values
+
+    def to_dict(self):
+        if self.units is not None:
+            return defaultdict(int, zip(self.book.load().keys, to_ints(self.units[:self.n])))
+        values = self.values[:self.n].tolist()
+        return defaultdict(float, zip(self.book.load().keys, values))
+
+    def close(self):
+        pass
+
+
+class DiskBalances:
+    # Out-of-core engine for address sets larger than memory: balances are kept in a raw binary file
+    # indexed by dense address IDs and split into blocks of BLOCK IDs. At most MEMORY_BUDGET bytes of
+    # blocks are held in memory (the hot tier), the least recently updated blocks are written back
+    # to the file first. Every week is applied in one batch sorted by block, so each block is
+    # loaded at most once per week; a cold block with only a few updates is updated in the file
+    # directly instead of evicting a hot one. IDs are given in the order of first appearance, so
+    # recently active addresses share the last blocks
+
+    def __init__(self, scale, balances=None, book=None, path=None, memory_budget=2**30,
+            block=2**20):
+        self.scale = scale
+        # balances are always floats
+        self.limbs = 0
+        self.book = book if book is not None else AddressBook()
+        self.path = path
+        self.block = block
+        # values and dirty flags of a block take 9 bytes per ID
+        self.max_hot = max(1, memory_budget // (9 * block))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        # the files are a working copy of balances (saved balances are kept by checkpoints)
+        for file_ in [STORE_VALUES_FILE, STORE_DIRTY_FILE]:
+            open(os.path.join(path, file_), 'wb').close()
+        self.capacity = 0
+        self.disk = None
+        self.disk_dirty = None
+        self.hot = OrderedDict()
+        self.loads = 0
+        self.n = len(self.book)
+        self._reserve(max(self.n, 1))
+        self.topk = None
+        self.changed = []
+        self.sketch = None
+        if balances:
+            ids = balance_ids(self.book, balances)
+            self.restore(len(self.book), ids,
+                    np.fromiter(balances.values(), dtype=float, count=len(balances)))
+
+    def __len__(self):
+        return self.n
+
+    def _map(self):
+        self.disk = np.memmap(os.path.join(self.path, STORE_VALUES_FILE), dtype=np.float64,
+                mode='r+', shape=(self.capacity,))
+        self.disk_dirty = np.memmap(os.path.join(self.path, STORE_DIRTY_FILE), dtype=bool,
+                mode='r+', shape=(self.capacity,))
+
+    def _reserve(self, n):
+        # the files grow by whole blocks (as sparse files, unwritten blocks take no disk space)
+        if n > self.capacity:
+            capacity = max(-(-n // self.block), 2 * self.capacity // self.block) * self.block
+            self.disk = self.disk_dirty = None
+            for file_, itemsize in [(STORE_VALUES_FILE, 8), (STORE_DIRTY_FILE, 1)]:
+                with open(os.path.join(self.path, file_), 'r+b') as f:
+                    f.truncate(capacity * itemsize)
+            self.capacity = capacity
+            self._map()
+
+    def _evict(self, p):
+        values, dirty = self.hot.pop(p)
+        self.disk[p * self.block:(p + 1) * self.block] = values
+        self.disk_dirty[p * self.block:(p + 1) * self.block] = dirty
+
+    def _load(self, p):
+        # values and dirty flags of block P in the hot tier
+        if p in self.hot:
+            self.hot.move_to_end(p)
+        else:
+            while len(self.hot) >= self.max_hot:
+                self._evict(next(iter(self.hot)))
+            self.hot[p] = (np.array(self.disk[p * self.block:(p + 1) * self.block]),
+                    np.array(self.disk_dirty[p * self.block:(p + 1) * self.block]))
+            self.loads += 1
+        return self.hot[p]
+
+    def _groups(self, ids):
+        # positions of IDS grouped by block (in their order within a block)
+        blocks = ids // self.block
+        order = np.argsort(blocks, kind='stable')
+        blocks, starts = np.unique(blocks[order], return_index=True)
+        bounds = np.r_[starts, order.shape[0]]
+        for j, p in enumerate(blocks.tolist()):
+            yield p, order[bounds[j]:bounds[j + 1]]
+
+    def update(self, addresses, values):
+        return self.update_ids(self.book.ids(addresses), values)
+
+    def update_ids(self, ids, values):
+        ids = np.asarray(ids, dtype=IDS_DTYPE)
+        values = np.asarray(values, dtype=float) / self.scale
+        self.n = max(self.n, len(self.book), int(ids.max()) + 1 if ids.shape[0] else 0)
+        self._reserve(self.n)
+        if self.sketch is not None:
+            changed = _distinct(ids)
+            old = self.gather(changed)
+        # rows of a block keep their order, so balances are bitwise identical to ArrayBalances
+        for p, rows in self._groups(ids):
+            if p in self.hot or rows.shape[0] * SPARSE_UPDATES >= self.block:
+                block_values, dirty = self._load(p)
+                local = ids[rows] - p * self.block
+                np.add.at(block_values, local, values[rows])
+                dirty[local] = True
+            else:
+                np.add.at(self.disk, ids[rows], values[rows])
+                self.disk_dirty[ids[rows]] = True
+        if self.sketch is not None:
+            self.sketch.update(old, self.gather(changed))
+        self.changed.append(ids)
+        return ids
+
+    def gather(self, ids):
+        # balances of IDS, cold blocks are read from the file without loading them
+        ids = np.asarray(ids, dtype=IDS_DTYPE)
+        out = np.empty(ids.shape[0])
+        for p, rows in self._groups(ids):
+            if p in self.hot:
+                out[rows] = self.hot[p][0][ids[rows] - p * self.block]
+            else:
+                out[rows] = self.disk[ids[rows]]
+        return out
+
+    def blocks(self):
+        # first ID, values and dirty flags of every block up to the last ID
+        for p in range(-(-self.n // self.block)):
+            size = min(self.block, self.n - p * self.block)
+            if p in self.hot:
+                values, dirty = self.hot[p]
+            else:
+                values = self.disk[p * self.block:(p + 1) * self.block]
+                dirty = self.disk_dirty[p * self.block:(p + 1) * self.block]
+            yield p * self.block, values[:size], dirty[:size]
+
+    def drop_zeros(self):
+        pass
+
+    def nonzero(self):
+        return np.concatenate([values[values != 0] for _, values, _ in self.blocks()] +
+                [np.empty(0)])
+
+    def top(self, n):
+        return self.top_items(n)[1].tolist()
+
+    def top_items(self, n):
+        if self.topk is None or self.topk.k != n:
+            self.topk = DiskTopK(n, self)
+        changed = np.concatenate(self.changed) if self.changed else np.empty(0, dtype=np.int64)
+        self.changed = []
+        return self.topk.update(DiskValues(self), changed)
+
+    def changed_items(self):
+        ids = np.unique(np.concatenate(self.changed)) if self.changed else \
+                np.empty(0, dtype=IDS_DTYPE)
+        return ids, self.gather(ids)
+
+    def nonzero_items(self):
+        # IDs and balances block by block (a checkpoint writes them without holding all of them)
+        for start, values, _ in self.blocks():
+            ids = np.flatnonzero(values)
+            yield ids + start, np.asarray(values[ids])
+
+    def dirty_items(self):
+        for start, values, dirty in self.blocks():
+            ids = np.flatnonzero(dirty)
+            yield ids + start, np.asarray(values[ids])
+
+    def clear_dirty(self):
+        for _, dirty in self.hot.values():
+            dirty[:] = False
+        # the file is emptied and extended again as a sparse file of zeros
+        self.disk_dirty = None
+        with open(os.path.join(self.path, STORE_DIRTY_FILE), 'r+b') as f:
+            f.truncate(0)
+            f.truncate(self.capacity)
+        self._map()
+
+    def restore(self, n, ids, values):
+        self.n = max(self.n, n)
+        self._reserve(self.n)
+        while self.hot:
+            self._evict(next(iter(self.hot)))
+        self.disk[ids] = values
+
+    def to_dict(self):
+        values = np.concatenate([values for _, values, _ in self.blocks()]).tolist()
+        return defaultdict(float, zip(self.book.load().keys, values))
+
+    def close(self):
+        # the working copy is removed, balances are saved by checkpoints
+        self.hot.clear()
+        self.disk = self.disk_dirty = None
+        for file_ in [STORE_VALUES_FILE, STORE_DIRTY_FILE]:
+            if os.path.isfile(os.path.join(self.path, file_)):
+                os.remove(os.path.join(self.path, file_))
+        if not os.listdir(self.path):
+            os.rmdir(self.path)
+
+
+class DiskValues:
+    # balances of DiskBalances indexed like an array by the incremental top-K
+
+    def __init__(self, balances):
+        self.balances = balances
+
+    def __getitem__(self, ids):
+        return self.balances.gather(ids)
+
+
+class DiskTopK(TopK):
+    # the full partial selection of the top-K is done block by block
+
+    def __init__(self, k, balances):
+        super().__init__(k)
+        self.balances = balances
+
+    def rebuild(self, values):
+        tracked = np.empty(0, dtype=np.int64)
+        tracked_values = np.empty(0)
+        count = 0
+        for ids, block_values in self.balances.nonzero_items():
+            count += ids.shape[0]
+            tracked = np.concatenate([tracked, ids])
+            tracked_values = np.concatenate([tracked_values, block_values])
+            if tracked.shape[0] > self.size:
+                keep = np.argpartition(tracked_values, tracked.shape[0] - self.size)\
+                        [tracked.shape[0] - self.size:]
+                tracked, tracked_values = tracked[keep], tracked_values[keep]
+        self.threshold = tracked_values.min() if count > self.size else -np.inf
+        self.tracked = tracked
+        self.rebuilds += 1
+
+
+def make_engine(engine, scale, balances=None, book=None, path=None, memory_budget=2**30, limbs=0):
+    # PATH and MEMORY_BUDGET (bytes) are used by the disk engine only, balances are exact with
+    # values of LIMBS limbs if LIMBS (see fixedpoint.py)
+    if engine == 'dict':
+        return DictBalances(scale, balances, book, limbs)
+    if engine == 'array':
+        return ArrayBalances(scale, balances, book, limbs)
+    if engine == 'disk':
+        if limbs:
+            raise ValueError('Exact balances are not supported by the disk engine!')
+        return DiskBalances(scale, balances, book, path, memory_budget)
+    raise ValueError('Unknown engine \"{}\"!'.format(engine))
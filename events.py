@@ -0,0 +1,172 @@
+# This module contains the event store written by split_csv.py (with --events): the rows of all
+# subfolders of a blockchain sorted by date, saved as raw binary arrays "events.ids" (dense
+# address IDs of the address book) and "events.val" (values), together with an index "days.idx"
+# of row offsets per day. Balances at any date are then the sum of a prefix of the events, so
+# calc_top_balances.py can take snapshots at any calendar by reading one contiguous range of rows
+# per period, without splitting the CSV files again. Values of partitions split with --exact are
+# rows of limbs (see fixedpoint.py).
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from fixedpoint import UNITS_DTYPE
+from partitions import DAYS_DTYPE, DAYS_EXT, IDS_DTYPE, VALUES_DTYPE, _memmap, list_weeks, \
+        read_bin_week, week_file
+
+
+EVENTS_DIR = 'events'
+EVENTS_FILE = 'events'
+DAYS_FILE = 'days.idx'
+META_FILE = 'events.json'
+
+
+def read_week_days(sub_dir, week):
+    return _memmap(week_file(sub_dir, 'bin', week, DAYS_EXT), DAYS_DTYPE)
+
+
+def kept_events(path, sub_dirs, first_week, limbs):
+    # (rows, {day: count}, rows before each week) of the events before week FIRST_WEEK in the store
+    # at PATH, or None if the store has to be built from all weeks (it is missing, was built with
+    # other limbs or its rows of these weeks do not match the partitions of SUB_DIRS)
+    if not first_week or not is_event_store(path):
+        return None
+    with open(os.path.join(path, META_FILE), 'r') as f:
+        meta = json.load(f)
+    week_rows = meta.get('week_rows', [])
+    if meta.get('limbs', 0) != limbs or first_week >= len(week_rows):
+        return None
+    rows = [sum(os.path.getsize(week_file(sd, 'bin', week, 'ids')) // IDS_DTYPE.itemsize
+        for sd in sub_dirs) for week in range(first_week)]
+    if np.diff(week_rows[:first_week + 1]).tolist() != rows:
+        return None
+    n_rows = week_rows[first_week]
+    val_size = UNITS_DTYPE.itemsize * limbs if limbs else VALUES_DTYPE.itemsize
+    if os.path.getsize(os.path.join(path, EVENTS_FILE + '.ids')) < n_rows * IDS_DTYPE.itemsize or \
+            os.path.getsize(os.path.join(path, EVENTS_FILE + '.val')) < n_rows * val_size:
+        return None
+    offsets = np.fromfile(os.path.join(path, DAYS_FILE), dtype=np.int64)
+    # weeks do not share days, so the events before FIRST_WEEK end at a day boundary
+    j = int(np.searchsorted(offsets, n_rows, side='right')) - 1
+    if j < 0 or offsets[j] != n_rows:
+        return None
+    day_counts = np.diff(offsets[:j + 1])
+    counts = {meta['first_day'] + k: int(c) for k, c in enumerate(day_counts.tolist()) if c}
+    return n_rows, counts, week_rows[:first_week + 1]
+
+
+def build_events(dir_, sub_dirs, verbose=False, limbs=0, first_week=0):
+    # merges weekly binary partitions (with days) of all subfolders to the event store in
+    # DIR_/events, returns the number of events. Weeks are already sorted relative to each other,
+    # so only the rows of one week have to be sorted at a time. Rows of the same day keep the order
+    # of subfolders and of rows in CSV files. Events of weeks before FIRST_WEEK are kept if the
+    # store has them, the files are truncated to the first event of FIRST_WEEK and the following
+    # weeks are appended
+    sub_dirs = [os.path.join(dir_, sd) for sd in sub_dirs]
+    path = os.path.join(dir_, EVENTS_DIR)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    kept = kept_events(path, sub_dirs, first_week, limbs)
+    if kept is None:
+        first_week, n_rows, counts, week_rows = 0, 0, {}, [0]
+    else:
+        n_rows, counts, week_rows = kept
+    val_size = UNITS_DTYPE.itemsize * limbs if limbs else VALUES_DTYPE.itemsize
+    mode = 'r+b' if kept is not None else 'wb'
+
+    weeks = [w for w in list_weeks(sub_dirs[0], 'bin') if w >= first_week]
+    with open(os.path.join(path, EVENTS_FILE + '.ids'), mode) as f_ids, \
+            open(os.path.join(path, EVENTS_FILE + '.val'), mode) as f_val:
+        f_ids.truncate(n_rows * IDS_DTYPE.itemsize)
+        f_val.truncate(n_rows * val_size)
+        f_ids.seek(0, os.SEEK_END)
+        f_val.seek(0, os.SEEK_END)
+        for i, week in enumerate(weeks):
+            if verbose:
+                print(' file {} out of {}'.format(i, len(weeks) - 1), end='\n')
+            parts = [read_bin_week(sd, week, limbs) for sd in sub_dirs]
+            days = np.concatenate([read_week_days(sd, week) for sd in sub_dirs])
+            order = np.argsort(days, kind='stable')
+            days = days[order]
+            np.concatenate([p[0] for p in parts])[order].tofile(f_ids)
+            np.concatenate([p[1] for p in parts])[order].tofile(f_val)
+            unique_days, day_counts = np.unique(days, return_counts=True)
+            for day, count in zip(unique_days.tolist(), day_counts.tolist()):
+                counts[day] = counts.get(day, 0) + count
+            n_rows += days.shape[0]
+            week_rows.append(n_rows)
+
+    # OFFSETS[j] is the number of events before day FIRST_DAY + j
+    first_day = min(counts) if counts else 0
+    last_day = max(counts) if counts else -1
+    day_counts = np.zeros(last_day - first_day + 1, dtype=np.int64)
+    for day, count in counts.items():
+        day_counts[day - first_day] = count
+    np.cumsum(np.r_[0, day_counts]).astype(np.int64).tofile(os.path.join(path, DAYS_FILE))
+    # WEEK_ROWS[k] is the number of events before week K
+    with open(os.path.join(path, META_FILE), 'w') as f:
+        json.dump({'first_day': first_day, 'last_day': last_day, 'rows': n_rows, 'limbs': limbs,
+            'week_rows': week_rows}, f)
+    return n_rows
+
+
+class EventStore:
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE), 'r') as f:
+            meta = json.load(f)
+        self.first_day = meta['first_day']
+        self.last_day = meta['last_day']
+        self.rows = meta['rows']
+        self.limbs = meta.get('limbs', 0)
+        self.offsets = np.fromfile(os.path.join(path, DAYS_FILE), dtype=np.int64)
+
+    def offset(self, day):
+        # number of events on or before DAY (days since epoch)
+        j = min(max(day - self.first_day + 1, 0), self.offsets.shape[0] - 1)
+        return int(self.offsets[j])
+
+    def read(self, day_from, day_to):
+        # zero-copy: events in (DAY_FROM, DAY_TO], DAY_FROM=None reads from the first event
+        lo = 0 if day_from is None else self.offset(day_from)
+        hi = self.offset(day_to)
+        if self.limbs:
+            dtype, shape = UNITS_DTYPE, (hi - lo, self.limbs)
+        else:
+            dtype, shape = VALUES_DTYPE, (hi - lo,)
+        if hi <= lo:
+            return np.empty(0, dtype=IDS_DTYPE), np.empty((0,) + shape[1:], dtype=dtype)
+        ids = np.memmap(os.path.join(self.path, EVENTS_FILE + '.ids'), dtype=IDS_DTYPE, mode='r',
+                offset=lo * IDS_DTYPE.itemsize, shape=(hi - lo,))
+        values = np.memmap(os.path.join(self.path, EVENTS_FILE + '.val'), dtype=dtype,
+                mode='r', offset=lo * dtype.itemsize * (self.limbs or 1), shape=shape)
+        return ids, values
+
+
+def is_event_store(path):
+    return os.path.isfile(os.path.join(path, META_FILE))
+
+
+# pandas frequencies of snapshot calendars
+CALENDARS = {'daily': pd.offsets.Day(), 'weekly': pd.offsets.Day(7),
+        'monthly': pd.offsets.MonthEnd()}
+
+
+def calendar_dates(calendar, start_date, end_date):
+    # snapshot dates of a calendar between START_DATE and END_DATE, monthly snapshots are taken at
+    # the ends of months
+    return pd.date_range(start_date, end_date, freq=CALENDARS[calendar]).to_numpy().\
+            astype('datetime64[D]')
+
+
+def parse_dates(dates):
+    # DATES is a comma-separated list of dates or a path to a file with one date per line
+    if os.path.isfile(dates):
+        with open(dates, 'r') as f:
+            dates = f.read().split()
+    else:
+        dates = dates.split(',')
+    return np.unique(np.array([d.strip() for d in dates if d.strip()], dtype='datetime64[D]'))
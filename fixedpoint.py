@@ -0,0 +1,107 @@
+# This module contains the exact representation of values used with --exact: values are kept as
+# integers in base units (satoshi or wei) instead of floats in coins, so balances are exact and a
+# balance that returns to zero is exactly zero. A value is a row of LIMBS int64 limbs, the value of
+# a row being the sum of limb[j] * LIMB**j. Satoshi-like chains take one limb (any balance fits in
+# int64), Ethereum-like chains three limbs (the last one counts whole ether). All limbs but the last
+# are kept in [0, LIMB), so a value has a single representation, and up to 2**63 / LIMB rows are
+# added up limb by limb with vectorized int64 additions before the carries are propagated. Values
+# are converted to coins only when balances are written out.
+
+import re
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+
+
+LIMB = 10**9
+UNITS_DTYPE = np.dtype(np.int64)
+# digits of a limb
+LIMB_DIGITS = 9
+
+
+def value_limbs(scale):
+    # number of limbs of values of a blockchain with SCALE base units per coin
+    return 1 + (len(str(scale)) - 1) // LIMB_DIGITS
+
+
+def normalize(units):
+    # propagates carries of UNITS (rows of limbs) in place, returns UNITS
+    for j in range(units.shape[1] - 1):
+        carry = units[:, j] // LIMB
+        units[:, j] -= carry * LIMB
+        units[:, j + 1] += carry
+    return units
+
+
+def from_ints(ints, limbs):
+    # rows of LIMBS limbs of python integers
+    if limbs == 1:
+        return np.array(ints, dtype=UNITS_DTYPE).reshape(-1, 1)
+    ints = np.array(ints, dtype=object)
+    units = np.empty((ints.shape[0], limbs), dtype=UNITS_DTYPE)
+    for j in range(limbs - 1):
+        units[:, j] = ints % LIMB
+        ints = ints // LIMB
+    units[:, -1] = ints
+    return units
+
+
+def to_ints(units):
+    # python integers of rows of limbs
+    units = np.asarray(units)
+    if units.shape[1] == 1:
+        return units[:, 0].tolist()
+    ints = units[:, -1].astype(object)
+    for j in range(units.shape[1] - 2, -1, -1):
+        ints = ints * LIMB + units[:, j].astype(object)
+    return ints.tolist()
+
+
+def parse_units(values, limbs):
+    # rows of LIMBS limbs of integer values given as strings (a pyarrow array or a sequence of
+    # strings), a fractional part must be zero (e.g. "-1500000000.0"), missing values are zero
+    if pa is None or not isinstance(values, (pa.Array, pa.ChunkedArray)):
+        return from_ints([int(re.sub(r'\.0*$', '', v)) if isinstance(v, str) and v else 0
+            for v in values], limbs)
+    values = pc.replace_substring_regex(values.fill_null('0'), pattern=r'\.0*$', replacement='')
+    if limbs == 1:
+        return values.cast(pa.int64()).to_numpy().reshape(-1, 1).astype(UNITS_DTYPE)
+    # digits of the magnitude padded with zeros, so that every limb is a slice of them
+    negative = pc.starts_with(values, pattern='-').to_numpy(zero_copy_only=False)
+    digits = pc.utf8_lpad(pc.utf8_ltrim(values, characters='-+'), width=limbs * LIMB_DIGITS,
+            padding='0')
+    units = np.empty((len(values), limbs), dtype=UNITS_DTYPE)
+    for j in range(limbs - 1):
+        units[:, j] = pc.utf8_slice_codeunits(digits, start=-LIMB_DIGITS * (j + 1),
+                stop=-LIMB_DIGITS * j or None).cast(pa.int64()).to_numpy()
+    units[:, -1] = pc.utf8_slice_codeunits(digits, start=0, stop=-LIMB_DIGITS * (limbs - 1)).\
+            cast(pa.int64()).to_numpy()
+    units[negative] *= -1
+    return normalize(units)
+
+
+def to_coins(units, scale):
+    # balances in coins (floats) of rows of limbs in base units, magnitudes are converted so that
+    # no digits cancel out
+    units = np.asarray(units)
+    negative = units[:, -1] < 0
+    magnitude = normalize(np.where(negative[:, None], -units, units))
+    coins = magnitude[:, 0].astype(float)
+    for j in range(1, units.shape[1]):
+        coins = coins / LIMB + magnitude[:, j]
+    coins /= scale / LIMB**(units.shape[1] - 1)
+    return np.where(negative, -coins, coins)
+
+
+def sum_by_id(ids, units):
+    # sorted distinct IDS and the sums of UNITS of their rows
+    order = np.argsort(ids)
+    ids = np.asarray(ids)[order]
+    if not ids.shape[0]:
+        return ids, np.empty((0, units.shape[1]), dtype=UNITS_DTYPE)
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    return ids[starts], normalize(np.add.reduceat(np.asarray(units)[order], starts, axis=0))
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3.9
+
+# This script can be used to calculate top account balances directly from CSV files downloaded from
+# GCS, without splitting them to weekly partitions first. The CSV files of every subfolder are
+# sorted by date (see the queries in folder "extract"), so they are streamed in one pass: all
+# subfolders are merged week by week, the rows of a week are applied to balances and the top
+# balances are taken when the week is over. No weekly partitions, pickles or checkpoints are
+# written, and the start date is derived like in split_csv.py
+
+import os
+import shutil
+import argparse
+import datetime
+import numpy as np
+from time import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from addresskeys import address_keys
+from engines import ENGINES, STORE_DIR, make_engine, value_scale
+from fixedpoint import value_limbs
+from partitions import AddressBook, list_sub_dirs
+from shards import WeekStream, derive_start_date, fetch_shard, first_date, fsspec, \
+        list_remote_shards, ordered_map, parse_shard, to_days
+from telemetry import Profiler, Telemetry
+from topstore import TopStore
+
+
+def main():
+    formatter = lambda prog: argparse.RawTextHelpFormatter(prog, max_help_position=50)
+    parser = argparse.ArgumentParser(
+            description='Calculates top account balances from CSV files (downloaded from GCS) in '
+                'one pass',
+            add_help=False,
+            formatter_class=formatter,
+            )
+
+    # required arguments
+    required_args = parser.add_argument_group('required arguments')
+    required_args.add_argument(
+            '--dir',
+            type=str,
+            required=True,
+            help='Path to parent directory with blockchain historical data',
+            )
+    required_args.add_argument(
+            '--name',
+            type=str,
+            required=True,
+            help='Name of blockchain (also the name of the folder with CSV files)',
+            )
+
+    # optimal arguments
+    optional_args = parser.add_argument_group('optional arguments')
+    optional_args.add_argument(
+            '-h',
+            '--help',
+            action='help',
+            help='show this help message and exit',
+            )
+    optional_args.add_argument(
+            '--top',
+            type=int,
+            default=10000,
+            help='How many top account balances to consider, defaults to 10000',
+            )
+    optional_args.add_argument(
+            '--start_date',
+            type=str,
+            default=None,
+            help='Start date to consider, defaults to None (derived from the first rows like in '
+                'split_csv.py)',
+            )
+    optional_args.add_argument(
+            '--end_date',
+            type=str,
+            default='2022-07-01',
+            help='End date to consider (its weekday is the last day of every week), defaults to '
+                '2022-07-01',
+            )
+    optional_args.add_argument(
+            '--drop_step',
+            type=int,
+            default=50,
+            help='Drop zero balances after each DROP_STEP-th week (reduces memory consumption), '
+                'defaults to 50',
+            )
+    optional_args.add_argument(
+            '--keep_address',
+            action='store_true',
+            default=False,
+            help='Keep address along with its values (not with the dict engine), defaults to False'
+            )
+    optional_args.add_argument(
+            '--engine',
+            type=str,
+            choices=ENGINES,
+            default='dict',
+            help='Engine used to accumulate balances (see calc_top_balances.py), defaults to dict',
+            )
+    optional_args.add_argument(
+            '--memory_budget',
+            type=int,
+            default=4096,
+            help='Memory in MB for balances held in memory by the disk engine (the rest is kept in '
+                'folder\n\"{}\"), defaults to 4096'.format(STORE_DIR),
+            )
+    optional_args.add_argument(
+            '--exact',
+            action='store_true',
+            default=False,
+            help='Accumulate exact integer balances in base units (see calc_top_balances.py, not '
+                'with the\ndisk engine), defaults to False',
+            )
+    optional_args.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of worker processes parsing CSV files ahead of the calculation, defaults '
+                'to 1',
+            )
+    optional_args.add_argument(
+            '--source',
+            type=str,
+            default=None,
+            help='URL of a folder with subfolders of CSV files to stream instead of local CSV files '
+                '(e.g.\n\"gs://blockchain_historical_data/bitcoin\", requires fsspec and a '
+                'filesystem driver such as\ngcsfs), defaults to None',
+            )
+    optional_args.add_argument(
+            '--prefetch',
+            type=int,
+            default=4,
+            help='Number of CSV files downloaded concurrently ahead of parsing (with --source), '
+                'defaults to 4',
+            )
+    optional_args.add_argument(
+            '--verbose',
+            action='store_true',
+            default=False,
+            help='Print detailed output to console, defaults to False'
+            )
+    optional_args.add_argument(
+            '--telemetry',
+            type=str,
+            default=None,
+            help='Append a JSON line per week with time per stage, rows/s, the number of addresses '
+                'and RSS\nto the given file, defaults to None (disabled)',
+            )
+    optional_args.add_argument(
+            '--profile',
+            type=str,
+            default=None,
+            help='Profile the main loop by cProfile and save statistics to the given file, '
+                'defaults to None',
+            )
+    args = parser.parse_args()
+    if args.keep_address and args.engine == 'dict':
+        parser.error('--keep_address requires --engine array or disk')
+    if args.exact and args.engine == 'disk':
+        parser.error('--exact requires --engine dict or array')
+    if args.source and fsspec is None:
+        parser.error('--source requires fsspec')
+
+    DIR = os.path.join(args.dir, args.name)
+    # paths of CSV files in every subfolder, on a remote filesystem FS if streamed
+    if args.source:
+        FS, SHARDS = list_remote_shards(args.source)
+        if not os.path.isdir(DIR):
+            os.makedirs(DIR)
+    else:
+        if not os.path.isdir(DIR):
+            raise FileNotFoundError('Directory \"{}\" does not exist!'.format(DIR))
+        FS = None
+        SHARDS = {sd: [os.path.join(DIR, sd, 'csv', f) for f in
+            sorted(os.listdir(os.path.join(DIR, sd, 'csv')))
+            if os.path.isfile(os.path.join(DIR, sd, 'csv', f))]
+            for sd in list_sub_dirs(DIR) if os.path.isdir(os.path.join(DIR, sd, 'csv'))}
+
+    SUB_DIRS = list(SHARDS)
+    if not SUB_DIRS:
+        raise FileNotFoundError('Directory \"{}\" contains no subfolders!'.format(
+            args.source or DIR))
+    for sd in SUB_DIRS:
+        if not SHARDS[sd]:
+            raise FileNotFoundError('Directory \"{}\" contains no CSV files!'.format(sd))
+
+    if args.start_date is None:
+        first_dates = []
+        for sd in SUB_DIRS:
+            with (FS.open(SHARDS[sd][0], 'rb') if FS else open(SHARDS[sd][0], 'rb')) as f:
+                first_dates.append(first_date(f))
+        START_DATE = derive_start_date(first_dates, args.end_date)
+        print('Derived start date \"{}\"'.format(START_DATE.strftime('%Y-%m-%d')))
+    else:
+        START_DATE = datetime.datetime.strptime(args.start_date, '%Y-%m-%d')
+    START_DAY = to_days(START_DATE)
+    DELTA = datetime.timedelta(weeks=1)
+
+    SCALE = value_scale(args.name)
+    # exact values are parsed to rows of LIMBS limbs (see fixedpoint.py)
+    LIMBS = value_limbs(SCALE) if args.exact else 0
+    BOOK = AddressBook()
+    balances = make_engine(args.engine, SCALE, book=BOOK, path=os.path.join(DIR, STORE_DIR),
+            memory_budget=args.memory_budget * 2**20, limbs=LIMBS)
+    if args.engine == 'dict':
+        # the dict engine is keyed by compact binary keys of addresses
+        encode = lambda uniques: np.asarray(address_keys(uniques), dtype=object)
+        update = lambda keys, values: balances.update_keys(keys.tolist(), values)
+    else:
+        encode = BOOK.unique_ids
+        update = balances.update_ids
+
+    # every subfolder is a stream of parsed CSV files, parsed by worker processes (and downloaded
+    # by threads) ahead of the calculation
+    pool = Pool(args.workers) if args.workers > 1 else None
+    fetch_pool = ThreadPool(args.prefetch) if FS is not None else None
+    streams = []
+    for sd in SUB_DIRS:
+        if FS is not None:
+            fetched = ordered_map(fetch_pool, fetch_shard, ((FS, p, None) for p in SHARDS[sd]),
+                    args.prefetch)
+            tasks = ((data, START_DAY, LIMBS) for data in fetched)
+        else:
+            tasks = ((p, START_DAY, LIMBS) for p in SHARDS[sd])
+        streams.append(WeekStream(ordered_map(pool, parse_shard, tasks, args.workers), encode))
+
+    fname = os.path.join(DIR, 'top{}_balances'.format(args.top) + \
+        '_addresses' * args.keep_address + '.csv')
+    # the store of weekly top balances is kept next to the CSV file exported from it, it is not
+    # resumed
+    if os.path.isdir(fname[:-len('.csv')]):
+        shutil.rmtree(fname[:-len('.csv')])
+    store = TopStore(fname[:-len('.csv')], args.top, keep_ids=args.keep_address)
+
+    TELEMETRY = Telemetry(args.telemetry, script='fused_top_balances', name=args.name,
+            engine=args.engine)
+    PROFILER = Profiler(args.profile)
+
+    print('Calculating top account balances from CSV files in {}...'.format(
+        ', '.join('\"{}\"'.format(sd) for sd in SUB_DIRS)))
+    start = time()
+    total_rows = 0
+    week = 0
+    PROFILER.start()
+    # weeks without rows in any subfolder get the top balances of the previous week
+    while any(s.next_week() is not None for s in streams):
+        if args.verbose:
+            print(' week {}'.format(week), end='\n')
+        rows = 0
+        # subfolders are applied one after another, like the weekly partitions by
+        # calc_top_balances.py
+        for s in streams:
+            for encoded, values in s.take(week):
+                TELEMETRY.lap('read')
+                update(encoded, values)
+                TELEMETRY.lap('update')
+                rows += values.shape[0]
+        total_rows += rows
+
+        if not (week % args.drop_step):
+            balances.drop_zeros()
+            TELEMETRY.lap('drop_zeros')
+        date = (START_DATE + DELTA * week).strftime('%Y-%m-%d')
+        if args.keep_address:
+            ids, sorted_d = balances.top_items(args.top)
+            TELEMETRY.lap('top')
+            store.append(date, sorted_d, ids)
+        else:
+            sorted_d = balances.top(args.top)
+            TELEMETRY.lap('top')
+            store.append(date, sorted_d)
+        TELEMETRY.lap('store')
+        TELEMETRY.record('week', rows, len(balances), week=week, date=date)
+        week += 1
+    PROFILER.stop()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if fetch_pool is not None:
+        fetch_pool.close()
+        fetch_pool.join()
+
+    print(' ' * 50, end='\n')
+    print('Calculating done! Saving data...')
+    store.close()
+    store.export_csv(fname, BOOK if args.keep_address else None)
+    TELEMETRY.record('done', addresses=len(balances), weeks=week, total_rows=total_rows,
+            start_date=START_DATE.strftime('%Y-%m-%d'), elapsed=time() - start)
+    balances.close()
+    TELEMETRY.close()
+    print('Elapsed time: {:.4f} s'.format(time() - start))
+    print('Throughput: {:.0f} rows/s'.format(total_rows / (time() - start)))
+    print('Data saved in {}'.format(fname))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3.9
+
+# This script can be used to generate a synthetic blockchain in the layout of CSV files extracted by
+# the queries in folder "extract" (columns "block_date", "address" and "value", sorted by date), so
+# that split_csv.py, calc_top_balances.py and metric.py can be benchmarked without the real data.
+# Addresses are reused with a Zipf distribution. Bitcoin-like chains get subfolders "inputs" and
+# "outputs" (every input spends an output of an earlier week), Ethereum-like chains get "from",
+# "to", "fees" and "rewards" with values in wei
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from time import time
+
+from shards import COLUMNS
+
+
+CHAINS = {
+        # subfolders with credited and debited values, median value and its log-normal spread
+        'btc': {'credits': 'outputs', 'debits': 'inputs', 'median': 10**7, 'sigma': 2.5},
+        'eth': {'credits': 'to', 'debits': 'from', 'median': 10**17, 'sigma': 3.,
+            'fees': 'fees', 'rewards': 'rewards', 'fee': 10**15, 'miners': 10},
+        }
+# fraction of credits of a week that are spent in the next week
+SPEND_RATE = 0.9
+
+
+class ShardWriter:
+    # writes rows of one subfolder to CSV files of at most ROWS_PER_FILE rows, named like the
+    # files exported from BigQuery
+
+    def __init__(self, sub_dir, name, rows_per_file, float_values=False):
+        self.path = os.path.join(sub_dir, 'csv')
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.name = name
+        self.rows_per_file = rows_per_file
+        self.float_format = '%.0f' if float_values else None
+        self.files = 0
+        self.rows = 0
+        self.rows_in_file = 0
+
+    def append(self, df):
+        while df.shape[0]:
+            if not self.rows_in_file:
+                self.files += 1
+            chunk = df.iloc[:self.rows_per_file - self.rows_in_file]
+            chunk.to_csv(os.path.join(self.path, '{}_{:012d}.csv'.format(self.name,
+                self.files - 1)), mode='a', header=not self.rows_in_file, index=False,
+                float_format=self.float_format)
+            self.rows_in_file = (self.rows_in_file + chunk.shape[0]) % self.rows_per_file
+            self.rows += chunk.shape[0]
+            df = df.iloc[chunk.shape[0]:]
+
+
+def address_strings(ids, chain):
+    # fixed-width hexadecimal addresses, IDs are scrambled so that frequent addresses are not
+    # sorted first. Every address is formatted once
+    uniques, inverse = np.unique(ids, return_inverse=True)
+    keys = (uniques.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)).tolist()
+    fmt = '0x{:040x}' if chain == 'eth' else '1{:033x}'
+    return np.asarray([fmt.format(k) for k in keys], dtype=object)[inverse]
+
+
+def frame(days, ids, values, chain):
+    # rows sorted by date (rows of the same day keep their order)
+    order = np.argsort(days, kind='stable')
+    return pd.DataFrame({
+        COLUMNS[0]: np.datetime_as_string(days[order], unit='D'),
+        COLUMNS[1]: address_strings(ids[order], chain),
+        COLUMNS[2]: values[order],
+        })
+
+
+def generate(dir_, name, chain='btc', weeks=52, rows_per_week=100000, addresses=10**6, zipf=1.2,
+        start_date='2014-01-01', rows_per_file=10**6, seed=0, verbose=False):
+    # writes the chain to DIR_/NAME, returns the number of rows
+    spec = CHAINS[chain]
+    rng = np.random.default_rng(seed)
+    path = os.path.join(dir_, name)
+    kinds = [k for k in ['credits', 'debits', 'fees', 'rewards'] if k in spec]
+    for k in kinds:
+        csv_dir = os.path.join(path, spec[k], 'csv')
+        if os.path.isdir(csv_dir) and os.listdir(csv_dir):
+            raise FileExistsError('Directory \"{}\" already contains CSV files!'.format(csv_dir))
+    writers = {k: ShardWriter(os.path.join(path, spec[k]), spec[k], rows_per_file,
+        float_values=chain == 'eth') for k in kinds}
+
+    start_day = np.datetime64(start_date, 'D')
+    # credits of the previous week that are not spent yet (IDs of addresses and values)
+    unspent_ids = np.empty(0, dtype=np.int64)
+    unspent_values = np.empty(0)
+    # spent credits take about SPEND_RATE of the rows of a week
+    n_credits = max(int(rows_per_week / (1 + SPEND_RATE)), 1)
+    for week in range(weeks):
+        if verbose:
+            print(' week {} out of {}'.format(week, weeks - 1), end='\n')
+        first_day = start_day + 7 * week
+
+        ids = (rng.zipf(zipf, n_credits) - 1) % addresses
+        values = np.maximum(np.round(rng.lognormal(np.log(spec['median']), spec['sigma'],
+            n_credits)), 1)
+        days = first_day + rng.integers(0, 7, n_credits)
+        writers['credits'].append(frame(days, ids, values if chain == 'eth' else
+            values.astype(np.int64), chain))
+
+        spent = rng.random(unspent_ids.shape[0]) < SPEND_RATE
+        spent_ids, spent_values = unspent_ids[spent], unspent_values[spent]
+        spent_days = first_day + rng.integers(0, 7, spent_ids.shape[0])
+        writers['debits'].append(frame(spent_days, spent_ids, -spent_values if chain == 'eth' else
+            -spent_values.astype(np.int64), chain))
+
+        if chain == 'eth':
+            # senders pay fees, which are collected by a few miners every day
+            fees = np.maximum(np.round(rng.lognormal(np.log(spec['fee']), 1.,
+                spent_ids.shape[0])), 1)
+            writers['fees'].append(frame(spent_days, spent_ids, -fees, chain))
+            miners = rng.integers(0, spec['miners'], spent_ids.shape[0])
+            keys = (spent_days - first_day).astype(np.int64) * spec['miners'] + miners
+            keys, inverse = np.unique(keys, return_inverse=True)
+            writers['rewards'].append(frame(first_day + keys // spec['miners'],
+                keys % spec['miners'], np.bincount(inverse, weights=fees), chain))
+
+        # outputs left unspent are kept by their holders
+        unspent_ids, unspent_values = ids, values
+    return sum(w.rows for w in writers.values())
+
+
+def main():
+    formatter = lambda prog: argparse.RawTextHelpFormatter(prog, max_help_position=50)
+    parser = argparse.ArgumentParser(
+            description='Generates CSV files of a synthetic blockchain',
+            add_help=False,
+            formatter_class=formatter,
+            )
+
+    # required arguments
+    required_args = parser.add_argument_group('required arguments')
+    required_args.add_argument(
+            '--dir',
+            type=str,
+            required=True,
+            help='Path to parent directory with blockchain historical data',
+            )
+    required_args.add_argument(
+            '--name',
+            type=str,
+            required=True,
+            help='Name of blockchain (also the name of the folder with CSV files)',
+            )
+
+    # optimal arguments
+    optional_args = parser.add_argument_group('optional arguments')
+    optional_args.add_argument(
+            '-h',
+            '--help',
+            action='help',
+            help='show this help message and exit',
+            )
+    optional_args.add_argument(
+            '--chain',
+            type=str,
+            choices=list(CHAINS),
+            default=None,
+            help='Layout and value scale of the blockchain (calc_top_balances.py converts values '
+                'from wei\nonly if NAME starts with \"eth\"), defaults to eth if NAME starts with '
+                '\"eth\", otherwise\nto btc',
+            )
+    optional_args.add_argument(
+            '--weeks',
+            type=int,
+            default=52,
+            help='Number of weeks, defaults to 52',
+            )
+    optional_args.add_argument(
+            '--rows_per_week',
+            type=int,
+            default=100000,
+            help='Number of credits and debits per week, defaults to 100000',
+            )
+    optional_args.add_argument(
+            '--addresses',
+            type=int,
+            default=1000000,
+            help='Number of distinct addresses, defaults to 1000000',
+            )
+    optional_args.add_argument(
+            '--zipf',
+            type=float,
+            default=1.2,
+            help='Exponent of the Zipf distribution of address reuse (greater than 1, smaller '
+                'values give\nmore distinct addresses), defaults to 1.2',
+            )
+    optional_args.add_argument(
+            '--start_date',
+            type=str,
+            default='2014-01-01',
+            help='Date of the first rows, defaults to 2014-01-01',
+            )
+    optional_args.add_argument(
+            '--rows_per_file',
+            type=int,
+            default=1000000,
+            help='Maximum number of rows in a CSV file, defaults to 1000000',
+            )
+    optional_args.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Seed of the random generator, defaults to 0',
+            )
+    optional_args.add_argument(
+            '--verbose',
+            action='store_true',
+            default=False,
+            help='Print detailed output to console, defaults to False'
+            )
+    args = parser.parse_args()
+    if args.zipf <= 1:
+        parser.error('--zipf must be greater than 1')
+
+    chain = args.chain or ('eth' if args.name.lower().startswith('eth') else 'btc')
+    print('Generating {} weeks of \"{}\" ({}-like)...'.format(args.weeks, args.name, chain))
+    start = time()
+    rows = generate(args.dir, args.name, chain, args.weeks, args.rows_per_week, args.addresses,
+            args.zipf, args.start_date, args.rows_per_file, args.seed, args.verbose)
+
+    print(' ' * 50, end='\n')
+    print('Generating done!')
+    print('Generated {} rows in \"{}\"'.format(rows, os.path.join(args.dir, args.name)))
+    print('Elapsed time: {:.4f} s'.format(time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+# This module contains the index of balance histories written by calc_top_balances.py (with
+# --history), which answers what the balance of an address was at any date without calculating the
+# balances again. During the calculation, the balances changed in every week are appended to a log
+# ("log.ids", "log.val" and the number of changes per week in "log.idx"). At the end, the log is
+# sorted by address with a counting sort into change points: "points.week" (weeks of changes) and
+# "points.val" (balances after them) hold the change points of every address in the order of weeks,
+# and "points.idx" the offsets of the change points of every address ID. Addresses are found by
+# their 64-bit hashes sorted in "addresses.hash" (with the IDs in "addresses.ids"). All files are
+# raw binary arrays read with np.memmap, so a query reads only a few pages of them.
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from itertools import islice
+
+from partitions import ADDRESSES_FILE, IDS_DTYPE, OFFSETS_FILE, VALUES_DTYPE, AddressBook, _memmap
+
+
+HISTORY_DIR = 'history'
+LOG_FILE = 'log'
+DATES_FILE = 'dates.txt'
+POINTS_FILE = 'points'
+HASHES_FILE = 'addresses'
+META_FILE = 'history.json'
+WEEKS_DTYPE = np.dtype(np.int32)
+HASH_DTYPE = np.dtype(np.uint64)
+# number of log entries (or addresses) processed at once when the index is built
+BUILD_ROWS = 2**24
+
+
+def hash_addresses(addresses):
+    return pd.util.hash_array(np.asarray(addresses, dtype=object)).astype(HASH_DTYPE)
+
+
+class HistoryWriter:
+    # appends the balances changed in every week to the log, which is truncated to WEEKS weeks
+    # first (e.g. weeks of saved balances when resuming)
+
+    def __init__(self, path, weeks=0):
+        self.path = path
+        counts = np.fromfile(self._file('.idx'), dtype=np.int64) \
+                if os.path.isfile(self._file('.idx')) else np.zeros(1, dtype=np.int64)
+        if counts.shape[0] - 1 < weeks:
+            raise ValueError('History in \"{}\" has fewer weeks than saved balances, calculate all '
+                'weeks again!'.format(path))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.counts = counts[:weeks + 1].tolist()
+        for ext, itemsize in [('.ids', IDS_DTYPE.itemsize), ('.val', VALUES_DTYPE.itemsize),
+                ('.idx', 8)]:
+            with open(self._file(ext), 'ab') as f:
+                f.truncate((self.counts[-1] if ext != '.idx' else len(self.counts)) * itemsize)
+        dates = []
+        if os.path.isfile(os.path.join(path, DATES_FILE)):
+            with open(os.path.join(path, DATES_FILE), 'r') as f:
+                dates = f.read().split()[:weeks]
+        with open(os.path.join(path, DATES_FILE), 'w') as f:
+            f.write(''.join(d + '\n' for d in dates))
+        self.files = [open(self._file(ext), 'ab') for ext in ['.ids', '.val', '.idx']] + \
+                [open(os.path.join(path, DATES_FILE), 'a')]
+
+    def _file(self, ext):
+        return os.path.join(self.path, LOG_FILE + ext)
+
+    def append(self, date, ids, values):
+        # IDS (unique) and balances of addresses changed in the week of DATE
+        f_ids, f_val, f_idx, f_dates = self.files
+        np.asarray(ids, dtype=IDS_DTYPE).tofile(f_ids)
+        np.asarray(values, dtype=VALUES_DTYPE).tofile(f_val)
+        self.counts.append(self.counts[-1] + len(ids))
+        np.array(self.counts[-1:], dtype=np.int64).tofile(f_idx)
+        f_dates.write(date + '\n')
+
+    def flush(self):
+        for f in self.files:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        self.flush()
+        for f in self.files:
+            f.close()
+        self.files = []
+
+
+def build_history(path, book_path, verbose=False, period_days=0):
+    # sorts the log in PATH to change points of every address and indexes the hashes of addresses
+    # of the address book in BOOK_PATH, returns the number of change points. PERIOD_DAYS is the
+    # number of days from the date of a week to the last day of its rows (7 for weekly partitions,
+    # whose dates are the starts of weeks, 0 for calendars, whose dates are the ends of periods)
+    counts = np.fromfile(os.path.join(path, LOG_FILE + '.idx'), dtype=np.int64)
+    with open(os.path.join(path, DATES_FILE), 'r') as f:
+        dates = f.read().split()
+    n_points = int(counts[-1])
+    n_addresses = len(AddressBook(book_path))
+    log_ids = _memmap(os.path.join(path, LOG_FILE + '.ids'), IDS_DTYPE)[:n_points]
+    log_values = _memmap(os.path.join(path, LOG_FILE + '.val'), VALUES_DTYPE)[:n_points]
+
+    # offsets of change points of every address, then every chunk of the log is scattered to the
+    # change points (the log is in the order of weeks, so change points of an address are too)
+    points = np.zeros(n_addresses, dtype=np.int64)
+    for lo in range(0, n_points, BUILD_ROWS):
+        points += np.bincount(log_ids[lo:lo + BUILD_ROWS], minlength=n_addresses)
+    offsets = np.r_[0, np.cumsum(points)].astype(np.int64)
+    offsets.tofile(os.path.join(path, POINTS_FILE + '.idx'))
+    del points
+
+    point_files = [os.path.join(path, POINTS_FILE + ext) for ext in ['.week', '.val']]
+    for fname, dtype in zip(point_files, [WEEKS_DTYPE, VALUES_DTYPE]):
+        with open(fname, 'wb') as f:
+            f.truncate(n_points * dtype.itemsize)
+    if n_points:
+        weeks = np.memmap(point_files[0], dtype=WEEKS_DTYPE, mode='r+')
+        values = np.memmap(point_files[1], dtype=VALUES_DTYPE, mode='r+')
+        cursor = offsets[:-1].copy()
+        for lo in range(0, n_points, BUILD_ROWS):
+            if verbose:
+                print(' change points {} out of {}'.format(lo, n_points), end='\n')
+            ids = np.asarray(log_ids[lo:lo + BUILD_ROWS])
+            order = np.argsort(ids, kind='stable')
+            ids = ids[order]
+            uniques, starts, n = np.unique(ids, return_index=True, return_counts=True)
+            positions = cursor[ids] + np.arange(ids.shape[0]) - np.repeat(starts, n)
+            weeks[positions] = np.searchsorted(counts, lo + order, side='right') - 1
+            values[positions] = log_values[lo:lo + BUILD_ROWS][order]
+            cursor[uniques] += n
+        weeks.flush()
+        values.flush()
+        del weeks, values
+
+    _index_hashes(path, book_path, n_addresses)
+    with open(os.path.join(path, META_FILE), 'w') as f:
+        json.dump({'weeks': len(dates), 'addresses': n_addresses, 'points': n_points,
+            'book': os.path.relpath(book_path, path), 'dates': dates, 'period_days': period_days},
+            f)
+    return n_points
+
+
+def _index_hashes(path, book_path, n_addresses):
+    # hashes of addresses sorted with their IDs, only addresses added to the book since the index
+    # was built last time are hashed and merged
+    hashes_file = os.path.join(path, HASHES_FILE + '.hash')
+    ids_file = os.path.join(path, HASHES_FILE + '.ids')
+    n_hashed = 0
+    if os.path.isfile(os.path.join(path, META_FILE)) and os.path.isfile(hashes_file):
+        with open(os.path.join(path, META_FILE), 'r') as f:
+            n_hashed = json.load(f)['addresses']
+    if n_hashed and os.path.getsize(hashes_file) != n_hashed * HASH_DTYPE.itemsize:
+        n_hashed = 0
+    old_hashes = np.fromfile(hashes_file, dtype=HASH_DTYPE) if n_hashed else \
+            np.empty(0, dtype=HASH_DTYPE)
+    old_ids = np.fromfile(ids_file, dtype=IDS_DTYPE) if n_hashed else np.empty(0, dtype=IDS_DTYPE)
+    if n_hashed > n_addresses:
+        # the address book was truncated
+        old_hashes, old_ids = old_hashes[old_ids < n_addresses], old_ids[old_ids < n_addresses]
+        n_hashed = n_addresses
+
+    new_hashes = []
+    offsets = _memmap(os.path.join(book_path, OFFSETS_FILE), np.int64)
+    with open(os.path.join(book_path, ADDRESSES_FILE), 'rb') as f:
+        if n_hashed:
+            f.seek(int(offsets[n_hashed]))
+        for lo in range(n_hashed, n_addresses, BUILD_ROWS):
+            batch = [line[:-1].decode() for line in islice(f, min(BUILD_ROWS, n_addresses - lo))]
+            new_hashes.append(hash_addresses(batch))
+    new_hashes = np.concatenate(new_hashes + [np.empty(0, dtype=HASH_DTYPE)])
+    new_ids = np.arange(n_hashed, n_addresses, dtype=IDS_DTYPE)
+    order = np.argsort(new_hashes, kind='stable')
+    new_hashes, new_ids = new_hashes[order], new_ids[order]
+
+    # new hashes are inserted after equal old hashes
+    positions = np.searchsorted(old_hashes, new_hashes, side='right') + \
+            np.arange(new_hashes.shape[0])
+    is_new = np.zeros(old_hashes.shape[0] + new_hashes.shape[0], dtype=bool)
+    is_new[positions] = True
+    for fname, old, new in [(hashes_file, old_hashes, new_hashes), (ids_file, old_ids, new_ids)]:
+        merged = np.empty(is_new.shape[0], dtype=old.dtype)
+        merged[is_new] = new
+        merged[~is_new] = old
+        merged.tofile(fname + '.tmp')
+        os.replace(fname + '.tmp', fname)
+
+
+def is_history(path):
+    return os.path.isfile(os.path.join(path, META_FILE))
+
+
+class BalanceHistory:
+    # queries of the index of balance histories in PATH
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE), 'r') as f:
+            meta = json.load(f)
+        self.dates = np.array(meta['dates'], dtype='datetime64[D]')
+        # the last day of rows of every week
+        self.ends = self.dates + np.timedelta64(meta['period_days'], 'D')
+        self.n_addresses = meta['addresses']
+        self.book = AddressBook(os.path.normpath(os.path.join(path, meta['book'])))
+        self.offsets = _memmap(os.path.join(path, POINTS_FILE + '.idx'), np.int64)
+        self.weeks = _memmap(os.path.join(path, POINTS_FILE + '.week'), WEEKS_DTYPE)
+        self.values = _memmap(os.path.join(path, POINTS_FILE + '.val'), VALUES_DTYPE)
+        self.hashes = _memmap(os.path.join(path, HASHES_FILE + '.hash'), HASH_DTYPE)
+        self.hash_ids = _memmap(os.path.join(path, HASHES_FILE + '.ids'), IDS_DTYPE)
+
+    def __len__(self):
+        return self.n_addresses
+
+    def ids(self, addresses):
+        # IDs of ADDRESSES (-1 for addresses that are not in the index), addresses with the same
+        # hash are told apart by the address book
+        hashes = hash_addresses(addresses)
+        lo = np.searchsorted(self.hashes, hashes, side='left')
+        hi = np.searchsorted(self.hashes, hashes, side='right')
+        ids = np.full(len(addresses), -1, dtype=IDS_DTYPE)
+        for j, address in enumerate(addresses):
+            candidates = self.hash_ids[lo[j]:hi[j]]
+            for i, found in zip(candidates.tolist(), self.book.lookup(candidates)):
+                if found == address:
+                    ids[j] = i
+        return ids
+
+    def changes(self, i):
+        # last days of weeks in which the balance of address ID I changed, and the balances after
+        # them
+        if i < 0 or i >= self.n_addresses:
+            return self.ends[:0], np.empty(0)
+        lo, hi = int(self.offsets[i]), int(self.offsets[i + 1])
+        return self.ends[np.asarray(self.weeks[lo:hi])], np.asarray(self.values[lo:hi])
+
+    def balances(self, ids, dates):
+        # (len(DATES), len(IDS)) balances at the end of DATES, i.e. at the end of the last week
+        # whose rows end on or before a date (rows of later days of the week of a date are not
+        # included)
+        weeks = np.searchsorted(self.ends, np.asarray(dates, dtype='datetime64[D]'),
+                side='right') - 1
+        out = np.zeros((weeks.shape[0], len(ids)))
+        for j, i in enumerate(np.asarray(ids).tolist()):
+            if i < 0 or i >= self.n_addresses:
+                continue
+            lo, hi = int(self.offsets[i]), int(self.offsets[i + 1])
+            points = np.searchsorted(self.weeks[lo:hi], weeks, side='right') - 1
+            valid = points >= 0
+            out[valid, j] = self.values[lo:hi][points[valid]]
+        return out
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3.9
+
+# This script can be used to run the queries in folder "extract" on local Parquet exports of the raw
+# BigQuery tables with DuckDB (see localsql.py), instead of querying BigQuery and downloading CSV
+# files from GCS. The rows are either saved to CSV files in the layout of the files on GCS, or
+# aggregated by DuckDB to one value per address and week and saved directly as weekly partitions
+# for calc_top_balances.py (no CSV files and no split_csv.py)
+
+import os
+import glob
+import shutil
+import argparse
+import datetime
+import pandas as pd
+from time import time
+
+from engines import value_scale
+from events import EVENTS_DIR
+from fixedpoint import value_limbs
+from localsql import connect, declared_final_date, duckdb, export_csv, first_date, pa, \
+        query_files, tables_of, translate, weekly_rows, write_fixtures
+from partitions import FORMATS, NET_DIR, AddressBook, WeekWriter, write_split_manifest
+from shards import derive_start_date
+
+
+def main():
+    formatter = lambda prog: argparse.RawTextHelpFormatter(prog, max_help_position=50)
+    parser = argparse.ArgumentParser(
+            description='Runs the queries in folder \"extract\" on local Parquet tables with DuckDB',
+            add_help=False,
+            formatter_class=formatter,
+            )
+
+    # required arguments
+    required_args = parser.add_argument_group('required arguments')
+    required_args.add_argument(
+            '--dir',
+            type=str,
+            required=True,
+            help='Path to parent directory with blockchain historical data',
+            )
+    required_args.add_argument(
+            '--name',
+            type=str,
+            required=True,
+            help='Name of blockchain (the queries \"extract/*/NAME_*.sql\" are run)',
+            )
+    required_args.add_argument(
+            '--tables',
+            type=str,
+            required=True,
+            help='Path to Parquet exports of the raw tables (table `project.dataset.table` is read '
+                'from\n\"TABLES/dataset/table/*.parquet\")',
+            )
+
+    # optimal arguments
+    optional_args = parser.add_argument_group('optional arguments')
+    optional_args.add_argument(
+            '-h',
+            '--help',
+            action='help',
+            help='show this help message and exit',
+            )
+    optional_args.add_argument(
+            '--csv',
+            action='store_true',
+            default=False,
+            help='Save rows to CSV files (for split_csv.py) instead of weekly partitions, defaults '
+                'to False',
+            )
+    optional_args.add_argument(
+            '--format',
+            type=str,
+            choices=FORMATS,
+            default='bin',
+            help='Format of weekly partitions (see split_csv.py), defaults to bin',
+            )
+    optional_args.add_argument(
+            '--exact',
+            action='store_true',
+            default=False,
+            help='Save values of weekly partitions as exact integers in base units (see '
+                'split_csv.py), defaults\nto False',
+            )
+    optional_args.add_argument(
+            '--final_date',
+            type=str,
+            default=None,
+            help='Skip rows on or after this date, defaults to None (FINAL_DATE of the queries)',
+            )
+    optional_args.add_argument(
+            '--start_date',
+            type=str,
+            default=None,
+            help='Start date of weekly partitions, defaults to None (derived from the first rows '
+                'like in\nsplit_csv.py)',
+            )
+    optional_args.add_argument(
+            '--end_date',
+            type=str,
+            default='2022-07-01',
+            help='End date to consider (its weekday is the last day of every week), defaults to '
+                '2022-07-01',
+            )
+    optional_args.add_argument(
+            '--threads',
+            type=int,
+            default=None,
+            help='Number of threads of DuckDB, defaults to None (the number of CPUs)',
+            )
+    optional_args.add_argument(
+            '--memory_limit',
+            type=int,
+            default=None,
+            help='Memory in MB used by DuckDB (larger aggregations spill to disk), defaults to None '
+                '(80%% of\nphysical memory)',
+            )
+    optional_args.add_argument(
+            '--fixtures',
+            action='store_true',
+            default=False,
+            help='Write small random raw tables to TABLES first (for offline checks of the '
+                'queries),\ndefaults to False',
+            )
+    optional_args.add_argument(
+            '--show_sql',
+            action='store_true',
+            default=False,
+            help='Print the queries translated to DuckDB SQL, defaults to False',
+            )
+    optional_args.add_argument(
+            '--verbose',
+            action='store_true',
+            default=False,
+            help='Print detailed output to console, defaults to False'
+            )
+    args = parser.parse_args()
+    if duckdb is None or pa is None:
+        parser.error('this script requires duckdb and pyarrow')
+    if args.exact and (args.csv or args.format != 'bin'):
+        parser.error('--exact requires weekly partitions in --format bin')
+
+    QUERIES = query_files(args.name)
+    if not QUERIES:
+        raise FileNotFoundError('Folder \"extract\" contains no queries of \"{}\"!'.format(
+            args.name))
+    SQL = {}
+    for sd, fname in QUERIES.items():
+        with open(fname, 'r') as f:
+            SQL[sd] = f.read()
+    FINAL_DATE = args.final_date or declared_final_date(next(iter(SQL.values())))
+    if args.fixtures:
+        for path in write_fixtures(args.tables, QUERIES.values(), FINAL_DATE):
+            print('Fixture table saved in {}'.format(path))
+    for sd in SQL:
+        for dataset, table in tables_of(SQL[sd]):
+            if not glob.glob(os.path.join(args.tables, dataset, table, '*.parquet')):
+                raise FileNotFoundError('Directory \"{}\" contains no Parquet files!'.format(
+                    os.path.join(args.tables, dataset, table)))
+
+    DIR = os.path.join(args.dir, args.name)
+    if not os.path.isdir(DIR):
+        os.makedirs(DIR)
+    con = connect(args.threads, args.memory_limit)
+    queries = {sd: translate(SQL[sd], args.tables, FINAL_DATE) for sd in SQL}
+    if args.show_sql:
+        for sd, query in queries.items():
+            print('-- {}\n{}\n'.format(sd, query))
+
+    start = time()
+    total_rows = 0
+    if args.csv:
+        for sd, query in queries.items():
+            csv_dir = os.path.join(DIR, sd, 'csv')
+            if os.path.isdir(csv_dir):
+                shutil.rmtree(csv_dir)
+            os.makedirs(csv_dir)
+            print('Extracting data to \"{}\"...'.format(csv_dir))
+            rows = export_csv(con, query, os.path.join(csv_dir, '{}_{:012d}.csv'.format(sd, 0)))
+            if args.verbose:
+                print(' {} rows'.format(rows))
+            total_rows += rows
+    else:
+        if args.start_date is None:
+            START_DATE = derive_start_date([pd.Timestamp(first_date(con, q)) for q in
+                queries.values()], args.end_date)
+        else:
+            START_DATE = datetime.datetime.strptime(args.start_date, '%Y-%m-%d')
+        START_DATE = START_DATE.strftime('%Y-%m-%d')
+        print('Use \"{}\" as start_date for calc_top_balances.py'.format(START_DATE))
+
+        # partitions, the address book and anything built from them are written again
+        book = AddressBook(DIR)
+        if args.format == 'bin':
+            book.clear()
+        for d in [NET_DIR, EVENTS_DIR] + [os.path.join(sd, fmt) for sd in queries
+                for fmt in FORMATS]:
+            if os.path.isdir(os.path.join(DIR, d)):
+                shutil.rmtree(os.path.join(DIR, d))
+
+        LIMBS = value_limbs(value_scale(args.name)) if args.exact else 0
+        writers = []
+        n_weeks = 0
+        for sd, query in queries.items():
+            print('Extracting weekly data to \"{}\"...'.format(os.path.join(DIR, sd)))
+            writer = WeekWriter(os.path.join(DIR, sd), args.format, book, limbs=LIMBS)
+            for weeks, codes, uniques, values in weekly_rows(con, query, START_DATE,
+                    limbs=LIMBS):
+                if args.verbose:
+                    print(' week {}'.format(weeks[-1]), end='\n')
+                writer.append(weeks, codes, uniques, values)
+            writers.append(writer)
+            n_weeks = max(n_weeks, writer.close())
+            total_rows += writer.rows
+            book.save()
+        for writer in writers:
+            writer.fill(n_weeks)
+
+        last_weeks = {sd: w.last_week for sd, w in zip(queries, writers)}
+        write_split_manifest(DIR, {
+            'format': args.format,
+            'start_date': START_DATE,
+            'days': False,
+            'limbs': LIMBS,
+            'weeks': n_weeks,
+            'rows': total_rows,
+            'files': {},
+            'first_new_week': 0,
+            'last_weeks': last_weeks,
+            'open_week': min(last_weeks.values()),
+            'tables': os.path.abspath(args.tables),
+            })
+    con.close()
+
+    print(' ' * 50, end='\n')
+    print('Extracting done!')
+    print('Saved {} rows{}'.format(total_rows, '' if args.csv else
+        ' (one per address and week)'))
+    print('Elapsed time: {:.4f} s'.format(time() - start))
+
+
+if __name__ == '__main__':
+    main()
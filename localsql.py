@@ -0,0 +1,249 @@
+# This module runs the queries in folder "extract" on local Parquet exports of the raw BigQuery
+# tables with DuckDB, an embedded analytical engine, instead of BigQuery. The queries are not
+# rewritten by hand: the BigQuery SQL is translated to DuckDB SQL (scripting statements, string
+# literals, FORMAT_DATE, DATE and NUMERIC), so a change of the filters in a query takes effect
+# locally as well. A table `project.dataset.table` is read from the Parquet files in
+# "{TABLES}/dataset/table/" (e.g. exported by EXPORT DATA with FORMAT = 'PARQUET'). The weekly
+# per-address aggregation can also be done by DuckDB, so that only one row per address and week
+# leaves the engine.
+
+import os
+import re
+import glob
+import numpy as np
+
+from fixedpoint import parse_units
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+EXTRACT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extract')
+TABLE_RE = re.compile(r'`([^`.]+)\.([^`.]+)\.([^`.]+)`')
+FINAL_DATE_RE = re.compile(r'SET\s+FINAL_DATE\s*=\s*DATE\(\s*["\'](\d{4}-\d{2}-\d{2})["\']\s*\)',
+        re.IGNORECASE)
+
+
+def query_files(name):
+    # paths of the queries of blockchain NAME by subfolder ("{NAME}_{subfolder}.sql")
+    files = {}
+    for fname in sorted(glob.glob(os.path.join(EXTRACT_DIR, '*', name + '_*.sql'))):
+        sub_dir = os.path.basename(fname)[len(name) + 1:-len('.sql')]
+        # e.g. "bitcoin_cash_inputs.sql" is not a query of "bitcoin"
+        if '_' not in sub_dir:
+            files[sub_dir] = fname
+    return files
+
+
+def _calls(sql, name, replace):
+    # replaces every call NAME(args) in SQL by REPLACE(args), arguments are split at top-level
+    # commas (calls in arguments are replaced first)
+    pattern = re.compile(r'\b{}\s*\('.format(name), re.IGNORECASE)
+    out = []
+    pos = 0
+    while True:
+        match = pattern.search(sql, pos)
+        if match is None:
+            return ''.join(out) + sql[pos:]
+        depth, args, start = 1, [], match.end()
+        i = start
+        quote = None
+        while depth:
+            c = sql[i]
+            if quote:
+                quote = None if c == quote else quote
+            elif c in '\'"':
+                quote = c
+            elif c == '(':
+                depth += 1
+            elif c == ')':
+                depth -= 1
+            elif c == ',' and depth == 1:
+                args.append(sql[start:i])
+                start = i + 1
+            i += 1
+        args.append(sql[start:i - 1])
+        out.append(sql[pos:match.start()])
+        out.append(replace([_calls(a, name, replace).strip() for a in args]))
+        pos = i
+
+
+def declared_final_date(sql):
+    # FINAL_DATE set by a BigQuery query (None if it is not set)
+    declared = FINAL_DATE_RE.search(sql)
+    return declared.group(1) if declared else None
+
+
+def translate(sql, tables, final_date=None):
+    # DuckDB SQL of a BigQuery query of folder "extract" reading tables from folder TABLES, rows
+    # on or after FINAL_DATE (defaults to FINAL_DATE of the query) are skipped. The columns are
+    # renamed to the ones of CSV files on GCS ("block_date", "address" and "value")
+    final_date = final_date or declared_final_date(sql)
+    lines = []
+    for line in sql.splitlines():
+        line = line.split('--', 1)[0].rstrip()
+        if not line.strip() or line.lstrip().startswith('#') or \
+                re.match(r'\s*(DECLARE|SET)\b', line, re.IGNORECASE):
+            continue
+        lines.append(line)
+    sql = '\n'.join(lines).rstrip().rstrip(';')
+
+    # BigQuery strings may be double-quoted, DuckDB takes them for identifiers
+    sql = re.sub(r'"([^"]*)"', r"'\1'", sql)
+    sql = TABLE_RE.sub(lambda m: "read_parquet('{}')".format(
+        os.path.join(tables, m.group(2), m.group(3), '*.parquet')), sql)
+    sql = _calls(sql, 'FORMAT_DATE', lambda a: 'strftime(CAST({} AS DATE), {})'.format(a[1], a[0]))
+    sql = _calls(sql, 'DATE', lambda a: 'CAST({} AS DATE)'.format(a[0]))
+    # NUMERIC values of BigQuery are integers here (satoshi or wei), HUGEINT has 38 digits as well
+    sql = re.sub(r'\bAS\s+NUMERIC\b', 'AS HUGEINT', sql, flags=re.IGNORECASE)
+    if final_date is not None:
+        sql = re.sub(r'\bFINAL_DATE\b', "DATE '{}'".format(final_date), sql)
+    return 'SELECT date AS block_date, address, CAST(value AS HUGEINT) AS value FROM (\n{}\n)'.\
+            format(sql)
+
+
+def tables_of(sql):
+    # (dataset, table) of every table read by a BigQuery query
+    return sorted({(m.group(2), m.group(3)) for m in TABLE_RE.finditer(sql)})
+
+
+def connect(threads=None, memory_limit=None):
+    con = duckdb.connect()
+    # dates of rows are taken in UTC like in BigQuery
+    con.execute("SET TimeZone = 'UTC'")
+    if threads:
+        con.execute('SET threads = {:d}'.format(threads))
+    if memory_limit:
+        con.execute("SET memory_limit = '{:d}MB'".format(memory_limit))
+    return con
+
+
+def first_date(con, query):
+    # the first date of rows of QUERY after 1970-01-01 (see derive_start_date in shards.py)
+    row = con.execute("SELECT MIN(block_date) FROM ({}) WHERE block_date > '1970-01-01'".format(
+        query)).fetchone()
+    return row[0]
+
+
+def export_csv(con, query, fname):
+    # rows of QUERY sorted by date to a CSV file in the layout of files exported from BigQuery,
+    # returns the number of rows
+    return con.execute("COPY ({} ORDER BY block_date) TO '{}' (HEADER, DELIMITER ',')".format(
+        query, fname)).fetchone()[0]
+
+
+def weekly_rows(con, query, start_date, batch=2**20, limbs=0):
+    # yields rows of QUERY aggregated to one value per address and week (weeks as in
+    # week_index of shards.py, zero sums are dropped) sorted by week: arrays of weeks, codes of
+    # addresses, unique addresses and values (rows of LIMBS limbs if LIMBS), BATCH rows at a time
+    result = con.execute('''
+        SELECT GREATEST(CAST(FLOOR((block_date::DATE - DATE '{}' - 1) / 7) AS BIGINT), 0) AS week,
+            address,
+            CAST(SUM(value) AS {}) AS value
+        FROM ({})
+        GROUP BY week, address
+        HAVING SUM(value) <> 0
+        ORDER BY week, address'''.format(start_date, 'VARCHAR' if limbs else 'DOUBLE', query))
+    reader = result.fetch_record_batch(batch)
+    for chunk in reader:
+        if not chunk.num_rows:
+            continue
+        addresses = chunk.column(1).dictionary_encode()
+        codes = addresses.indices.fill_null(-1).to_numpy(zero_copy_only=False).astype(np.int64)
+        uniques = addresses.dictionary.to_pylist()
+        if (codes < 0).any():
+            codes = np.where(codes < 0, len(uniques), codes)
+            uniques.append('')
+        values = parse_units(chunk.column(2), limbs) if limbs else \
+                chunk.column(2).to_numpy(zero_copy_only=False)
+        yield chunk.column(0).to_numpy(zero_copy_only=False).astype(np.int64), codes, uniques, \
+                values
+
+
+# small raw tables for offline checks of the translated queries, rows of every table are random
+# but include the cases filtered by the queries (zero values, failed traces, calls that move no
+# funds, missing addresses, blocks before and after EIP-1559 and rows after FINAL_DATE)
+def write_fixtures(tables, sql_files, final_date, rows=1000, seed=0):
+    rng = np.random.default_rng(seed)
+    last = np.datetime64(final_date, 'D')
+    # timestamps of rows span 60 days until a week after FINAL_DATE (in UTC like in BigQuery)
+    def timestamps(n):
+        seconds = np.sort(rng.integers(0, 60 * 86400, n))
+        return pa.array((last - 53).astype('datetime64[s]') + seconds.astype('timedelta64[s]')).\
+                cast(pa.timestamp('us', tz='UTC'))
+
+    def addresses(n, eth=True):
+        pool = ['0x{:040x}'.format(i) for i in range(1, 51)] if eth else \
+                ['1Addr{:02d}'.format(i) for i in range(1, 51)]
+        return np.asarray(pool, dtype=object)[rng.zipf(1.5, n) % 50]
+
+    def numeric(values):
+        return pa.array([None if v is None else int(v) for v in values], type=pa.decimal128(38, 9))
+
+    n_blocks = rows // 10
+    block_times = timestamps(n_blocks)
+    block_numbers = np.arange(n_blocks)
+    columns = {
+        'inputs': lambda n: {
+            'block_timestamp': timestamps(n),
+            'addresses': [list(addresses(1 + (rng.random() < 0.05), eth=False)) for _ in range(n)],
+            'value': numeric(rng.integers(0, 10**10, n) * (rng.random(n) > 0.05)),
+            },
+        'outputs': lambda n: {
+            'block_timestamp': timestamps(n),
+            'addresses': [list(addresses(1 + (rng.random() < 0.05), eth=False)) for _ in range(n)],
+            'value': numeric(rng.integers(0, 10**10, n) * (rng.random(n) > 0.05)),
+            },
+        'traces': lambda n: {
+            'block_timestamp': timestamps(n),
+            'from_address': [None if rng.random() < 0.05 else a for a in addresses(n)],
+            'to_address': [None if rng.random() < 0.05 else a for a in addresses(n)],
+            'value': numeric([v * 10**5 for v in (rng.integers(0, 10**15, n) *
+                (rng.random(n) > 0.1)).tolist()]),
+            'status': rng.integers(0, 10, n).clip(0, 1),
+            'call_type': rng.choice(np.array(['call', 'delegatecall', 'callcode', 'staticcall',
+                None], dtype=object), n, p=[0.6, 0.1, 0.05, 0.1, 0.15]),
+            },
+        'transactions': lambda n: {
+            'block_number': np.sort(rng.integers(0, n_blocks, n)),
+            'from_address': addresses(n),
+            'receipt_gas_used': rng.integers(21000, 10**6, n),
+            'gas_price': rng.integers(10**9, 10**11, n),
+            'receipt_effective_gas_price': rng.integers(10**9, 10**11, n),
+            },
+        'blocks': lambda n: {
+            'number': block_numbers,
+            'timestamp': block_times,
+            'miner': addresses(n_blocks),
+            'base_fee_per_gas': [None if i < n_blocks // 2 else int(v) for i, v in
+                enumerate(rng.integers(10**8, 10**9, n_blocks))],
+            },
+        }
+
+    written = []
+    for fname in sql_files:
+        with open(fname, 'r') as f:
+            sql = f.read()
+        for dataset, table in tables_of(sql):
+            path = os.path.join(tables, dataset, table)
+            if path in written:
+                continue
+            data = columns[table](rows)
+            if table == 'transactions':
+                # transactions are in blocks, at the time of their block
+                data['block_timestamp'] = block_times.take(pa.array(data['block_number']))
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            pq.write_table(pa.table({k: v if isinstance(v, pa.Array) else pa.array(v)
+                for k, v in data.items()}),
+                os.path.join(path, '{}-000000000000.parquet'.format(table)))
+            written.append(path)
+    return written
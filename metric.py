@@ -13,34 +13,77 @@ import matplotlib.dates as mdates
 import matplotlib.cm as cm
 from time import time
 
+from sketches import SKETCH_DIR, SketchStore, holders_above, is_sketch_store, population_gini, \
+        population_nakamoto, top_share
+from topstore import TOP_DIR, TopStore, is_top_store
 
+
+# metrics are computed for all weeks at once: x is a (N, weeks) matrix of shares of the top N
+# holders (one column per week, a 1D array is a single week), memory stays O(N * weeks)
 def entropy(x):
-    return -np.dot(x, np.log(x))
+    return -(x * np.log(x)).sum(axis=0)
 
 
 def gini(x):
-    # s = 0
-    # for i in range(len(x)):
-        # s += np.abs(x[i] - x).sum()
-    # return s / (2 * len(x))
-    return np.abs(np.tril(np.subtract.outer(x, x))).sum() / len(x)
+    # sum of |x_i - x_j| over all pairs divided by N, from the sorted shares: the k-th smallest
+    # share is added k times and subtracted N - 1 - k times
+    n = x.shape[0]
+    return np.dot(2 * np.arange(n) - n + 1, np.sort(x, axis=0)) / n
 
 
 def nakamoto(x):
-    half = 0.5 * x.sum()
-    s = 0
-    for i in range(1, len(x) + 1):
-        s += x[i-1]
-        if s > half:
-            return i
+    # the smallest number of top holders owning more than a half (NaN if there is none)
+    above = np.cumsum(x, axis=0) > 0.5 * x.sum(axis=0)
+    return np.where(above.any(axis=0), above.argmax(axis=0) + 1, np.nan)
 
 
 def efficiency(x):
-    return entropy(x) / np.log(len(x))
+    return entropy(x) / np.log(x.shape[0])
 
 
 def robin(x):
-    return 0.5 * np.abs(x - 1 / len(x)).sum()
+    return 0.5 * np.abs(x - 1 / x.shape[0]).sum(axis=0)
+
+
+METRICS = {
+        'entropy': entropy,
+        'gini': gini,
+        'nakamoto': nakamoto,
+        'efficiency': efficiency,
+        'robin': robin,
+        }
+# metrics of all holders calculated from sketches of balances (see sketches.py)
+POPULATION_METRICS = ['gini', 'nakamoto', 'holders', 'top_share']
+CACHE_DIR = 'cache'
+
+
+def load_balances(dir_, token_csv):
+    # returns dates and the (rows, weeks) matrix of top balances of a CSV file. The parsed matrix
+    # is cached to .npy files, which are parsed again only if the CSV file is newer
+    fname = os.path.join(dir_, token_csv)
+    cache = os.path.join(dir_, CACHE_DIR, token_csv.rsplit('.', 1)[0])
+    if os.path.isfile(cache + '.values.npy') and \
+            os.path.getmtime(cache + '.values.npy') >= os.path.getmtime(fname):
+        return np.load(cache + '.dates.npy'), np.load(cache + '.values.npy')
+
+    df = pd.read_csv(fname, header=0, index_col=0)
+    df.drop(df.index[0], inplace=True)
+    dates = pd.to_datetime(df.columns).to_numpy()
+    values = df.to_numpy(dtype=float)
+    if not os.path.isdir(os.path.join(dir_, CACHE_DIR)):
+        os.makedirs(os.path.join(dir_, CACHE_DIR))
+    np.save(cache + '.dates.npy', dates)
+    np.save(cache + '.values.npy', values)
+    return dates, values
+
+
+def load_store(path):
+    # returns dates and the matrix of top balances of a store of weekly top balances (see
+    # topstore.py), in the layout of its exported CSV file read by load_balances
+    dates, values, _ = TopStore(path).read()
+    values = values.T
+    non_nan = np.flatnonzero(~np.isnan(values).all(axis=1))
+    return dates, values[1:non_nan[-1] + 1 if non_nan.shape[0] else 0]
 
 
 formatter = lambda prog: argparse.RawTextHelpFormatter(prog, max_help_position=50)
@@ -61,15 +104,18 @@ required_args.add_argument(
 required_args.add_argument(
         '--metric',
         type=str,
-        choices=['entropy', 'gini', 'nakamoto', 'efficiency', 'robin'],
+        nargs='+',
+        choices=list(METRICS),
         required=True,
-        help='Metric to plot. Available metrics: entropy, '
+        help='Metrics to plot (one figure per metric and N). Available metrics: entropy, gini, '
+            'nakamoto,\nefficiency, robin',
         )
 required_args.add_argument(
         '--N',
         type=int,
+        nargs='+',
         required=True,
-        help='Top N token holders to consider',
+        help='Top N token holders to consider (one or more values)',
         )
 
 # optimal arguments
@@ -104,6 +150,32 @@ optional_args.add_argument(
         default=False,
         help='Use log scale on y-axis, defaults to False'
         )
+optional_args.add_argument(
+        '--population',
+        type=str,
+        nargs='+',
+        choices=POPULATION_METRICS,
+        default=[],
+        help='Metrics of all holders to plot from sketches of balances in folder \"{}/NAME\" (saved '
+            'by\ncalc_top_balances.py with --sketch): gini, nakamoto, holders (above THRESHOLDS), '
+            'top_share\n(of the top FRACTIONS of holders), defaults to none'.format(SKETCH_DIR),
+        )
+optional_args.add_argument(
+        '--thresholds',
+        type=float,
+        nargs='+',
+        default=[1, 1000],
+        help='Balances for the number of holders above them (with --population holders), '
+            'defaults to 1 1000',
+        )
+optional_args.add_argument(
+        '--fractions',
+        type=float,
+        nargs='+',
+        default=[0.01, 0.1],
+        help='Fractions of the richest holders for their share of all balances (with --population '
+            'top_share),\ndefaults to 0.01 0.1',
+        )
 args = parser.parse_args()
 
 LABELS = {
@@ -122,72 +194,119 @@ if args.latex:
     plt.rcParams['font.serif'] = ['Times New Roman'] + plt.rcParams['font.serif']
     plt.rc('text', usetex=True)
 
-fig, ax = plt.subplots(figsize=(8.636, 5.2)) # this width is twice larger for double-column IEEE articles
-
-token_csvs = [f for f in os.listdir(args.dir) if 'csv' in f]
-for token_csv in token_csvs:
+# each coin is loaded once, then all metrics are calculated for all N. Coins are CSV files of top
+# balances or stores of weekly top balances in folder TOP_DIR (loaded much faster), a store is used
+# if a coin has both
+Y = defaultdict(dict)
+token_csvs = {f.split('.')[0]: f for f in os.listdir(args.dir) if 'csv' in f}
+if os.path.isdir(os.path.join(args.dir, TOP_DIR)):
+    for name in sorted(os.listdir(os.path.join(args.dir, TOP_DIR))):
+        if is_top_store(os.path.join(args.dir, TOP_DIR, name)):
+            token_csvs[name] = None
+for name, token_csv in token_csvs.items():
     # if token_csv in ['Theta Token.csv', 'stETH.csv']:
         # continue
 
-    df = pd.read_csv(os.path.join(args.dir, token_csv), header=0, index_col=0)
-    df.drop(df.index[0], inplace=True)
+    if token_csv is None:
+        dates, values = load_store(os.path.join(args.dir, TOP_DIR, name))
+    else:
+        dates, values = load_balances(args.dir, token_csv)
+
+    # the first week with no NaN among the top balances
+    full = np.flatnonzero(~np.isnan(values[:args.top]).any(axis=0))
+    FIRST_COL = full[0] if full.shape[0] else 0
+
+    print('First {} weeks dropped for \"{}\"'.format(FIRST_COL, name))
+
+    X = pd.to_datetime(dates[FIRST_COL:])
 
-    FIRST_COL = None
-    for i, col in enumerate(df):
-        if not df[col][:args.top].isnull().sum():
-            FIRST_COL = col
-            break
-    non_nan_df = df.loc[:, FIRST_COL:].copy()
-
-    name = token_csv.split('.')[0]
-    print('First {} weeks dropped for \"{}\"'.format(df.shape[-1] - non_nan_df.shape[-1], name))
-
-    X = pd.to_datetime(non_nan_df.columns)
-    Y = []
-
-    for i, col in enumerate(non_nan_df):
-        # some token addresses have zero or nagative balance, this may cause warning when 
-        # computing entropy so we will replace 'bad' values with machine epsilon
-        non_nan_df.loc[np.isclose(non_nan_df[col], 0), col] = np.finfo(float).eps
-
-        top_N = non_nan_df[col][:args.N].to_numpy()
-        top_N = top_N / top_N.sum()
-        assert np.isclose(top_N.sum(), 1)
-        
-        if args.metric == 'entropy':
-            Y.append(entropy(top_N))
-        elif args.metric == 'gini':
-            Y.append(gini(top_N))
-        elif args.metric == 'nakamoto':
-            Y.append(nakamoto(top_N))
-        elif args.metric == 'efficiency':
-            Y.append(efficiency(top_N))
-        elif args.metric == 'robin':
-            Y.append(robin(top_N))
+    # some token addresses have zero or nagative balance, this may cause warning when 
+    # computing entropy so we will replace 'bad' values with machine epsilon
+    values = np.array(values[:, FIRST_COL:])
+    values[np.isclose(values, 0)] = np.finfo(float).eps
+
+    for N in args.N:
+        top_N = values[:N]
+        top_N = top_N / top_N.sum(axis=0)
+        assert np.allclose(top_N.sum(axis=0), 1)
+        for metric in args.metric:
+            Y[metric, N][name] = X, METRICS[metric](top_N)
+
+# metrics of all holders, every figure is a key of P with the label of its y-axis
+P = defaultdict(dict)
+for name in token_csvs if args.population else []:
+    path = os.path.join(args.dir, SKETCH_DIR, name)
+    if not is_sketch_store(path) or not len(SketchStore(path)):
+        print('No sketches of balances for \"{}\"'.format(name))
+        continue
+    dates, counts, sums = SketchStore(path).read()
+    X = pd.to_datetime(dates)
+    ys = {}
+    for metric in args.population:
+        if metric == 'gini':
+            ys['population_gini', 'Gini coefficient'] = population_gini(counts, sums)
+        elif metric == 'nakamoto':
+            ys['population_nakamoto', 'Nakamoto coefficient'] = population_nakamoto(counts, sums)
+        elif metric == 'holders':
+            for t in args.thresholds:
+                ys['holders_above={:g}'.format(t), 'Holders above {:g}'.format(t)] = \
+                        holders_above(counts, sums, t)
         else:
-            pass
-    
-    plt.plot(X, Y, linewidth=3, label=LABELS[name])
-
-ax.set_title('Sample size {}N = {}{}'.format('$' if args.latex else '', args.N,
-    '$' if args.latex else ''))
-
-ax.xaxis_date()
-ax.set_xlabel('Year')
-
-if args.ylog:
-    plt.yscale('log')
-y_label = '{}'.format(args.metric.title())
-if args.metric in ['gini', 'nakamoto']:
-    y_label += ' coefficient'
-elif args.metric == 'robin':
-    y_label += ' Hood index'
-ax.set_ylabel(y_label)
-
-plt.legend(labelspacing=0.1, fontsize='small')
-
-plt.savefig(
-        os.path.join(args.dir, 'coins_{}_N={}.pdf'.format(args.metric, args.N)),
-        format='PDF',
-        bbox_inches='tight',
-        )
+            for p in args.fractions:
+                ys['top_share={:g}'.format(p), 'Share of the top {:g}{}%'.format(100 * p,
+                    '\\' if args.latex else '')] = top_share(counts, sums, p)
+    for key, y in ys.items():
+        P[key][name] = X, y
+    print('All holders of \"{}\" at {}: {}'.format(name, dates[-1], ', '.join(
+        '{} {:.4g}'.format(label, y[-1]) for (_, label), y in ys.items())))
+
+for metric in args.metric:
+    for N in args.N:
+        # this width is twice larger for double-column IEEE articles
+        fig, ax = plt.subplots(figsize=(8.636, 5.2))
+        for name, (X, y) in Y[metric, N].items():
+            plt.plot(X, y, linewidth=3, label=LABELS.get(name, name))
+
+        ax.set_title('Sample size {}N = {}{}'.format('$' if args.latex else '', N,
+            '$' if args.latex else ''))
+
+        ax.xaxis_date()
+        ax.set_xlabel('Year')
+
+        if args.ylog:
+            plt.yscale('log')
+        y_label = '{}'.format(metric.title())
+        if metric in ['gini', 'nakamoto']:
+            y_label += ' coefficient'
+        elif metric == 'robin':
+            y_label += ' Hood index'
+        ax.set_ylabel(y_label)
+
+        plt.legend(labelspacing=0.1, fontsize='small')
+
+        plt.savefig(
+                os.path.join(args.dir, 'coins_{}_N={}.pdf'.format(metric, N)),
+                format='PDF',
+                bbox_inches='tight',
+                )
+        plt.close(fig)
+
+for (figure, y_label), coins in P.items():
+    fig, ax = plt.subplots(figsize=(8.636, 5.2))
+    for name, (X, y) in coins.items():
+        plt.plot(X, y, linewidth=3, label=LABELS.get(name, name))
+
+    ax.set_title('All holders')
+    ax.xaxis_date()
+    ax.set_xlabel('Year')
+    if args.ylog:
+        plt.yscale('log')
+    ax.set_ylabel(y_label)
+    plt.legend(labelspacing=0.1, fontsize='small')
+
+    plt.savefig(
+            os.path.join(args.dir, 'coins_{}.pdf'.format(figure)),
+            format='PDF',
+            bbox_inches='tight',
+            )
+    plt.close(fig)
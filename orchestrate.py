@@ -0,0 +1,458 @@
+#!/usr/bin/env python3.9
+
+# This script can be used to process several blockchains at once: for every blockchain, CSV files
+# are (optionally) copied from GCS by cp_from_gcs.py, split by split_csv.py and top balances are
+# calculated by calc_top_balances.py, then metric.py plots the metrics of all blockchains. Stages of
+# different blockchains run concurrently as long as their estimated memory fits in the memory
+# budget and their workers in the CPU budget (a stage larger than the budget runs alone). Memory
+# of a stage is estimated from the sizes of CSV files and weekly partitions, or taken from the peak
+# RSS measured when the stage ran before. Finished stages are saved in a state file, so an
+# interrupted run continues with the remaining stages
+
+import os
+import sys
+import json
+import glob
+import shutil
+import signal
+import argparse
+import platform
+import subprocess
+from time import time
+
+from partitions import list_sub_dirs
+from sketches import SKETCH_DIR, is_sketch_store
+from topstore import TOP_DIR
+
+
+# stages run in their own processes, the orchestrator itself takes little memory
+HERE = os.path.dirname(os.path.abspath(__file__))
+STATE_FILE = 'orchestrate.json'
+LOGS_DIR = 'logs'
+COINS_DIR = 'coins'
+STAGES = ['copy', 'split', 'calc', 'metric']
+# memory model of stages (bytes): the interpreter with numpy, pandas and pyarrow, the address book
+# index of split_csv.py and balances of the array engine per address, a parsed CSV file relative
+# to its size, and CSV bytes per distinct address (used before the address book exists)
+BASE_MEMORY = 128 * 2**20
+BOOK_BYTES = 130
+ARRAY_BYTES = 9
+PARSE_FACTOR = 4
+CSV_BYTES_PER_ADDRESS = 250
+# subfolders of every blockchain on GCS (the types of transfers copied by cp_from_gcs.py)
+BTC_SUB_DIRS = ['inputs', 'outputs']
+ETH_SUB_DIRS = ['credits', 'debits', 'credit_fees', 'debit_fees']
+GCS_SUB_DIRS = {
+        'bitcoin': BTC_SUB_DIRS,
+        'bitcoin_cash': BTC_SUB_DIRS,
+        'dash': BTC_SUB_DIRS,
+        'dogecoin': BTC_SUB_DIRS,
+        'ethereum': ETH_SUB_DIRS,
+        'ethereum_classic': ETH_SUB_DIRS,
+        'litecoin': BTC_SUB_DIRS,
+        }
+
+
+def chain_sub_dirs(dir_, chain, copy, sub_dirs):
+    # subfolders of a blockchain: given by --sub_dirs, found in its folder (unless they are copied
+    # from GCS), or else the folders of the blockchain on GCS
+    if chain in sub_dirs:
+        return sub_dirs[chain]
+    chain_dir = os.path.join(dir_, chain)
+    if not copy and os.path.isdir(chain_dir) and list_sub_dirs(chain_dir):
+        return sorted(list_sub_dirs(chain_dir))
+    return GCS_SUB_DIRS.get(chain, [])
+
+
+def total_memory():
+    # physical memory in bytes (Linux only, 8 GB otherwise)
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 8 * 2**30
+
+
+def file_sizes(pattern):
+    return [os.path.getsize(f) for f in glob.glob(pattern) if os.path.isfile(f)]
+
+
+def n_addresses(chain_dir):
+    # number of addresses in the address book, None if there is no address book
+    fname = os.path.join(chain_dir, 'addresses.idx')
+    return os.path.getsize(fname) // 8 - 1 if os.path.isfile(fname) else None
+
+
+class Stage:
+
+    def __init__(self, name, chain, kind, deps, sub_dir=None):
+        self.name = name
+        self.chain = chain
+        self.kind = kind
+        self.deps = deps
+        self.sub_dir = sub_dir
+        self.cpus = 1
+        self.memory = BASE_MEMORY
+        self.command = None
+
+    def __repr__(self):
+        return self.name
+
+
+def build_stages(args, chains):
+    # stages of every blockchain and the metric stage, in the order of dependencies
+    stages = []
+    calcs = []
+    for chain in args.chains:
+        deps = []
+        if args.copy:
+            for sd in chains[chain]:
+                stages.append(Stage('{}/copy_{}'.format(chain, sd), chain, 'copy', [], sd))
+                deps.append(stages[-1].name)
+        stages.append(Stage('{}/split'.format(chain), chain, 'split', deps))
+        stages.append(Stage('{}/calc'.format(chain), chain, 'calc', [stages[-1].name]))
+        calcs.append(stages[-1].name)
+    stages.append(Stage('metric', None, 'metric', calcs))
+    return stages
+
+
+def plan(stage, args, chains, measured):
+    # command, CPUs and estimated memory of STAGE, done just before it starts, so that the sizes
+    # of files written by the previous stages are known
+    chain_dir = os.path.join(args.dir, stage.chain) if stage.chain else None
+    python = [sys.executable]
+    if stage.kind == 'copy':
+        stage.command = python + [os.path.join(HERE, 'cp_from_gcs.py'), '--name', stage.chain,
+                '--type', stage.sub_dir, '--to_dir', args.dir]
+    elif stage.kind == 'split':
+        csv_sizes = [s for sd in chains[stage.chain] for s in
+                file_sizes(os.path.join(chain_dir, sd, 'csv', '*'))]
+        addresses = n_addresses(chain_dir)
+        if addresses is None:
+            addresses = sum(csv_sizes) // CSV_BYTES_PER_ADDRESS
+        stage.cpus = min(args.workers, args.cpus)
+        # every worker parses up to two files ahead
+        stage.memory = BASE_MEMORY + addresses * BOOK_BYTES + \
+                2 * stage.cpus * max(csv_sizes + [0]) * PARSE_FACTOR
+        stage.command = python + [os.path.join(HERE, 'split_csv.py'), '--dir', args.dir, '--name',
+                stage.chain, '--workers', str(stage.cpus), '--end_date', args.end_date] + \
+                ['--incremental'] * args.incremental
+    elif stage.kind == 'calc':
+        with open(os.path.join(chain_dir, 'split.json'), 'r') as f:
+            start_date = json.load(f)['start_date']
+        addresses = n_addresses(chain_dir) or 0
+        # a week is read from all subfolders and updated with temporary copies
+        week = max(file_sizes(os.path.join(chain_dir, '*', 'bin', '*.ids')) + [0]) * \
+                2 * len(chains[stage.chain])
+        stage.memory = BASE_MEMORY + addresses * ARRAY_BYTES + week
+        engine = ['--engine', args.engine]
+        # balances that do not fit are kept in files by the disk engine, which holds in memory
+        # what is left of the budget
+        budget = max(args.memory - BASE_MEMORY - week, 256 * 2**20)
+        if args.engine == 'array' and stage.memory > args.memory and \
+                BASE_MEMORY + week + budget < stage.memory:
+            engine = ['--engine', 'disk', '--memory_budget', str(budget // 2**20)]
+            stage.memory = BASE_MEMORY + week + budget
+        stage.command = python + [os.path.join(HERE, 'calc_top_balances.py'), '--dir', args.dir,
+                '--name', stage.chain, '--start_date', start_date, '--top', str(args.top)] + \
+                engine + ['--incremental'] * args.incremental
+    else:
+        stage.command = python + [os.path.join(HERE, 'metric.py'), '--dir',
+                os.path.join(args.dir, COINS_DIR), '--metric'] + args.metric + \
+                ['--N'] + [str(n) for n in args.N] + ['--top', str(args.top)]
+    # a stage that ran before takes at least as much memory as it did
+    stage.memory = max(stage.memory, measured.get(stage.name, 0))
+
+
+def collect_tops(args):
+    # top balances of all blockchains are plotted from one folder
+    coins = os.path.join(args.dir, COINS_DIR)
+    if not os.path.isdir(coins):
+        os.makedirs(coins)
+    for chain in args.chains:
+        # stores of weekly top balances are read by metric.py much faster than CSV files
+        shutil.copytree(os.path.join(args.dir, chain, 'top{}_balances'.format(args.top)),
+                os.path.join(coins, TOP_DIR, chain), dirs_exist_ok=True)
+        # sketches of all balances, if calculated, are read by metric.py with --population
+        if is_sketch_store(os.path.join(args.dir, chain, SKETCH_DIR)):
+            shutil.copytree(os.path.join(args.dir, chain, SKETCH_DIR),
+                    os.path.join(coins, SKETCH_DIR, chain), dirs_exist_ok=True)
+
+
+def save_state(fname, state):
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(fname + '.tmp', fname)
+
+
+def main():
+    formatter = lambda prog: argparse.RawTextHelpFormatter(prog, max_help_position=50)
+    parser = argparse.ArgumentParser(
+            description='Runs split_csv.py, calc_top_balances.py and metric.py for several '
+                'blockchains concurrently',
+            add_help=False,
+            formatter_class=formatter,
+            )
+
+    # required arguments
+    required_args = parser.add_argument_group('required arguments')
+    required_args.add_argument(
+            '--dir',
+            type=str,
+            required=True,
+            help='Path to parent directory with blockchain historical data',
+            )
+
+    # optimal arguments
+    optional_args = parser.add_argument_group('optional arguments')
+    optional_args.add_argument(
+            '-h',
+            '--help',
+            action='help',
+            help='show this help message and exit',
+            )
+    optional_args.add_argument(
+            '--chains',
+            type=str,
+            nargs='+',
+            default=list(GCS_SUB_DIRS),
+            metavar='CHAIN',
+            help='Blockchains to process, defaults to all of them:\n{}'.format(
+                ', '.join(GCS_SUB_DIRS)),
+            )
+    optional_args.add_argument(
+            '--sub_dirs',
+            type=str,
+            nargs='+',
+            default=[],
+            metavar='SD',
+            help='Subfolders of blockchains as CHAIN:SUB_DIR,... (e.g. ethereum:credits,debits), '
+                'defaults to\nthe subfolders in DIR/CHAIN, or to the folders of CHAIN on GCS with '
+                '--copy',
+            )
+    optional_args.add_argument(
+            '--copy',
+            action='store_true',
+            default=False,
+            help='Copy CSV files from GCS by cp_from_gcs.py first, defaults to False',
+            )
+    optional_args.add_argument(
+            '--cpus',
+            type=int,
+            default=os.cpu_count(),
+            help='Number of CPUs used by all running stages, defaults to the number of CPUs',
+            )
+    optional_args.add_argument(
+            '--memory',
+            type=int,
+            default=total_memory() * 4 // 5 // 2**20,
+            help='Memory in MB used by all running stages, defaults to 80%% of physical memory',
+            )
+    optional_args.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help='Number of worker processes of split_csv.py, defaults to 4',
+            )
+    optional_args.add_argument(
+            '--engine',
+            type=str,
+            choices=['dict', 'array', 'disk'],
+            default='array',
+            help='Engine of calc_top_balances.py (the array engine is replaced by the disk engine '
+                'if balances\ndo not fit in the memory budget), defaults to array',
+            )
+    optional_args.add_argument(
+            '--top',
+            type=int,
+            default=10000,
+            help='How many top account balances to consider, defaults to 10000',
+            )
+    optional_args.add_argument(
+            '--end_date',
+            type=str,
+            default='2022-07-01',
+            help='End date to consider, defaults to 2022-07-01',
+            )
+    optional_args.add_argument(
+            '--metric',
+            type=str,
+            nargs='+',
+            default=['gini', 'nakamoto'],
+            help='Metrics plotted by metric.py, defaults to gini nakamoto',
+            )
+    optional_args.add_argument(
+            '--N',
+            type=int,
+            nargs='+',
+            default=None,
+            help='Top N holders considered by metric.py, defaults to TOP',
+            )
+    optional_args.add_argument(
+            '--incremental',
+            action='store_true',
+            default=False,
+            help='Split and calculate only new data (see split_csv.py and calc_top_balances.py), '
+                'defaults to\nFalse',
+            )
+    optional_args.add_argument(
+            '--fresh',
+            action='store_true',
+            default=False,
+            help='Run all stages again instead of continuing the previous run (e.g. to refresh the '
+                'data\nwith --incremental), defaults to False',
+            )
+    optional_args.add_argument(
+            '--dry_run',
+            action='store_true',
+            default=False,
+            help='Print the stages with their estimated memory without running them, defaults to '
+                'False',
+            )
+    args = parser.parse_args()
+    args.N = args.N or [args.top]
+    args.memory *= 2**20
+    if args.cpus < 1:
+        parser.error('--cpus must be positive')
+    sub_dirs = {}
+    for item in args.sub_dirs:
+        chain, _, sds = item.partition(':')
+        if not chain or not sds:
+            parser.error('--sub_dirs must be given as CHAIN:SUB_DIR,... (got \"{}\")'.format(item))
+        sub_dirs[chain] = sds.split(',')
+
+    args.dir = os.path.abspath(args.dir)
+    if not os.path.isdir(args.dir):
+        raise FileNotFoundError('Directory \"{}\" does not exist!'.format(args.dir))
+    chains = {chain: chain_sub_dirs(args.dir, chain, args.copy, sub_dirs) for chain in args.chains}
+    for chain in args.chains:
+        if not chains[chain]:
+            raise FileNotFoundError('No subfolders of blockchain \"{}\" found in \"{}\" (use '
+                    '--copy or --sub_dirs)!'.format(chain, os.path.join(args.dir, chain)))
+    if not args.copy:
+        for chain in args.chains:
+            for sd in chains[chain]:
+                if not os.path.isdir(os.path.join(args.dir, chain, sd, 'csv')):
+                    raise FileNotFoundError('Directory \"{}\" does not exist (use --copy)!'.format(
+                        os.path.join(args.dir, chain, sd, 'csv')))
+
+    STATE = os.path.join(args.dir, STATE_FILE)
+    state = {'stages': {}, 'measured': {}}
+    if os.path.isfile(STATE):
+        with open(STATE, 'r') as f:
+            state = json.load(f)
+    if args.fresh:
+        # measured memory is kept for the estimates
+        state['stages'] = {}
+    LOGS = os.path.join(args.dir, LOGS_DIR)
+    if not os.path.isdir(LOGS):
+        os.makedirs(LOGS)
+
+    stages = build_stages(args, chains)
+    done = {s.name for s in stages if state['stages'].get(s.name, {}).get('status') == 'done'}
+    pending = [s for s in stages if s.name not in done]
+    if done:
+        print('Continuing the previous run, {} stages already done'.format(len(done)))
+    if args.dry_run:
+        for stage in pending:
+            if all(d in done for d in stage.deps):
+                plan(stage, args, chains, state['measured'])
+                print('{:<28} {:>4} CPUs {:>10.1f} MB  {}'.format(stage.name, stage.cpus,
+                    stage.memory / 2**20, ' '.join(stage.command[1:])))
+            else:
+                print('{:<28} waits for {}'.format(stage.name, ', '.join(stage.deps)))
+        return
+
+    print('Running {} stages with {} CPUs and {:.0f} MB...'.format(len(pending), args.cpus,
+        args.memory / 2**20))
+    start = time()
+    running = {}
+    failed = set()
+    try:
+        while pending or running:
+            # stages whose dependencies failed are not run
+            for stage in [s for s in pending if any(d in failed for d in s.deps)]:
+                pending.remove(stage)
+                failed.add(stage.name)
+                state['stages'][stage.name] = {'status': 'skipped'}
+                print('Skipping {} (a dependency failed)'.format(stage.name))
+
+            # ready stages are started largest first, as long as they fit in the budgets
+            ready = [s for s in pending if all(d in done for d in s.deps)]
+            for stage in ready:
+                plan(stage, args, chains, state['measured'])
+            for stage in sorted(ready, key=lambda s: s.memory, reverse=True):
+                cpus = sum(s.cpus for s, _, _, _ in running.values())
+                memory = sum(s.memory for s, _, _, _ in running.values())
+                if running and (cpus + stage.cpus > args.cpus or
+                        memory + stage.memory > args.memory):
+                    continue
+                if stage.memory > args.memory:
+                    print('Warning: {} needs about {:.0f} MB, more than the memory budget'.format(
+                        stage.name, stage.memory / 2**20))
+                if stage.kind == 'metric':
+                    collect_tops(args)
+                log = open(os.path.join(LOGS, stage.name.replace('/', '.') + '.log'), 'w')
+                process = subprocess.Popen(stage.command, cwd=HERE, stdout=log,
+                        stderr=subprocess.STDOUT)
+                running[process.pid] = (stage, process, log, time())
+                pending.remove(stage)
+                state['stages'][stage.name] = {'status': 'running', 'command': stage.command,
+                        'estimated_memory': stage.memory}
+                save_state(STATE, state)
+                print('Started {} ({} CPUs, about {:.0f} MB)'.format(stage.name, stage.cpus,
+                    stage.memory / 2**20))
+
+            if not running:
+                continue
+            # the peak RSS of a finished stage is measured by wait4 (the maximum over the stage
+            # and all its worker processes)
+            pid, status, usage = os.wait4(-1, 0)
+            if pid not in running:
+                continue
+            stage, process, log, started = running.pop(pid)
+            log.close()
+            process.returncode = os.waitstatus_to_exitcode(status)
+            peak_rss = usage.ru_maxrss * (1 if platform.system() == 'Darwin' else 1024)
+            state['measured'][stage.name] = peak_rss
+            state['stages'][stage.name].update({
+                'status': 'done' if process.returncode == 0 else 'failed',
+                'returncode': process.returncode,
+                'seconds': time() - started,
+                'peak_rss': peak_rss,
+                })
+            save_state(STATE, state)
+            if process.returncode == 0:
+                done.add(stage.name)
+                print('Finished {} in {:.1f} s, peak RSS {:.0f} MB'.format(stage.name,
+                    time() - started, peak_rss / 2**20))
+            else:
+                failed.add(stage.name)
+                print('Failed {} with exit code {}, see {}'.format(stage.name, process.returncode,
+                    log.name))
+    except KeyboardInterrupt:
+        # running stages are stopped and run again next time (calc_top_balances.py resumes from
+        # its saved balances)
+        for stage, process, log, _ in running.values():
+            process.send_signal(signal.SIGTERM)
+            process.wait()
+            log.close()
+            state['stages'][stage.name]['status'] = 'interrupted'
+        save_state(STATE, state)
+        print('\nInterrupted, run the same command again to continue')
+        sys.exit(1)
+
+    print(' ' * 50, end='\n')
+    print('Orchestration done!' if not failed else 'Orchestration done, {} stages failed or '
+        'skipped: {}'.format(len(failed), ', '.join(sorted(failed))))
+    print('Elapsed time: {:.4f} s'.format(time() - start))
+    print('State saved in {}'.format(STATE))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
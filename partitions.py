@@ -0,0 +1,470 @@
+# This module contains the formats of weekly partitions written by split_csv.py and read by
+# calc_top_balances.py:
+#   - pkl: each week is a pickled pandas DataFrame with columns "address" and "value";
+#   - bin: each week is a pair of raw binary arrays, "{week:04d}.ids" with dense address IDs and
+#     "{week:04d}.val" with values, read with np.memmap without copying. The addresses behind
+#     the IDs are shared by all sub-directories of a blockchain and saved in an address book,
+#     which indexes compact binary keys of addresses instead of the strings. With --exact, values
+#     are rows of int64 limbs in base units (see fixedpoint.py) and "split.json" holds the number
+#     of limbs.
+
+import os
+import gc
+import json
+import shutil
+import pickle
+import numpy as np
+import pandas as pd
+from itertools import islice
+
+from addresskeys import address_keys
+from fixedpoint import UNITS_DTYPE, sum_by_id
+
+
+FORMATS = ['bin', 'pkl']
+IDS_DTYPE = np.dtype(np.int64)
+VALUES_DTYPE = np.dtype(np.float64)
+# days since epoch of rows, kept in binary partitions to build the event store (see events.py)
+DAYS_DTYPE = np.dtype(np.int32)
+DAYS_EXT = 'day'
+ADDRESSES_FILE = 'addresses.txt'
+OFFSETS_FILE = 'addresses.idx'
+# number of addresses read from the address book at once when their keys are indexed
+LOAD_BATCH = 2**20
+# folder with weekly net deltas per address pre-aggregated over all sub-directories
+NET_DIR = 'net'
+# manifest of CSV files split so far (used to split new files only)
+SPLIT_MANIFEST = 'split.json'
+# record of an incremental split in progress, with the sizes of partitions before it
+SPLIT_PENDING = 'split.pending.json'
+# pickle partitions written before an incremental split are kept with this suffix until it ends
+BACKUP_EXT = '.orig'
+
+
+class AddressBook:
+    # Maps addresses to dense integer IDs in the order of their first appearance. Addresses are
+    # indexed by their compact binary keys (see addresskeys.py). If PATH is given, addresses are
+    # saved to PATH/addresses.txt (one per line) together with the byte offsets of the lines in
+    # PATH/addresses.idx, so that single addresses can be looked up without loading the whole book.
+    # Only addresses that are not saved yet are kept in memory as strings
+
+    def __init__(self, path=None):
+        self.path = path
+        self.index = None
+        self.keys = None
+        self.new = []
+        self.n_saved = 0
+        if path is not None and os.path.isfile(os.path.join(path, OFFSETS_FILE)):
+            self.n_saved = os.path.getsize(os.path.join(path, OFFSETS_FILE)) // 8 - 1
+        if not self.n_saved:
+            self.index = {}
+            self.keys = []
+
+    def __len__(self):
+        return self.n_saved + len(self.new)
+
+    def load(self):
+        if self.index is None:
+            self.index = {}
+            self.keys = []
+            with open(os.path.join(self.path, ADDRESSES_FILE), 'r') as f:
+                while len(self.keys) < self.n_saved:
+                    batch = [line[:-1] for line in islice(f, min(LOAD_BATCH,
+                        self.n_saved - len(self.keys)))]
+                    keys = address_keys(batch)
+                    self.index.update(zip(keys, range(len(self.keys), len(self.keys) + len(keys))))
+                    self.keys.extend(keys)
+        return self
+
+    def ids(self, addresses):
+        # hash the addresses in C, then look up only the unique ones in the python index
+        codes, uniques = pd.factorize(np.asarray(addresses, dtype=object))
+        uniques = list(uniques)
+        if (codes < 0).any():
+            codes = np.where(codes < 0, len(uniques), codes)
+            uniques.append('')
+        return self.unique_ids(uniques)[codes]
+
+    def unique_ids(self, uniques):
+        self.load()
+        index = self.index
+        keys_ = self.keys
+        new = self.new
+        unique_ids = np.empty(len(uniques), dtype=IDS_DTYPE)
+        for j, (address, key) in enumerate(zip(uniques, address_keys(uniques))):
+            i = index.get(key)
+            if i is None:
+                i = index[key] = len(keys_)
+                keys_.append(key)
+                new.append(address)
+            unique_ids[j] = i
+        return unique_ids
+
+    def key_ids(self, keys):
+        # IDs of addresses given by their keys, all of them must be in the book
+        self.load()
+        index = self.index
+        try:
+            return np.fromiter((index[k] for k in keys), dtype=IDS_DTYPE, count=len(keys))
+        except KeyError:
+            raise ValueError('Address key {} is not in the address book!'.format(
+                [k for k in keys if k not in index][0].hex()))
+
+    def keys_of(self, ids):
+        self.load()
+        keys_ = self.keys
+        return [keys_[i] for i in np.asarray(ids).tolist()]
+
+    def lookup(self, ids):
+        ids = np.asarray(ids).tolist()
+        if not any(i < self.n_saved for i in ids):
+            new = self.new
+            return [new[i - self.n_saved] for i in ids]
+        offsets = np.memmap(os.path.join(self.path, OFFSETS_FILE), dtype=np.int64, mode='r')
+        with open(os.path.join(self.path, ADDRESSES_FILE), 'rb') as f:
+            lines = []
+            for i in ids:
+                if i >= self.n_saved:
+                    lines.append(self.new[i - self.n_saved])
+                    continue
+                f.seek(offsets[i])
+                lines.append(f.read(offsets[i + 1] - offsets[i] - 1).decode())
+        return lines
+
+    def save(self):
+        if self.path is None or not self.new:
+            return
+        data = [(a + '\n').encode() for a in self.new]
+        offsets_file = os.path.join(self.path, OFFSETS_FILE)
+        if self.n_saved:
+            start = int(np.memmap(offsets_file, dtype=np.int64, mode='r')[-1])
+            offsets = start + np.cumsum([len(d) for d in data], dtype=np.int64)
+        else:
+            offsets = np.cumsum([0] + [len(d) for d in data], dtype=np.int64)
+        with open(os.path.join(self.path, ADDRESSES_FILE), 'ab') as f:
+            f.write(b''.join(data))
+        with open(offsets_file, 'ab') as f:
+            offsets.tofile(f)
+        self.n_saved += len(self.new)
+        self.new = []
+
+    def truncate(self, n):
+        # keeps the first N addresses only
+        if not n:
+            return self.clear()
+        offsets = np.fromfile(os.path.join(self.path, OFFSETS_FILE), dtype=np.int64, count=n + 1)
+        with open(os.path.join(self.path, OFFSETS_FILE), 'r+b') as f:
+            f.truncate((n + 1) * 8)
+        with open(os.path.join(self.path, ADDRESSES_FILE), 'r+b') as f:
+            f.truncate(int(offsets[-1]))
+        self.index = None
+        self.keys = None
+        self.new = []
+        self.n_saved = n
+
+    def clear(self):
+        for file_ in [ADDRESSES_FILE, OFFSETS_FILE]:
+            if os.path.isfile(os.path.join(self.path, file_)):
+                os.remove(os.path.join(self.path, file_))
+        self.index = {}
+        self.keys = []
+        self.new = []
+        self.n_saved = 0
+
+
+def list_sub_dirs(dir_):
+    # subfolders of a blockchain with CSV files or weekly partitions
+    return [d for d in os.listdir(dir_) if d != NET_DIR and
+            any(os.path.isdir(os.path.join(dir_, d, f)) for f in ['csv'] + FORMATS)]
+
+
+def detect_format(sub_dirs):
+    # prefer binary partitions if all sub-directories have them
+    for fmt in FORMATS:
+        if all(os.path.isdir(os.path.join(sd, fmt)) and os.listdir(os.path.join(sd, fmt))
+                for sd in sub_dirs):
+            return fmt
+    return None
+
+
+def list_weeks(sub_dir, fmt):
+    files = os.listdir(os.path.join(sub_dir, fmt))
+    return list(sorted({int(f.split('.')[0]) for f in files if f.split('.')[0].isnumeric()}))
+
+
+def week_file(sub_dir, fmt, week, ext=None):
+    return os.path.join(sub_dir, fmt, '{:04d}.{}'.format(week, ext or fmt))
+
+
+def _memmap(fname, dtype):
+    if not os.path.getsize(fname):
+        return np.empty(0, dtype=dtype)
+    return np.memmap(fname, dtype=dtype, mode='r')
+
+
+def read_pkl_week(sub_dir, week):
+    with open(week_file(sub_dir, 'pkl', week), 'rb') as f:
+        gc.disable()
+        df = pickle.load(f)
+        gc.enable()
+    return df
+
+
+def read_bin_week(sub_dir, week, limbs=0):
+    # zero-copy: both arrays are memory-mapped, values are (rows, LIMBS) limbs if LIMBS
+    ids = _memmap(week_file(sub_dir, 'bin', week, 'ids'), IDS_DTYPE)
+    if limbs:
+        values = _memmap(week_file(sub_dir, 'bin', week, 'val'), UNITS_DTYPE).reshape(-1, limbs)
+    else:
+        values = _memmap(week_file(sub_dir, 'bin', week, 'val'), VALUES_DTYPE)
+    assert ids.shape[0] == values.shape[0]
+    return ids, values
+
+
+def write_week(sub_dir, fmt, week, addresses, values, book=None):
+    if fmt == 'pkl':
+        df = pd.DataFrame({'address': addresses, 'value': values})
+        df.to_pickle(week_file(sub_dir, 'pkl', week))
+    else:
+        append_bin_week(sub_dir, week, book.ids(addresses), values, mode='wb')
+
+
+def append_bin_week(sub_dir, week, ids, values, mode='ab', days=None):
+    with open(week_file(sub_dir, 'bin', week, 'ids'), mode) as f:
+        np.ascontiguousarray(ids, dtype=IDS_DTYPE).tofile(f)
+    with open(week_file(sub_dir, 'bin', week, 'val'), mode) as f:
+        np.ascontiguousarray(values, dtype=UNITS_DTYPE if np.ndim(values) == 2 else
+                VALUES_DTYPE).tofile(f)
+    if days is not None:
+        with open(week_file(sub_dir, 'bin', week, DAYS_EXT), mode) as f:
+            np.ascontiguousarray(days, dtype=DAYS_DTYPE).tofile(f)
+
+
+def read_split_manifest(dir_):
+    if not os.path.isfile(os.path.join(dir_, SPLIT_MANIFEST)):
+        return None
+    with open(os.path.join(dir_, SPLIT_MANIFEST), 'r') as f:
+        return json.load(f)
+
+
+def write_split_manifest(dir_, manifest):
+    # the manifest is replaced atomically, so it never lists files whose rows are not saved
+    tmp = os.path.join(dir_, SPLIT_MANIFEST + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, os.path.join(dir_, SPLIT_MANIFEST))
+
+
+def begin_split(dir_, sub_dirs, fmt, weeks, files, n_addresses):
+    # records the CSV files FILES (per subfolder) about to be appended to WEEKS weekly partitions
+    # and the sizes of these partitions (bytes of binary files), so that an interrupted split is
+    # rolled back by rollback_split
+    lengths = {}
+    for sd in sub_dirs if fmt == 'bin' else []:
+        lengths[sd] = [[os.path.getsize(week_file(os.path.join(dir_, sd), 'bin', week, ext))
+            if os.path.isfile(week_file(os.path.join(dir_, sd), 'bin', week, ext)) else 0
+            for ext in ['ids', 'val', DAYS_EXT]] for week in range(weeks)]
+    tmp = os.path.join(dir_, SPLIT_PENDING + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump({'format': fmt, 'weeks': weeks, 'addresses': n_addresses, 'files': files,
+            'lengths': lengths}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, os.path.join(dir_, SPLIT_PENDING))
+
+
+def rollback_split(dir_, manifest):
+    # restores weekly partitions and the address book to their state before a split recorded by
+    # begin_split that was interrupted before MANIFEST listed its files, returns True if rolled
+    # back
+    fname = os.path.join(dir_, SPLIT_PENDING)
+    if not os.path.isfile(fname):
+        return False
+    with open(fname, 'r') as f:
+        pending = json.load(f)
+    listed = all(set(files) <= set(manifest['files'].get(sd, []))
+            for sd, files in pending['files'].items())
+    if not listed:
+        fmt = pending['format']
+        for sd in pending['files']:
+            sub_dir = os.path.join(dir_, sd)
+            if not os.path.isdir(os.path.join(sub_dir, fmt)):
+                continue
+            for week in list_weeks(sub_dir, fmt):
+                if week >= pending['weeks']:
+                    for f in os.listdir(os.path.join(sub_dir, fmt)):
+                        if f.split('.')[0] == '{:04d}'.format(week):
+                            os.remove(os.path.join(sub_dir, fmt, f))
+                elif fmt == 'bin':
+                    for ext, length in zip(['ids', 'val', DAYS_EXT], pending['lengths'][sd][week]):
+                        if os.path.isfile(week_file(sub_dir, 'bin', week, ext)):
+                            with open(week_file(sub_dir, 'bin', week, ext), 'r+b') as f:
+                                f.truncate(length)
+                elif os.path.isfile(week_file(sub_dir, 'pkl', week) + BACKUP_EXT):
+                    os.replace(week_file(sub_dir, 'pkl', week) + BACKUP_EXT,
+                            week_file(sub_dir, 'pkl', week))
+        book = AddressBook(dir_)
+        if len(book) > pending['addresses']:
+            book.truncate(pending['addresses'])
+    end_split(dir_, list(pending['files']))
+    return not listed
+
+
+def end_split(dir_, sub_dirs):
+    # removes the record of a split listed by the manifest and the backups of its partitions
+    for sd in sub_dirs:
+        if os.path.isdir(os.path.join(dir_, sd, 'pkl')):
+            for f in os.listdir(os.path.join(dir_, sd, 'pkl')):
+                if f.endswith(BACKUP_EXT):
+                    os.remove(os.path.join(dir_, sd, 'pkl', f))
+    if os.path.isfile(os.path.join(dir_, SPLIT_PENDING)):
+        os.remove(os.path.join(dir_, SPLIT_PENDING))
+
+
+class WeekWriter:
+    # Appends rows to weekly partitions of a sub-directory. Binary partitions are appended to in
+    # place, rows for pickle files are kept until a later week shows up. Weeks without rows are
+    # written as empty partitions. If KEEP_DAYS, days of rows are saved to binary partitions too.
+    # WEEKS partitions written before are appended to. Values are rows of LIMBS limbs if LIMBS
+
+    def __init__(self, sub_dir, fmt, book, keep_days=False, weeks=0, limbs=0):
+        self.sub_dir = sub_dir
+        self.fmt = fmt
+        self.book = book
+        self.keep_days = keep_days
+        self.limbs = limbs
+        self.written = set(range(weeks))
+        self.weeks = weeks
+        self.pending = {}
+        self.rows = 0
+        # the earliest and the latest week with new rows
+        self.first_week = None
+        self.last_week = -1
+        if not os.path.isdir(os.path.join(sub_dir, fmt)):
+            os.makedirs(os.path.join(sub_dir, fmt))
+
+    def append(self, weeks, codes, uniques, values, days=None):
+        # WEEKS, CODES, VALUES and DAYS are row-wise, CODES index UNIQUES (as returned by
+        # read_shard)
+        if not weeks.shape[0]:
+            return
+        if not self.keep_days:
+            days = None
+        if np.any(weeks[1:] < weeks[:-1]):
+            order = np.argsort(weeks, kind='stable')
+            weeks, codes, values = weeks[order], codes[order], values[order]
+            if days is not None:
+                days = days[order]
+        if self.fmt == 'bin':
+            keys = self.book.unique_ids(uniques)[codes]
+        else:
+            keys = np.asarray(uniques, dtype=object)[codes]
+
+        bounds = np.flatnonzero(weeks[1:] != weeks[:-1]) + 1
+        for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, weeks.shape[0]]):
+            self._append(int(weeks[lo]), keys[lo:hi], values[lo:hi],
+                    None if days is None else days[lo:hi])
+        self.rows += weeks.shape[0]
+        self.last_week = max(self.last_week, int(weeks[-1]))
+        self.first_week = int(weeks[0]) if self.first_week is None else \
+                min(self.first_week, int(weeks[0]))
+
+        if self.fmt == 'pkl':
+            for week in [w for w in self.pending if w < weeks[0]]:
+                self._flush(week)
+
+    def _append(self, week, keys, values, days=None):
+        if self.fmt == 'bin':
+            if self.keep_days and days is None:
+                days = np.empty(0, dtype=DAYS_DTYPE)
+            append_bin_week(self.sub_dir, week, keys, values,
+                    mode='ab' if week in self.written else 'wb', days=days)
+            self.written.add(week)
+        else:
+            self.pending.setdefault(week, []).append((keys, values))
+
+    def _flush(self, week):
+        chunks = self.pending.pop(week)
+        df = pd.DataFrame({
+            'address': np.concatenate([c[0] for c in chunks]),
+            'value': np.concatenate([c[1] for c in chunks]),
+            })
+        fname = week_file(self.sub_dir, 'pkl', week)
+        if week in self.written:
+            # partitions written before are kept until the manifest lists the new files (see
+            # rollback_split)
+            if week < self.weeks and not os.path.isfile(fname + BACKUP_EXT):
+                os.replace(fname, fname + BACKUP_EXT)
+            df = pd.concat([pd.read_pickle(fname if os.path.isfile(fname) else
+                fname + BACKUP_EXT), df], ignore_index=True)
+        df.to_pickle(fname + '.tmp')
+        os.replace(fname + '.tmp', fname)
+        self.written.add(week)
+
+    def close(self):
+        for week in list(self.pending):
+            self._flush(week)
+        return self.fill(max(self.last_week + 1, self.weeks, 1))
+
+    def fill(self, n_weeks):
+        # writes empty partitions for the weeks before N_WEEKS without rows, returns N_WEEKS
+        for week in range(n_weeks):
+            if week not in self.written:
+                self._append(week, np.empty(0, dtype=object if self.fmt == 'pkl' else IDS_DTYPE),
+                        np.empty((0, self.limbs), dtype=UNITS_DTYPE) if self.limbs else
+                        np.empty(0, dtype=VALUES_DTYPE))
+                if self.fmt == 'pkl':
+                    self._flush(week)
+        return n_weeks
+
+
+def aggregate_week(sub_dirs, fmt, week, limbs=0):
+    # collapses the week's rows of all sub-directories to one net delta per address (addresses
+    # whose net delta is zero are dropped)
+    if fmt == 'bin':
+        parts = [read_bin_week(sd, week, limbs) for sd in sub_dirs]
+        ids = np.concatenate([p[0] for p in parts])
+        values = np.concatenate([p[1] for p in parts])
+        n_rows = ids.shape[0]
+        if limbs:
+            keys, values = sum_by_id(ids, values)
+            mask = values.any(axis=1)
+            return keys[mask], values[mask], n_rows
+        keys, inverse = np.unique(ids, return_inverse=True)
+        values = np.bincount(inverse.ravel(), weights=values, minlength=keys.shape[0])
+    else:
+        df = pd.concat([read_pkl_week(sd, week)[['address', 'value']] for sd in sub_dirs])
+        n_rows = df.shape[0]
+        df = df.groupby('address', sort=False)['value'].sum()
+        keys, values = df.index.to_numpy(), df.to_numpy()
+    mask = values != 0
+    return keys[mask], values[mask], n_rows
+
+
+def aggregate(dir_, sub_dirs, fmt, verbose=False, first_week=0, limbs=0):
+    # writes pre-aggregated weekly partitions to DIR_/net, returns the number of rows before and
+    # after aggregation. Weeks before FIRST_WEEK are kept if aggregated before
+    sub_dirs = [os.path.join(dir_, sd) for sd in sub_dirs]
+    net_dir = os.path.join(dir_, NET_DIR)
+    if os.path.isdir(net_dir) and not (first_week and os.path.isdir(os.path.join(net_dir, fmt))):
+        shutil.rmtree(net_dir)
+    if not os.path.isdir(os.path.join(net_dir, fmt)):
+        os.makedirs(os.path.join(net_dir, fmt))
+        first_week = 0
+
+    weeks = [w for w in list_weeks(sub_dirs[0], fmt) if w >= first_week]
+    rows_in, rows_out = 0, 0
+    for i, week in enumerate(weeks):
+        if verbose:
+            print(' file {} out of {}'.format(i, len(weeks) - 1), end='\n')
+        keys, values, n_rows = aggregate_week(sub_dirs, fmt, week, limbs)
+        if fmt == 'bin':
+            append_bin_week(net_dir, week, keys, values, mode='wb')
+        else:
+            pd.DataFrame({'address': keys, 'value': values}).to_pickle(
+                    week_file(net_dir, 'pkl', week))
+        rows_in += n_rows
+        rows_out += keys.shape[0]
+    return rows_in, rows_out
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3.9
+
+# This script can be used to query balance histories of addresses from the index built by
+# calc_top_balances.py with --history: either every change of the balances of the given addresses,
+# or their balances at the given dates
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from time import time
+
+from events import CALENDARS, parse_dates
+from history import HISTORY_DIR, BalanceHistory, is_history
+
+
+def main():
+    formatter = lambda prog: argparse.RawTextHelpFormatter(prog, max_help_position=50)
+    parser = argparse.ArgumentParser(
+            description='Queries balance histories of addresses',
+            add_help=False,
+            formatter_class=formatter,
+            )
+
+    # required arguments
+    required_args = parser.add_argument_group('required arguments')
+    required_args.add_argument(
+            '--dir',
+            type=str,
+            required=True,
+            help='Path to parent directory with blockchain historical data',
+            )
+    required_args.add_argument(
+            '--name',
+            type=str,
+            required=True,
+            help='Name of blockchain (also the name of the folder with weekly partitions)',
+            )
+
+    # optimal arguments
+    optional_args = parser.add_argument_group('optional arguments')
+    optional_args.add_argument(
+            '-h',
+            '--help',
+            action='help',
+            help='show this help message and exit',
+            )
+    optional_args.add_argument(
+            '--address',
+            type=str,
+            nargs='+',
+            default=[],
+            help='Addresses to query, defaults to none',
+            )
+    optional_args.add_argument(
+            '--file',
+            type=str,
+            default=None,
+            help='Path to a file with addresses to query (one per line), defaults to None',
+            )
+    optional_args.add_argument(
+            '--dates',
+            type=str,
+            default=None,
+            help='Return balances at the end of the given dates (a comma-separated list or a path '
+                'to a file\nwith one date per line), i.e. at the end of the last week ending on or '
+                'before every date,\ndefaults to None (every change of balances is returned with '
+                'the last day of its week)',
+            )
+    optional_args.add_argument(
+            '--calendar',
+            type=str,
+            choices=list(CALENDARS) + ['dates'],
+            default=None,
+            help='Calendar of the history (given to calc_top_balances.py by --calendar or '
+                '--dates), defaults\nto None (weekly partitions)',
+            )
+    optional_args.add_argument(
+            '--output',
+            type=str,
+            default=None,
+            help='Save the result to the given CSV file, defaults to None (printed to console)',
+            )
+    args = parser.parse_args()
+
+    addresses = list(args.address)
+    if args.file is not None:
+        with open(args.file, 'r') as f:
+            addresses += [line.strip() for line in f if line.strip()]
+    if not addresses:
+        parser.error('no addresses given, use --address or --file')
+
+    PATH = os.path.join(args.dir, args.name, HISTORY_DIR + ('_' + args.calendar if
+        args.calendar else ''))
+    if not is_history(PATH):
+        raise FileNotFoundError('Directory \"{}\" contains no history (run calc_top_balances.py '
+            'with --history)!'.format(PATH))
+
+    start = time()
+    history = BalanceHistory(PATH)
+    ids = history.ids(addresses)
+    for address in np.asarray(addresses, dtype=object)[ids < 0].tolist():
+        print('Address \"{}\" is not in the history'.format(address))
+
+    if args.dates is not None:
+        dates = parse_dates(args.dates)
+        df = pd.DataFrame(history.balances(ids, dates), index=[str(d) for d in dates],
+                columns=addresses)
+    else:
+        frames = []
+        for address, i in zip(addresses, ids.tolist()):
+            dates, balances = history.changes(i)
+            frames.append(pd.DataFrame({'address': address, 'date': [str(d) for d in dates],
+                'balance': balances}))
+        df = pd.concat(frames, ignore_index=True)
+    elapsed = time() - start
+
+    if args.output is not None:
+        df.to_csv(args.output)
+        print('Data saved in {}'.format(args.output))
+    else:
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None,
+                'display.float_format', '{:.8f}'.format):
+            print(df)
+    print('Query time: {:.2f} ms'.format(elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+# This module contains the reader of CSV shards (downloaded from GCS) with columns "block_date",
+# "address" and "value", sorted by date. The multi-threaded pyarrow CSV engine is used if pyarrow
+# is installed, otherwise the data is read by pandas. Shards can also be streamed from any fsspec
+# filesystem (e.g. GCS with gcsfs) without saving them to local disk.
+
+import io
+import os
+import datetime
+import posixpath
+import numpy as np
+import pandas as pd
+from collections import deque
+
+from fixedpoint import parse_units
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pv
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+
+try:
+    import fsspec
+except ImportError:
+    fsspec = None
+
+
+COLUMNS = ['block_date', 'address', 'value']
+
+
+def read_shard(source, limbs=0):
+    # returns dates as days since epoch, addresses factorized to codes and unique addresses, and
+    # values. SOURCE is a path or a file-like object. If LIMBS, values are parsed exactly to rows of
+    # LIMBS limbs in base units (see fixedpoint.py)
+    if pa is not None:
+        table = pv.read_csv(
+                source,
+                read_options=pv.ReadOptions(use_threads=True),
+                convert_options=pv.ConvertOptions(
+                    column_types={
+                        'block_date': pa.date32(),
+                        'address': pa.string(),
+                        'value': pa.string() if limbs else pa.float64(),
+                        },
+                    include_columns=COLUMNS,
+                    ),
+                )
+        days = table.column('block_date').cast(pa.int32()).to_numpy().astype(np.int64)
+        values = parse_units(table.column('value'), limbs) if limbs else \
+                table.column('value').to_numpy()
+        addresses = pc.dictionary_encode(table.column('address')).combine_chunks()
+        codes = addresses.indices.fill_null(-1).to_numpy(zero_copy_only=False).astype(np.int64)
+        uniques = addresses.dictionary.to_pylist()
+    else:
+        df = pd.read_csv(source, usecols=COLUMNS, dtype={'block_date': str, 'address': str,
+            'value': str if limbs else float})
+        days = pd.to_datetime(df['block_date'], format='%Y-%m-%d').to_numpy().\
+                astype('datetime64[D]').astype(np.int64)
+        values = parse_units(df['value'].tolist(), limbs) if limbs else df['value'].to_numpy()
+        codes, uniques = pd.factorize(df['address'].to_numpy())
+        codes = codes.astype(np.int64)
+        uniques = list(uniques)
+
+    # missing addresses are mapped to an empty string
+    if (codes < 0).any():
+        codes = np.where(codes < 0, len(uniques), codes)
+        uniques.append('')
+    return days, codes, uniques, values
+
+
+def to_days(date):
+    return (np.datetime64(date, 'D') - np.datetime64(0, 'D')).astype(np.int64)
+
+
+def week_index(days, start_day):
+    # week k contains the dates in (START + 7 * k, START + 7 * (k + 1)], dates before the start
+    # date belong to the first week
+    return np.maximum((days - start_day - 1) // 7, 0)
+
+
+def first_date(source):
+    # date of the first row of a shard (a path or a file-like object)
+    df = pd.read_csv(source, nrows=1, parse_dates=['block_date'])
+    return df['block_date'].iloc[0]
+
+
+def derive_start_date(first_dates, end_date):
+    # the first date with the weekday of END_DATE after the earliest of FIRST_DATES (dates of
+    # 1970-01-01 and before are ignored), so that the last week ends on END_DATE
+    first_date = min(d for d in first_dates if d > pd.Timestamp(1970, 1, 1))
+    end_weekday = datetime.datetime.strptime(end_date, '%Y-%m-%d').weekday()
+    days_ahead = end_weekday - first_date.weekday()
+    if days_ahead <= 0:
+        days_ahead += 7
+    start_date = first_date + datetime.timedelta(days_ahead)
+    assert start_date.weekday() == end_weekday
+    return start_date
+
+
+def list_remote_shards(url):
+    # returns the fsspec filesystem of URL (e.g. "gs://bucket/bitcoin", "memory://bitcoin") and
+    # sorted paths of shards in every subfolder of URL
+    fs, root = fsspec.core.url_to_fs(url)
+    shards = {}
+    for d in sorted(fs.ls(root, detail=False)):
+        if fs.isdir(d):
+            shards[posixpath.basename(d.rstrip('/'))] = \
+                    list(sorted(p for p in fs.ls(d, detail=False) if fs.isfile(p)))
+    return fs, shards
+
+
+def fetch_shard(task):
+    # reads a shard from a remote filesystem to memory, used by prefetching threads. The shard is
+    # also saved to LAND_PATH if given
+    fs, path, land_path = task
+    with fs.open(path, 'rb') as f:
+        data = f.read()
+    if land_path is not None:
+        with open(land_path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(land_path + '.tmp', land_path)
+    return data
+
+
+def parse_shard(task):
+    # reads a shard (a path or the content of a file) and computes the week of every row, used by
+    # worker processes. Values are parsed to LIMBS limbs if LIMBS (see read_shard)
+    source, start_day, limbs = task
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    days, codes, uniques, values = read_shard(source, limbs)
+    return week_index(days, start_day), codes, uniques, values, days
+
+
+class WeekStream:
+    # rows of the shards of one subfolder, sorted by date, consumed week by week. PARSED yields the
+    # results of parse_shard in the order of files, and the unique addresses of every shard are
+    # mapped once by ENCODE (e.g. to IDs of an address book)
+
+    def __init__(self, parsed, encode):
+        self.parsed = parsed
+        self.encode = encode
+        self.week = 0
+        self.chunk = None
+        self.pos = 0
+        self._next_chunk()
+
+    def _next_chunk(self):
+        self.chunk = None
+        self.pos = 0
+        for weeks, codes, uniques, values, _ in self.parsed:
+            if not weeks.shape[0]:
+                continue
+            if weeks[0] < self.week or (weeks[1:] < weeks[:-1]).any():
+                raise ValueError('Rows of CSV files are not sorted by date, split them with '
+                    'split_csv.py instead!')
+            self.chunk = (weeks, codes, self.encode(uniques), values)
+            return
+
+    def next_week(self):
+        # week of the next row, None if all rows are consumed
+        return None if self.chunk is None else int(self.chunk[0][self.pos])
+
+    def take(self, week):
+        # yields encoded addresses and values of the rows of WEEK, rows of earlier weeks must be
+        # taken before
+        self.week = week
+        while self.chunk is not None and self.chunk[0][self.pos] == week:
+            weeks, codes, encoded, values = self.chunk
+            end = self.pos + int(np.searchsorted(weeks[self.pos:], week, side='right'))
+            yield encoded[codes[self.pos:end]], values[self.pos:end]
+            self.pos = end
+            if end == weeks.shape[0]:
+                self._next_chunk()
+
+
+def ordered_map(pool, func, tasks, window):
+    # like pool.imap, but at most WINDOW tasks are in flight (this bounds the memory taken by
+    # parsed shards waiting to be consumed). Results are yielded in the order of TASKS
+    if pool is None:
+        for task in tasks:
+            yield func(task)
+        return
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
@@ -0,0 +1,214 @@
+# This module contains sketches of the distribution of all balances written by calc_top_balances.py
+# (with --sketch), from which metric.py calculates metrics of the whole population of holders and
+# not only of the top N. A sketch is a histogram of balances in logarithmic buckets (BUCKETS_PER_OCTAVE
+# buckets per doubling of the balance, i.e. 4.4% wide) with the number and the sum of balances in
+# every bucket. It is updated by the engines from the balances changed in a week only: a changed
+# balance is removed from the bucket of its old value and added to the bucket of its new value.
+# Sketches are mergeable (sketches of disjoint sets of addresses are added up), so the sharded mode
+# adds up the sketches of its shards. Negative balances are counted in bucket 0 and ignored by the
+# metrics. Balances that round to zero base units (float dust left by subtraction, e.g. 1e-19 coins)
+# are zero balances, as with --exact (float dust of large balances may still exceed a base unit and
+# count as a holder, balances calculated with --exact have none). Every week is appended to raw
+# binary files ("counts.bin" and "sums.bin") as a row of N_BUCKETS + 1 values, and its date to
+# "dates.txt", so a range of weeks is read with np.memmap.
+
+import os
+import numpy as np
+
+
+SKETCH_DIR = 'sketch'
+COUNTS_FILE = 'counts.bin'
+SUMS_FILE = 'sums.bin'
+DATES_FILE = 'dates.txt'
+# buckets cover balances from 2**MIN_EXP to 2**MAX_EXP (1 wei is about 2**-60), balances out of the
+# range are counted in the first or the last bucket
+BUCKETS_PER_OCTAVE = 16
+MIN_EXP = -64
+MAX_EXP = 48
+N_BUCKETS = (MAX_EXP - MIN_EXP) * BUCKETS_PER_OCTAVE
+
+
+def buckets(values, unit=0.):
+    # bucket of every balance of VALUES (0 for negative balances, -1 for zero balances and balances
+    # smaller than half a base unit UNIT in magnitude)
+    values = np.asarray(values, dtype=float)
+    out = np.zeros(values.shape[0], dtype=np.int64)
+    zero = np.abs(values) < unit / 2 if unit else values == 0
+    positive = (values > 0) & ~zero
+    out[positive] = np.clip(np.floor((np.log2(values[positive]) - MIN_EXP) * BUCKETS_PER_OCTAVE),
+            0, N_BUCKETS - 1) + 1
+    out[zero] = -1
+    return out
+
+
+def lower_edges():
+    # the smallest balance of every bucket (bucket 0 excluded)
+    return 2.0**(MIN_EXP + np.arange(N_BUCKETS) / BUCKETS_PER_OCTAVE)
+
+
+class BalanceSketch:
+
+    def __init__(self, counts=None, sums=None, unit=0.):
+        # UNIT: base unit of balances in coins (1 / scale of values), smaller balances are dust
+        self.counts = counts if counts is not None else np.zeros(N_BUCKETS + 1, dtype=np.int64)
+        self.sums = sums if sums is not None else np.zeros(N_BUCKETS + 1)
+        self.unit = unit
+
+    @classmethod
+    def of(cls, items, unit=0.):
+        # sketch of balances given by ITEMS: arrays of IDs and balances, or an iterable of such
+        # pairs (like nonzero_items() of the engines)
+        sketch = cls(unit=unit)
+        if isinstance(items, tuple):
+            items = [items]
+        for _, values in items:
+            sketch.add(values)
+        return sketch
+
+    def add(self, values, sign=1):
+        values = np.asarray(values, dtype=float)
+        b = buckets(values, self.unit)
+        keep = b >= 0
+        self.counts += sign * np.bincount(b[keep], minlength=N_BUCKETS + 1)
+        self.sums += sign * np.bincount(b[keep], weights=values[keep], minlength=N_BUCKETS + 1)
+
+    def update(self, old, new):
+        # balances changed from OLD to NEW
+        self.add(old, -1)
+        self.add(new)
+        # rounding errors do not stay in empty buckets
+        self.sums[self.counts == 0] = 0
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.sums += other.sums
+        return self
+
+    def copy(self):
+        return BalanceSketch(self.counts.copy(), self.sums.copy(), self.unit)
+
+
+class SketchStore:
+    # weekly sketches in PATH, appended like the weekly top balances of TopStore
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.dates = []
+        if os.path.isfile(os.path.join(path, DATES_FILE)):
+            with open(os.path.join(path, DATES_FILE), 'r') as f:
+                self.dates = f.read().split()
+        row = (N_BUCKETS + 1) * 8
+        self.weeks = min([len(self.dates)] + [os.path.getsize(os.path.join(path, f)) // row
+            if os.path.isfile(os.path.join(path, f)) else 0 for f in [COUNTS_FILE, SUMS_FILE]])
+        self.files = None
+
+    def __len__(self):
+        return self.weeks
+
+    def truncate(self, weeks):
+        # weeks after WEEKS are removed (e.g. weeks calculated after the last saved balances)
+        self.close()
+        self.weeks = min(self.weeks, weeks)
+        self.dates = self.dates[:self.weeks]
+        for fname in [COUNTS_FILE, SUMS_FILE]:
+            with open(os.path.join(self.path, fname), 'ab') as f:
+                f.truncate(self.weeks * (N_BUCKETS + 1) * 8)
+        with open(os.path.join(self.path, DATES_FILE), 'w') as f:
+            f.write(''.join(d + '\n' for d in self.dates))
+
+    def append(self, date, sketch):
+        if self.files is None:
+            self.truncate(self.weeks)
+            self.files = [open(os.path.join(self.path, f), 'ab') for f in [COUNTS_FILE, SUMS_FILE]] \
+                    + [open(os.path.join(self.path, DATES_FILE), 'a')]
+        sketch.counts.astype(np.int64).tofile(self.files[0])
+        sketch.sums.astype(np.float64).tofile(self.files[1])
+        self.files[2].write(date + '\n')
+        self.dates.append(date)
+        self.weeks += 1
+
+    def flush(self):
+        if self.files is not None:
+            for f in self.files:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def close(self):
+        if self.files is not None:
+            self.flush()
+            for f in self.files:
+                f.close()
+            self.files = None
+
+    def read(self, lo=0, hi=None):
+        # dates and (weeks, N_BUCKETS + 1) counts and sums of weeks LO to HI (memory-mapped)
+        hi = self.weeks if hi is None else min(hi, self.weeks)
+        dates = np.array(self.dates[lo:hi], dtype='datetime64[D]')
+        if not self.weeks:
+            empty = np.zeros((0, N_BUCKETS + 1))
+            return dates, empty.astype(np.int64), empty
+        shape = (self.weeks, N_BUCKETS + 1)
+        counts = np.memmap(os.path.join(self.path, COUNTS_FILE), dtype=np.int64, mode='r',
+                shape=shape)
+        sums = np.memmap(os.path.join(self.path, SUMS_FILE), dtype=np.float64, mode='r',
+                shape=shape)
+        return dates, counts[lo:hi], sums[lo:hi]
+
+
+def is_sketch_store(path):
+    return os.path.isfile(os.path.join(path, DATES_FILE)) and \
+            os.path.isfile(os.path.join(path, COUNTS_FILE))
+
+
+# metrics of all holders (balances above zero) for every week of (weeks, N_BUCKETS + 1) counts
+# and sums, balances of a bucket are taken to be equal to their mean (the error of the Gini
+# coefficient is at most the relative width of a bucket)
+def population_gini(counts, sums):
+    c = np.asarray(counts[:, 1:], dtype=float)
+    s = np.asarray(sums[:, 1:])
+    n, total = c.sum(axis=1), s.sum(axis=1)
+    # area under the Lorenz curve, from the poorest bucket to the richest one
+    below = np.cumsum(s, axis=1) - s
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1 - (c * (2 * below + s)).sum(axis=1) / (n * total)
+
+
+def population_nakamoto(counts, sums):
+    # the smallest number of holders owning more than a half of all balances
+    c = np.asarray(counts[:, :0:-1], dtype=float)
+    s = np.asarray(sums[:, :0:-1])
+    above = np.cumsum(s, axis=1) > 0.5 * s.sum(axis=1, keepdims=True)
+    b = above.argmax(axis=1)
+    rows = np.arange(c.shape[0])
+    # holders of richer buckets and as many holders of bucket B as the rest of the half needs
+    holders = np.cumsum(c, axis=1)[rows, b] - c[rows, b]
+    missing = 0.5 * s.sum(axis=1) - (np.cumsum(s, axis=1)[rows, b] - s[rows, b])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        holders += np.floor(missing / (s[rows, b] / c[rows, b])) + 1
+    return np.where(above.any(axis=1), holders, np.nan)
+
+
+def holders_above(counts, sums, threshold):
+    # number of holders with balances of at least THRESHOLD, balances are spread uniformly on the
+    # log scale in the bucket of THRESHOLD
+    x = (np.log2(threshold) - MIN_EXP) * BUCKETS_PER_OCTAVE
+    b = int(np.clip(np.floor(x), 0, N_BUCKETS - 1))
+    frac = np.clip(x - b, 0, 1)
+    c = np.asarray(counts, dtype=float)
+    return c[:, b + 2:].sum(axis=1) + c[:, b + 1] * (1 - frac)
+
+
+def top_share(counts, sums, fraction):
+    # share of all balances owned by the richest FRACTION of holders
+    c = np.asarray(counts[:, :0:-1], dtype=float)
+    s = np.asarray(sums[:, :0:-1])
+    k = fraction * c.sum(axis=1)
+    cum_c = np.cumsum(c, axis=1)
+    b = np.minimum((cum_c < k[:, None]).sum(axis=1), c.shape[1] - 1)
+    rows = np.arange(c.shape[0])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        owned = np.cumsum(s, axis=1)[rows, b] - s[rows, b] + \
+                (k - (cum_c[rows, b] - c[rows, b])) * s[rows, b] / c[rows, b]
+        return np.nan_to_num(owned) / s.sum(axis=1)
@@ -1,24 +1,37 @@
 #!/usr/bin/env python3.9
 
-# This script can be used to split CSV files downloaded from GCS by weekly data saved into pickle files.
-# The resulting pickle files can then be processed by script calc_top_balances.py
+# This script can be used to split CSV files downloaded from GCS by weekly data saved into binary or
+# pickle files. The resulting files can then be processed by script calc_top_balances.py
 #
 # Author:  Roman Overko
 # Contact: roman.overko@iota.org
 # Date:    February 08, 2022
 
 import os
+import shutil
 import argparse
+import posixpath
 import datetime
-import pandas as pd
 from time import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from engines import value_scale
+from events import EVENTS_DIR, build_events
+from fixedpoint import value_limbs
+from partitions import FORMATS, NET_DIR, SPLIT_MANIFEST, AddressBook, WeekWriter, aggregate, \
+        begin_split, end_split, list_sub_dirs, read_split_manifest, rollback_split, \
+        write_split_manifest
+from shards import derive_start_date, fetch_shard, first_date, fsspec, list_remote_shards, \
+        ordered_map, parse_shard, to_days
+from telemetry import Profiler, Telemetry
 
 
 def main():
     formatter = lambda prog: argparse.RawTextHelpFormatter(prog, max_help_position=50)
     parser = argparse.ArgumentParser(
             description='Converts and splits CSV files (downloaded from GCS) to weekly data saved in '
-                'pickle files',
+                'binary or pickle files',
             add_help=False,
             formatter_class=formatter,
             )
@@ -64,94 +77,301 @@ def main():
             default=False,
             help='Print detailed output to console, defaults to False'
             )
+    optional_args.add_argument(
+            '--format',
+            type=str,
+            choices=FORMATS,
+            default='bin',
+            help='Format of weekly partitions: \'bin\' saves dense address IDs and values to raw '
+                'binary files\nthat are memory-mapped by calc_top_balances.py, \'pkl\' saves '
+                'pickled DataFrames, defaults to bin',
+            )
+    optional_args.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of worker processes parsing CSV files in parallel, defaults to 1',
+            )
+    optional_args.add_argument(
+            '--aggregate',
+            action='store_true',
+            default=False,
+            help='Collapse each week to one net delta per address across all subfolders and save '
+                'it\nto folder \"{}\" (used by calc_top_balances.py instead of subfolders), '
+                'defaults to False'.format(NET_DIR),
+            )
+    optional_args.add_argument(
+            '--events',
+            action='store_true',
+            default=False,
+            help='Also save rows of all subfolders sorted by date with an index of days to folder '
+                '\"{}\"\n(used by calc_top_balances.py with --calendar or --dates, binary format '
+                'only), defaults to False'.format(EVENTS_DIR),
+            )
+    optional_args.add_argument(
+            '--exact',
+            action='store_true',
+            default=False,
+            help='Save values as exact integers in base units (satoshi or wei) instead of floats, '
+                'for\ncalc_top_balances.py with --exact (binary format only), defaults to False',
+            )
+    optional_args.add_argument(
+            '--incremental',
+            action='store_true',
+            default=False,
+            help='Split only CSV files that are not listed in the manifest \"{}\" of files split '
+                'before,\nappending their rows to existing weekly partitions, defaults to '
+                'False'.format(SPLIT_MANIFEST),
+            )
+    optional_args.add_argument(
+            '--source',
+            type=str,
+            default=None,
+            help='URL of a folder with subfolders of CSV files to stream instead of local CSV files '
+                '(e.g.\n\"gs://blockchain_historical_data/bitcoin\", requires fsspec and a '
+                'filesystem driver such as\ngcsfs), defaults to None',
+            )
+    optional_args.add_argument(
+            '--prefetch',
+            type=int,
+            default=4,
+            help='Number of CSV files downloaded concurrently ahead of parsing (with --source), '
+                'defaults to 4',
+            )
+    optional_args.add_argument(
+            '--land',
+            action='store_true',
+            default=False,
+            help='Also save streamed CSV files to local subfolders (with --source), defaults to '
+                'False',
+            )
+    optional_args.add_argument(
+            '--telemetry',
+            type=str,
+            default=None,
+            help='Append a JSON line per CSV file with time per stage, rows/s, the number of '
+                'addresses and\nRSS to the given file, defaults to None (disabled)',
+            )
+    optional_args.add_argument(
+            '--profile',
+            type=str,
+            default=None,
+            help='Profile the main loop by cProfile and save statistics to the given file (worker '
+                'processes\nare not profiled), defaults to None',
+            )
     args = parser.parse_args()
+    if args.events and args.format != 'bin':
+        parser.error('--events requires --format bin')
+    if args.exact and args.format != 'bin':
+        parser.error('--exact requires --format bin')
+    if args.source and fsspec is None:
+        parser.error('--source requires fsspec')
     
     DIR = os.path.join(args.dir, args.name)
-    if not os.path.isdir(DIR):
-        raise FileNotFoundError('Directory \"{}\" does not exist!'.format(DIR))
+    # number of int64 limbs of exact values (0 for floats)
+    LIMBS = value_limbs(value_scale(args.name)) if args.exact else 0
+    # paths of CSV files in every subfolder, on a remote filesystem FS if streamed
+    if args.source:
+        FS, SHARDS = list_remote_shards(args.source)
+        if not os.path.isdir(DIR):
+            os.makedirs(DIR)
+    else:
+        if not os.path.isdir(DIR):
+            raise FileNotFoundError('Directory \"{}\" does not exist!'.format(DIR))
+        FS = None
+        SHARDS = {sd: [os.path.join(DIR, sd, 'csv', f) for f in
+            sorted(os.listdir(os.path.join(DIR, sd, 'csv')))
+            if os.path.isfile(os.path.join(DIR, sd, 'csv', f))]
+            for sd in list_sub_dirs(DIR) if os.path.isdir(os.path.join(DIR, sd, 'csv'))}
 
-    SUB_DIRS = [d for d in os.listdir(DIR) if os.path.isdir(os.path.join(DIR, d))]
+    SUB_DIRS = list(SHARDS)
     if not SUB_DIRS:
-        raise FileNotFoundError('Directory \"{}\" contains no subfolders!'.format(DIR))
+        raise FileNotFoundError('Directory \"{}\" contains no subfolders!'.format(
+            args.source or DIR))
     
-    first_dates = []
-    for sd in SUB_DIRS:
-        sub_dir = os.path.join(DIR, sd, 'csv')
-        # csv_files = [f for f in os.listdir(sub_dir) if f[-3:] == 'csv']
-        csv_files = os.listdir(sub_dir)
-        if not csv_files:
-            raise FileNotFoundError('Directory \"{}\" contains no CSV files!'.format(sub_dir))
-        csv_files = list(sorted(csv_files))
-        
-        df = pd.read_csv(os.path.join(sub_dir, csv_files[0]), nrows=1, parse_dates=['block_date'])
-        first_date = df['block_date'].iloc[0]
-        if first_date > pd.Timestamp(1970, 1, 1):
-            first_dates.append(first_date)
-        del df
-
-    first_date = min(first_dates)
-    END_WEEKDAY = datetime.datetime.strptime(args.end_date, '%Y-%m-%d').weekday()
-    DELTA = datetime.timedelta(weeks=1)
-    
-    days_ahead = END_WEEKDAY - first_date.weekday()
-    if days_ahead <= 0:
-        days_ahead += 7
-    START_DATE = first_date + datetime.timedelta(days_ahead)
-    assert START_DATE.weekday() == END_WEEKDAY
-    print('Use \"{}\" as start_date for calc_top_balances.py'.\
-            format(datetime.datetime.strftime(START_DATE, '%Y-%m-%d')))
-    # print(first_dates)
-    # exit()
+    # CSV files split before are skipped in the incremental mode
+    MANIFEST = read_split_manifest(DIR) if args.incremental else None
+    if MANIFEST is not None:
+        if MANIFEST['format'] != args.format or (args.events and not MANIFEST['days']) or \
+                MANIFEST.get('limbs', 0) != LIMBS:
+            raise ValueError('Weekly partitions in \"{}\" were split with other options, split all '
+                'files again without --incremental!'.format(DIR))
+        # rows of files that an interrupted run appended are removed, the files are split again
+        if rollback_split(DIR, MANIFEST):
+            print('Rolled back an interrupted split of files not listed in \"{}\"'.format(
+                SPLIT_MANIFEST))
+        START_DATE = datetime.datetime.strptime(MANIFEST['start_date'], '%Y-%m-%d')
+        print('Splitting new files only, use \"{}\" as start_date for calc_top_balances.py'.\
+                format(MANIFEST['start_date']))
+    else:
+        first_dates = []
+        for sd in SUB_DIRS:
+            if not SHARDS[sd]:
+                raise FileNotFoundError('Directory \"{}\" contains no CSV files!'.format(sd))
+            
+            with (FS.open(SHARDS[sd][0], 'rb') if FS else open(SHARDS[sd][0], 'rb')) as f:
+                first_dates.append(first_date(f))
+
+        START_DATE = derive_start_date(first_dates, args.end_date)
+        print('Use \"{}\" as start_date for calc_top_balances.py'.\
+                format(datetime.datetime.strftime(START_DATE, '%Y-%m-%d')))
     
+        # files split before are not listed anymore, and neither is an interrupted split
+        if os.path.isfile(os.path.join(DIR, SPLIT_MANIFEST)):
+            os.remove(os.path.join(DIR, SPLIT_MANIFEST))
+        end_split(DIR, SUB_DIRS)
+        if args.format == 'bin':
+            AddressBook(DIR).clear()
+        # pre-aggregated weeks and events are not valid anymore
+        for d in [NET_DIR, EVENTS_DIR]:
+            if os.path.isdir(os.path.join(DIR, d)):
+                shutil.rmtree(os.path.join(DIR, d))
+        MANIFEST = {
+                'format': args.format,
+                'start_date': datetime.datetime.strftime(START_DATE, '%Y-%m-%d'),
+                'days': args.events,
+                'limbs': LIMBS,
+                'weeks': 0,
+                'rows': 0,
+                'files': {},
+                }
+    book = AddressBook(DIR)
+    N_WEEKS = MANIFEST['weeks']
+    # the event store and net deltas built before are updated as well
+    EVENTS = args.events or MANIFEST['days']
+    AGGREGATE = args.aggregate or (N_WEEKS > 0 and os.path.isdir(os.path.join(DIR, NET_DIR)))
+    CSV_FILES = {sd: [p for p in SHARDS[sd] if
+        posixpath.basename(p) not in set(MANIFEST['files'].get(sd, []))] for sd in SUB_DIRS}
+
+    START_DAY = to_days(START_DATE)
+    total_rows_counter = 0
+    if N_WEEKS:
+        # sizes of partitions are recorded before appending to them, until the manifest lists the
+        # new files
+        begin_split(DIR, SUB_DIRS, args.format, N_WEEKS, {sd: [posixpath.basename(p)
+            for p in CSV_FILES[sd]] for sd in SUB_DIRS}, len(book))
+
+    # CSV files are parsed by worker processes, but their rows are routed to weekly partitions in
+    # the order of files, so the partitions do not depend on the order in which workers finish
+    if FS is not None:
+        # files are downloaded by threads at most PREFETCH files ahead of parsing
+        for sd in SUB_DIRS:
+            if args.land and not os.path.isdir(os.path.join(DIR, sd, 'csv')):
+                os.makedirs(os.path.join(DIR, sd, 'csv'))
+        fetch_pool = ThreadPool(args.prefetch)
+        fetched = ordered_map(fetch_pool, fetch_shard, ((FS, p, os.path.join(DIR, sd, 'csv',
+            posixpath.basename(p)) if args.land else None) for sd in SUB_DIRS
+            for p in CSV_FILES[sd]), args.prefetch)
+        tasks = ((data, START_DAY, LIMBS) for data in fetched)
+    else:
+        tasks = [(p, START_DAY, LIMBS) for sd in SUB_DIRS for p in CSV_FILES[sd]]
+    pool = Pool(args.workers) if args.workers > 1 else None
+    parsed = ordered_map(pool, parse_shard, tasks, 2 * args.workers)
+
     start = time()
+    TELEMETRY = Telemetry(args.telemetry, script='split_csv', name=args.name, format=args.format,
+            workers=args.workers)
+    PROFILER = Profiler(args.profile)
+    PROFILER.start()
+    writers = []
+    n_weeks = N_WEEKS
     for sd in SUB_DIRS:
-        date = START_DATE + DELTA
         csv_rows_counter = 0
-        pkl_rows_counter = 0
-        week_counter = 0
-        to_save_df = pd.DataFrame()
         
         sub_dir = os.path.join(DIR, sd)
         # csv_files = [f for f in os.listdir(sub_dir) if f[-3:] == 'csv']
-        csv_files = os.listdir(os.path.join(sub_dir, 'csv'))
-        csv_files = list(sorted(csv_files))
+        csv_files = CSV_FILES[sd]
         n_files = len(csv_files)
 
-        if not os.path.isdir(os.path.join(sub_dir, 'pkl')):
-            os.makedirs(os.path.join(sub_dir, 'pkl'))
+        writer = WeekWriter(sub_dir, args.format, book, keep_days=MANIFEST['days'],
+                weeks=N_WEEKS, limbs=LIMBS)
 
         print('Converting data in \"{}\"...'.format(sub_dir))
-        for i, file_ in enumerate(csv_files):
+        for i, fname in enumerate(csv_files):
             if args.verbose:
                 print(' file {} out of {}'.format(i, n_files - 1), end='\n')
         
-            fname = os.path.join(sub_dir, 'csv', file_)
-            df = pd.read_csv(fname, dtype={'value': float}, parse_dates=['block_date'])
-            csv_rows_counter += df.shape[0]
-            
-            to_save_df = pd.concat([to_save_df, df[df['block_date'] <= date][['address', 'value']]])
-            remain_df = df[df['block_date'] > date]
-        
-            while not remain_df.empty:
-                to_save_df.to_pickle(os.path.join(sub_dir, 'pkl', '{:04d}.pkl'.format(week_counter)))
-                pkl_rows_counter += to_save_df.shape[0]
-                week_counter += 1
-                date += DELTA
-        
-                df = remain_df
-                to_save_df = df[df['block_date'] <= date][['address', 'value']]
-                remain_df = df[df['block_date'] > date]
+            weeks, codes, uniques, values, days = next(parsed)
+            # time waiting for workers (and downloads) to parse the file
+            TELEMETRY.lap('parse')
+            csv_rows_counter += weeks.shape[0]
+            writer.append(weeks, codes, uniques, values, days)
+            TELEMETRY.lap('write')
+            TELEMETRY.record('file', weeks.shape[0], len(book), sub_dir=sd,
+                    file=posixpath.basename(fname))
         
-            if args.rm:
-                os.remove(fname)
-        
-        to_save_df.to_pickle(os.path.join(sub_dir, 'pkl', '{:04d}.pkl'.format(week_counter)))
-        pkl_rows_counter += to_save_df.shape[0]
+        writers.append(writer)
+        n_weeks = max(n_weeks, writer.close())
+        pkl_rows_counter = writer.rows
         assert pkl_rows_counter == csv_rows_counter
+        total_rows_counter += csv_rows_counter
+        book.save()
+        TELEMETRY.lap('save')
+        TELEMETRY.record('sub_dir', addresses=len(book), sub_dir=sd, sub_dir_rows=csv_rows_counter)
+    PROFILER.stop()
     
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if FS is not None:
+        fetch_pool.close()
+        fetch_pool.join()
+    # all subfolders get the same number of weeks
+    for writer in writers:
+        writer.fill(n_weeks)
+
+    # weeks before the earliest week with new rows are not changed. The last week with rows of
+    # any subfolder may still get new rows (from the next CSV files), so it is the open week
+    first_weeks = [w.first_week for w in writers if w.first_week is not None]
+    FIRST_NEW_WEEK = min(first_weeks) if first_weeks else n_weeks
+    last_weeks = MANIFEST.get('last_weeks', {})
+    for sd, writer in zip(SUB_DIRS, writers):
+        MANIFEST['files'][sd] = MANIFEST['files'].get(sd, []) + \
+                [posixpath.basename(p) for p in CSV_FILES[sd]]
+        last_weeks[sd] = max(last_weeks.get(sd, 0), writer.last_week)
+    MANIFEST['weeks'] = n_weeks
+    MANIFEST['first_new_week'] = FIRST_NEW_WEEK
+    MANIFEST['last_weeks'] = last_weeks
+    MANIFEST['open_week'] = min(last_weeks.values())
+    MANIFEST['rows'] += total_rows_counter
+    write_split_manifest(DIR, MANIFEST)
+    end_split(DIR, SUB_DIRS)
+    # CSV files are removed only when the manifest lists them
+    if args.rm and FS is None:
+        for sd in SUB_DIRS:
+            for fname in CSV_FILES[sd]:
+                os.remove(fname)
+    TELEMETRY.lap('manifest')
+    if N_WEEKS:
+        print('Split {} new rows, weeks from {} on have changed'.format(total_rows_counter,
+            FIRST_NEW_WEEK))
+
+    if EVENTS:
+        print('Building event store in \"{}\"...'.format(os.path.join(DIR, EVENTS_DIR)))
+        n_events = build_events(DIR, SUB_DIRS, args.verbose, LIMBS,
+                FIRST_NEW_WEEK if N_WEEKS else 0)
+        if n_events != MANIFEST['rows']:
+            # events of an earlier split are missing (e.g. it was interrupted before the store
+            # was updated), the store is built again from all weeks
+            print('Event store does not match the manifest, building it from all weeks...')
+            n_events = build_events(DIR, SUB_DIRS, args.verbose, LIMBS)
+        assert n_events == MANIFEST['rows']
+        TELEMETRY.lap('events')
+    if AGGREGATE:
+        print('Aggregating weekly net deltas in \"{}\"...'.format(os.path.join(DIR, NET_DIR)))
+        rows_in, rows_out = aggregate(DIR, SUB_DIRS, args.format, args.verbose,
+                FIRST_NEW_WEEK if N_WEEKS else 0, LIMBS)
+        print('Aggregated {} rows to {} rows ({:.1f}x fewer)'.format(rows_in, rows_out,
+            rows_in / max(rows_out, 1)))
+        TELEMETRY.lap('aggregate')
+    TELEMETRY.record('done', addresses=len(book), weeks=n_weeks, total_rows=total_rows_counter,
+            start_date=MANIFEST['start_date'], elapsed=time() - start)
+    TELEMETRY.close()
+
     print(' ' * 50, end='\n')
     print('Converting done!')
     print('Elapsed time: {:.4f} s'.format(time() - start))
+    print('Throughput: {:.0f} rows/s'.format(total_rows_counter / (time() - start)))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,111 @@
+# This module contains the instrumentation of the hot loops of split_csv.py and
+# calc_top_balances.py. Time spent in every stage of a step (a CSV file or a week) is accumulated
+# by laps of a monotonic clock, and each step is written as one JSON line with the number of rows,
+# rows/s, the number of live addresses and the resident memory of the process. When no telemetry
+# file is given, every call returns immediately. The hot loop can also be profiled by cProfile.
+
+import os
+import json
+import cProfile
+from time import time, perf_counter
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _proc_status(field):
+    # a field of /proc/self/status in bytes (Linux only)
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+    raise ValueError(field)
+
+
+def rss():
+    # resident set size of the process in bytes (the peak RSS if the current one is unknown)
+    try:
+        return _proc_status('VmRSS')
+    except (OSError, ValueError):
+        return peak_rss()
+
+
+def peak_rss():
+    # peak resident set size of the process in bytes. The peak of /proc is reset by exec, so unlike
+    # getrusage it does not include the memory of the parent process before starting the script
+    try:
+        return _proc_status('VmHWM')
+    except (OSError, ValueError):
+        pass
+    if resource is None:
+        return 0
+    # kilobytes on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * \
+            (1 if os.uname().sysname == 'Darwin' else 1024)
+
+
+class Telemetry:
+
+    def __init__(self, fname=None, **context):
+        # CONTEXT (e.g. the script and the blockchain) is added to every record
+        self.enabled = fname is not None
+        self.file = open(fname, 'a') if self.enabled else None
+        self.context = context
+        self.stages = {}
+        self.start = self.last = perf_counter()
+
+    def lap(self, stage):
+        # adds the time since the previous lap (or record) to STAGE
+        if not self.enabled:
+            return
+        now = perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.) + now - self.last
+        self.last = now
+
+    def record(self, event, rows=0, addresses=None, **fields):
+        # writes a record of the step finished since the previous record
+        if not self.enabled:
+            return
+        now = perf_counter()
+        seconds = now - self.start
+        record = dict(self.context)
+        record.update({
+                'event': event,
+                'time': time(),
+                'seconds': seconds,
+                'rows': int(rows),
+                'rows_per_s': rows / seconds if rows and seconds > 0 else None,
+                'addresses': addresses,
+                'rss': rss(),
+                'peak_rss': peak_rss(),
+                'stages': self.stages,
+                })
+        record.update(fields)
+        self.file.write(json.dumps(record) + '\n')
+        self.stages = {}
+        self.start = self.last = now
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class Profiler:
+    # profiles the hot loop by cProfile and saves statistics to FNAME (read them by pstats or
+    # snakeviz), only the calling process is profiled
+
+    def __init__(self, fname=None):
+        self.fname = fname
+        self.profiler = cProfile.Profile() if fname is not None else None
+
+    def start(self):
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.fname)
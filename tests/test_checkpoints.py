@@ -0,0 +1,78 @@
+import numpy as np
+
+from checkpoints import Checkpoint
+from engines import ArrayBalances, DiskBalances
+from fixedpoint import from_ints, to_ints
+
+
+SCALE = 10**8
+
+
+def random_weeks(rng, n_weeks=25, rows=300, n_ids=2000):
+    weeks = []
+    for w in range(n_weeks):
+        ids = rng.integers(0, min(n_ids, 100 * (w + 1)), size=rows)
+        values = rng.integers(-10**9, 10**9, size=rows)
+        weeks.append((ids, values))
+    return weeks
+
+
+def test_resume(tmp_path):
+    rng = np.random.default_rng(0)
+    weeks = random_weeks(rng)
+    for engine in [ArrayBalances, DiskBalances]:
+        def make():
+            if engine is DiskBalances:
+                return DiskBalances(SCALE, path=str(tmp_path / 'store'), block=256)
+            return ArrayBalances(SCALE)
+        path = str(tmp_path / engine.__name__)
+        full = make()
+        for ids, values in weeks:
+            full.update_ids(ids, values.astype(float))
+        expected = full.nonzero_items() if engine is ArrayBalances else None
+        expected_values = np.sort(full.nonzero())
+        full.close()
+
+        # balances are saved every 3 weeks, with a new base snapshot after 2 deltas
+        balances = make()
+        checkpoint = Checkpoint(path, base_every=2)
+        for i, (ids, values) in enumerate(weeks[:20]):
+            balances.update_ids(ids, values.astype(float))
+            if not (i + 1) % 3:
+                checkpoint.save(balances, i + 1)
+        balances.close()
+
+        checkpoint = Checkpoint(path, base_every=2)
+        assert checkpoint.weeks == 18
+        balances = make()
+        checkpoint.restore(balances)
+        for ids, values in weeks[checkpoint.weeks:]:
+            balances.update_ids(ids, values.astype(float))
+        np.testing.assert_array_equal(np.sort(balances.nonzero()), expected_values)
+        if expected is not None:
+            np.testing.assert_array_equal(balances.nonzero_items()[0], expected[0])
+        balances.close()
+
+
+def test_resume_exact(tmp_path):
+    rng = np.random.default_rng(1)
+    weeks = [(ids, from_ints([int(v) * 10**12 for v in values], 3))
+            for ids, values in random_weeks(rng)]
+    full = ArrayBalances(10**18, limbs=3)
+    for ids, units in weeks:
+        full.update_ids(ids, units)
+
+    balances = ArrayBalances(10**18, limbs=3)
+    checkpoint = Checkpoint(str(tmp_path), base_every=1)
+    for i, (ids, units) in enumerate(weeks[:15]):
+        balances.update_ids(ids, units)
+        if not (i + 1) % 4:
+            checkpoint.save(balances, i + 1)
+    balances = ArrayBalances(10**18, limbs=3)
+    Checkpoint(str(tmp_path)).restore(balances)
+    for ids, units in weeks[12:]:
+        balances.update_ids(ids, units)
+    ids, units = balances.nonzero_items(units=True)
+    expected_ids, expected_units = full.nonzero_items(units=True)
+    assert ids.tolist() == expected_ids.tolist()
+    assert to_ints(units) == to_ints(expected_units)
@@ -0,0 +1,85 @@
+import numpy as np
+
+from engines import ArrayBalances, DictBalances, DiskBalances, TopK
+from fixedpoint import from_ints, to_ints
+
+
+SCALE = 10**8
+
+
+def random_weeks(rng, n_weeks=30, rows=500, n_addresses=300):
+    # addresses and values in base units of every week, with more debits than credits in later
+    # weeks so that balances return to zero
+    weeks = []
+    for w in range(n_weeks):
+        addresses = np.array(['addr{}'.format(a) for a in rng.zipf(1.3, size=rows) % n_addresses],
+                dtype=object)
+        values = rng.integers(-10**9, 10**9, size=rows).astype(float)
+        if w % 3 == 2:
+            values = -np.abs(values)
+        weeks.append((addresses, values))
+    return weeks
+
+
+def test_engines_agree(tmp_path):
+    rng = np.random.default_rng(0)
+    engines = [DictBalances(SCALE), ArrayBalances(SCALE),
+            DiskBalances(SCALE, path=str(tmp_path), memory_budget=9 * 64, block=64)]
+    for addresses, values in random_weeks(rng):
+        for balances in engines:
+            balances.update(addresses, values)
+        tops = [balances.top(50) for balances in engines]
+        # row order is kept by all engines, so balances are bitwise identical
+        assert tops[0] == tops[1] == tops[2]
+        assert sorted(engines[0].nonzero()) == sorted(engines[1].nonzero().tolist()) == \
+                sorted(engines[2].nonzero().tolist())
+    for balances in engines:
+        balances.close()
+
+
+def test_exact_engines_agree():
+    rng = np.random.default_rng(1)
+    limbs = 3
+    engines = [DictBalances(10**18, limbs=limbs), ArrayBalances(10**18, limbs=limbs)]
+    totals = {}
+    for addresses, values in random_weeks(rng, n_weeks=10):
+        ints = [int(v) * 10**12 + 1 for v in values]
+        for balances in engines:
+            balances.update(addresses, from_ints(ints, limbs))
+        for a, v in zip(addresses, ints):
+            totals[a] = totals.get(a, 0) + v
+        assert engines[0].top(20) == engines[1].top(20)
+    ids, units = engines[1].nonzero_items(units=True)
+    book = engines[1].book
+    assert dict(zip(book.lookup(ids), to_ints(units))) == {a: v for a, v in totals.items() if v}
+
+
+def test_topk_matches_full_sort():
+    rng = np.random.default_rng(2)
+    n, k = 5000, 100
+    values = np.zeros(n)
+    topk = TopK(k, reserve=20)
+    for week in range(60):
+        changed = rng.integers(0, n, size=rng.integers(1, 400))
+        values[changed] += rng.normal(0, 10, size=changed.shape[0])
+        if week % 7 == 6:
+            # large holders leave, so the top-K has to be rebuilt
+            top = np.argsort(values)[-k:]
+            values[top[:-k // 10]] = 0
+            changed = np.concatenate([changed, top])
+        ids, top_values = topk.update(values, changed)
+        expected = np.sort(values[values != 0])[::-1][:k]
+        assert top_values.tolist() == expected.tolist()
+        assert (values[ids] == top_values).all()
+    assert topk.rebuilds > 1
+
+
+def test_array_top_items():
+    rng = np.random.default_rng(3)
+    balances = ArrayBalances(SCALE)
+    for addresses, values in random_weeks(rng):
+        balances.update(addresses, values)
+        ids, top = balances.top_items(30)
+        expected = np.sort(balances.nonzero())[::-1][:30]
+        assert top.tolist() == expected.tolist()
+        assert (balances.values[ids] == top).all()
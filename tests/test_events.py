@@ -0,0 +1,86 @@
+import os
+import sys
+import json
+import shutil
+import subprocess
+
+import pytest
+
+from events import EVENTS_DIR, META_FILE
+
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NAME = 'btc_test'
+
+
+def run(script, *args):
+    return subprocess.run([sys.executable, os.path.join(HERE, script)] + list(args), check=True,
+            stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+
+@pytest.fixture(scope='module')
+def chain(tmp_path_factory):
+    dir_ = str(tmp_path_factory.mktemp('chain'))
+    run('gen_chain.py', '--dir', dir_, '--name', NAME, '--weeks', '20', '--rows_per_week', '2000',
+            '--addresses', '500', '--seed', '1', '--rows_per_file', '5000')
+    return dir_
+
+
+def read_store(dir_):
+    path = os.path.join(dir_, NAME, EVENTS_DIR)
+    store = {}
+    for f in sorted(os.listdir(path)):
+        with open(os.path.join(path, f), 'rb') as fh:
+            store[f] = fh.read()
+    return store
+
+
+def split(dir_, *args):
+    return run('split_csv.py', '--dir', dir_, '--name', NAME, '--verbose', *args)
+
+
+def split_twice(chain, dir_, args):
+    # the last CSV file of every subfolder is split by a second incremental run
+    shutil.copytree(chain, dir_)
+    hidden = {}
+    for sd in ['inputs', 'outputs']:
+        csv_dir = os.path.join(dir_, NAME, sd, 'csv')
+        hidden[sd] = sorted(os.listdir(csv_dir))[-1]
+        os.replace(os.path.join(csv_dir, hidden[sd]), os.path.join(dir_, hidden[sd]))
+    split(dir_, '--events', *args)
+    for sd, f in hidden.items():
+        os.replace(os.path.join(dir_, f), os.path.join(dir_, NAME, sd, 'csv', f))
+
+
+@pytest.mark.parametrize('args', [[], ['--exact']])
+def test_incremental_events(chain, tmp_path, args):
+    full = str(tmp_path / 'full')
+    shutil.copytree(chain, full)
+    split(full, '--events', *args)
+    expected = read_store(full)
+
+    # only the weeks with new rows are merged again
+    dir_ = str(tmp_path / 'incremental')
+    split_twice(chain, dir_, args)
+    with open(os.path.join(dir_, NAME, 'split.json'), 'r') as f:
+        n_weeks = json.load(f)['weeks']
+    out = split(dir_, '--incremental', *args)
+    with open(os.path.join(dir_, NAME, 'split.json'), 'r') as f:
+        first_new_week = json.load(f)['first_new_week']
+    assert 0 < first_new_week < n_weeks
+    events = out[out.index('Building event store'):].split('\n')
+    assert ' file {} out of {}'.format(19 - first_new_week, 19 - first_new_week) in events
+    assert 'does not match' not in out
+    assert read_store(dir_) == expected
+
+    # a store that does not list the rows of its weeks is built again from all weeks
+    dir_ = str(tmp_path / 'fallback')
+    split_twice(chain, dir_, args)
+    meta_file = os.path.join(dir_, NAME, EVENTS_DIR, META_FILE)
+    with open(meta_file, 'r') as f:
+        meta = json.load(f)
+    meta['week_rows'][1] += 1
+    with open(meta_file, 'w') as f:
+        json.dump(meta, f)
+    split(dir_, '--incremental', *args)
+    assert read_store(dir_) == expected
@@ -0,0 +1,50 @@
+import numpy as np
+import pyarrow as pa
+
+from fixedpoint import LIMB, from_ints, normalize, parse_units, sum_by_id, to_coins, to_ints
+
+
+def random_ints(rng, n, digits):
+    # python integers of up to DIGITS digits, both signs
+    return [int(''.join(rng.choice(list('0123456789'), size=rng.integers(1, digits + 1)))) *
+            int(rng.choice([-1, 1])) for _ in range(n)]
+
+
+def test_round_trip():
+    rng = np.random.default_rng(0)
+    for limbs, digits in [(1, 18), (3, 26)]:
+        ints = random_ints(rng, 1000, digits) + [0, LIMB - 1, -LIMB, LIMB**(limbs - 1)]
+        assert to_ints(from_ints(ints, limbs)) == ints
+
+
+def test_carries():
+    # sums of many rows of limbs close to LIMB carry into the higher limbs
+    rng = np.random.default_rng(1)
+    ints = random_ints(rng, 5000, 26)
+    ids = rng.integers(0, 50, size=len(ints))
+    unique, sums = sum_by_id(ids, from_ints(ints, 3))
+    expected = [sum(v for i, v in zip(ids.tolist(), ints) if i == u) for u in unique.tolist()]
+    assert to_ints(sums) == expected
+    # all limbs but the last stay in [0, LIMB)
+    assert ((sums[:, :-1] >= 0) & (sums[:, :-1] < LIMB)).all()
+
+    units = np.array([[LIMB - 1, LIMB - 1, 0]] * 2, dtype=np.int64) * 2
+    assert to_ints(normalize(units)) == [2 * (LIMB**2 - 1)] * 2
+
+
+def test_parse_units():
+    values = ['-1500000000.0', '0', '', '-0.00', '999999999']
+    expected = [-1500000000, 0, 0, 0, 999999999]
+    for limbs in [1, 3]:
+        if limbs == 3:
+            # values in wei do not fit in int64
+            values, expected = values + ['123456789012345678901'], expected + [123456789012345678901]
+        assert to_ints(parse_units(values, limbs)) == expected
+        array = pa.array([v if v else None for v in values])
+        assert to_ints(parse_units(array, limbs)) == expected
+
+
+def test_to_coins():
+    ints = [10**18, -25 * 10**17, 123456789123456789123, 1]
+    coins = to_coins(from_ints(ints, 3), 10**18)
+    assert coins.tolist() == [1., -2.5, 123.45678912345679, 1e-18]
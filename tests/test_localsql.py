@@ -0,0 +1,152 @@
+import os
+import sys
+import subprocess
+from collections import defaultdict
+
+import numpy as np
+import pytest
+
+duckdb = pytest.importorskip('duckdb')
+pa = pytest.importorskip('pyarrow')
+import pyarrow.parquet as pq
+
+from fixedpoint import to_ints
+from localsql import connect, query_files, translate, weekly_rows
+from partitions import AddressBook, list_weeks, read_bin_week, read_split_manifest
+
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# weeks start on Mondays, the queries skip rows on or after their FINAL_DATE (2022-01-17)
+START_DATE = '2022-01-03'
+
+
+def write_table(tables, dataset, table, columns):
+    path = os.path.join(tables, dataset, table)
+    os.makedirs(path)
+    data = {}
+    for k, v in columns.items():
+        if k.endswith('timestamp'):
+            v = pa.array(np.array(v, dtype='datetime64[s]')).cast(pa.timestamp('us', tz='UTC'))
+        elif k == 'value':
+            v = pa.array(v, type=pa.decimal128(38, 9))
+        data[k] = v
+    pq.write_table(pa.table(data), os.path.join(path, '{}-000000000000.parquet'.format(table)))
+
+
+def weekly_sums(tables, name, limbs):
+    # {subfolder: {(week, address): value}} of the queries of NAME aggregated by DuckDB
+    con = connect(threads=1)
+    sums = {}
+    for sd, fname in query_files(name).items():
+        with open(fname, 'r') as f:
+            query = translate(f.read(), tables)
+        sums[sd] = {}
+        for weeks, codes, uniques, values in weekly_rows(con, query, START_DATE, limbs=limbs):
+            values = to_ints(values) if limbs else values.tolist()
+            for week, code, value in zip(weeks.tolist(), codes.tolist(), values):
+                sums[sd][week, uniques[code]] = value
+    con.close()
+    return sums
+
+
+def test_btc_like_queries(tmp_path):
+    tables = str(tmp_path)
+    # dates are taken in UTC, a week ends on its last day, rows of zero value or on FINAL_DATE
+    # are skipped and addresses of multisig outputs are joined with commas
+    write_table(tables, 'crypto_dash', 'outputs', {
+        'block_timestamp': ['2022-01-03T23:59:59', '2022-01-10T00:00:01', '2022-01-11T12:00:00',
+            '2022-01-12T00:00:00', '2022-01-16T23:59:59', '2022-01-17T00:00:00'],
+        'addresses': [['XA'], ['XA'], ['XB', 'XC'], ['XA'], ['XB'], ['XA']],
+        'value': [100, 50, 70, 0, 5, 999],
+        })
+    write_table(tables, 'crypto_dash', 'inputs', {
+        'block_timestamp': ['2022-01-05T08:00:00', '2022-01-11T08:00:00', '2022-01-18T00:00:00'],
+        'addresses': [['XA'], ['XA'], ['XB']],
+        'value': [100, 30, 5],
+        })
+    expected = {
+        'outputs': {(0, 'XA'): 150, (1, 'XB,XC'): 70, (1, 'XB'): 5},
+        'inputs': {(0, 'XA'): -100, (1, 'XA'): -30},
+        }
+    assert weekly_sums(tables, 'dash', 1) == expected
+    assert weekly_sums(tables, 'dash', 0) == expected
+
+
+def test_eth_like_queries(tmp_path):
+    tables = str(tmp_path)
+    # values in wei and gas fees of full blocks do not fit in int64, failed traces and calls that move no funds are skipped,
+    # miners get the whole gas fee before EIP-1559 and the priority fee after it
+    write_table(tables, 'crypto_ethereum', 'traces', {
+        'block_timestamp': ['2022-01-04T10:00:00', '2022-01-04T11:00:00', '2022-01-05T10:00:00',
+            '2022-01-05T11:00:00', '2022-01-12T10:00:00', '2022-01-12T11:00:00',
+            '2022-01-20T10:00:00'],
+        'from_address': ['0xa', '0xa', '0xa', None, '0xb', '0xb', '0xa'],
+        'to_address': ['0xb', '0xb', '0xb', '0xc', '0xa', '0xa', '0xb'],
+        'value': [3 * 10**20, 10**18, 10**18, 7, 2 * 10**18, 10**18, 5],
+        'status': [1, 0, 1, 1, 1, 1, 1],
+        'call_type': ['call', 'call', 'delegatecall', None, 'staticcall', 'call', 'call'],
+        })
+    write_table(tables, 'crypto_ethereum', 'transactions', {
+        'block_number': [0, 1, 1],
+        'block_timestamp': ['2022-01-04T10:00:00', '2022-01-11T10:00:00', '2022-01-11T10:00:00'],
+        'from_address': ['0xa', '0xb', '0xa'],
+        'receipt_gas_used': [21000, 30 * 10**6, 21000],
+        'gas_price': [100 * 10**9, 500 * 10**9, 100 * 10**9],
+        'receipt_effective_gas_price': [90 * 10**9, 450 * 10**9, 120 * 10**9],
+        })
+    write_table(tables, 'crypto_ethereum', 'blocks', {
+        'number': [0, 1],
+        'timestamp': ['2022-01-04T10:00:00', '2022-01-11T10:00:00'],
+        'miner': ['0xm', '0xm'],
+        'base_fee_per_gas': [None, 100 * 10**9],
+        })
+    expected = {
+        'from': {(0, '0xa'): -3 * 10**20, (1, '0xb'): -10**18},
+        'to': {(0, '0xb'): 3 * 10**20, (0, '0xc'): 7, (1, '0xa'): 10**18},
+        'fees': {(0, '0xa'): -21000 * 100 * 10**9, (1, '0xb'): -30 * 10**6 * 500 * 10**9,
+            (1, '0xa'): -21000 * 100 * 10**9},
+        'rewards': {(0, '0xm'): 21000 * 90 * 10**9,
+            (1, '0xm'): 30 * 10**6 * 350 * 10**9 + 21000 * 20 * 10**9},
+        }
+    assert weekly_sums(tables, 'ethereum', 3) == expected
+    floats = weekly_sums(tables, 'ethereum', 0)
+    assert {sd: {k: float(v) for k, v in sums.items()} for sd, sums in expected.items()} == floats
+
+
+def run(script, *args):
+    subprocess.run([sys.executable, os.path.join(HERE, script)] + list(args), check=True,
+            stdout=subprocess.DEVNULL)
+
+
+def partition_sums(dir_, limbs):
+    # {subfolder: {(week, address): value}} of binary weekly partitions
+    book = AddressBook(dir_)
+    sums = {}
+    for sd in read_split_manifest(dir_)['last_weeks']:
+        sums[sd] = defaultdict(int)
+        for week in list_weeks(os.path.join(dir_, sd), 'bin'):
+            ids, values = read_bin_week(os.path.join(dir_, sd), week, limbs)
+            if ids.shape[0]:
+                for address, value in zip(book.lookup(ids), to_ints(values)):
+                    sums[sd][week, address] += value
+        sums[sd] = {k: v for k, v in sums[sd].items() if v}
+    return sums
+
+
+@pytest.mark.parametrize('name', ['dash', 'ethereum'])
+def test_fixtures_match_split_csv(tmp_path, name):
+    # rows aggregated by DuckDB to weekly partitions are the rows of CSV files split by
+    # split_csv.py
+    tables = str(tmp_path / 'tables')
+    run('local_extract.py', '--dir', str(tmp_path / 'csv'), '--name', name, '--tables', tables,
+            '--fixtures', '--csv')
+    run('split_csv.py', '--dir', str(tmp_path / 'csv'), '--name', name, '--exact')
+    start_date = read_split_manifest(str(tmp_path / 'csv' / name))['start_date']
+    run('local_extract.py', '--dir', str(tmp_path / 'weekly'), '--name', name, '--tables', tables,
+            '--exact', '--start_date', start_date)
+
+    limbs = read_split_manifest(str(tmp_path / 'weekly' / name))['limbs']
+    expected = partition_sums(str(tmp_path / 'csv' / name), limbs)
+    sums = partition_sums(str(tmp_path / 'weekly' / name), limbs)
+    assert sums == expected
+    assert all(sums.values())
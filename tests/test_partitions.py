@@ -0,0 +1,82 @@
+import os
+import numpy as np
+import pandas as pd
+
+from partitions import (AddressBook, WeekWriter, begin_split, list_weeks, read_bin_week,
+        read_pkl_week, rollback_split)
+
+
+def addresses(n, offset=0):
+    return ['1Addr{}'.format(i + offset) for i in range(n)] + \
+            ['0x{:040x}'.format(i + offset) for i in range(n)]
+
+
+def test_address_book(tmp_path):
+    book = AddressBook(str(tmp_path))
+    first = addresses(100)
+    ids = book.ids(first + first[::-1])
+    assert ids[:200].tolist() == list(range(200))
+    assert ids[200:].tolist() == list(range(200))[::-1]
+    book.save()
+    book.ids(addresses(10, 1000))
+    book.save()
+
+    # IDs are kept after reloading, addresses are looked up by them
+    book = AddressBook(str(tmp_path))
+    assert len(book) == 220
+    assert book.ids(first).tolist() == list(range(200))
+    assert book.lookup([0, 150, 219]) == [first[0], first[150], addresses(10, 1000)[-1]]
+    book.truncate(200)
+    book = AddressBook(str(tmp_path))
+    assert len(book) == 200
+    assert book.ids(addresses(10, 1000)).tolist() == list(range(200, 220))
+
+
+def write(sub_dir, fmt, book, rows, weeks=0):
+    # ROWS are (week, address, value)
+    writer = WeekWriter(sub_dir, fmt, book, weeks=weeks)
+    w, a, v = zip(*rows)
+    codes, uniques = pd.factorize(np.array(a, dtype=object))
+    writer.append(np.array(w), codes, list(uniques), np.array(v, dtype=float))
+    return writer.close()
+
+
+def read(sub_dir, fmt, book):
+    # rows of every week as sorted (address, value) pairs
+    weeks = []
+    for week in list_weeks(sub_dir, fmt):
+        if fmt == 'bin':
+            ids, values = read_bin_week(sub_dir, week)
+            rows = zip(book.lookup(ids) if ids.shape[0] else [], values.tolist())
+        else:
+            df = read_pkl_week(sub_dir, week)
+            rows = zip(df['address'], df['value'])
+        weeks.append(sorted(rows))
+    return weeks
+
+
+def test_rollback_split(tmp_path):
+    rng = np.random.default_rng(0)
+    old = [(int(w), a, float(v)) for w, a, v in zip(rng.integers(0, 5, 300),
+        rng.choice(addresses(50), 300), rng.integers(1, 100, 300))]
+    new = [(int(w), a, float(v)) for w, a, v in zip(rng.integers(3, 8, 300),
+        rng.choice(addresses(80), 300), rng.integers(1, 100, 300))]
+    for fmt in ['bin', 'pkl']:
+        dir_ = str(tmp_path / fmt)
+        sub_dir = os.path.join(dir_, 'outputs')
+        book = AddressBook(dir_)
+        weeks = write(sub_dir, fmt, book, old)
+        book.save()
+        n_addresses = len(book)
+        before = read(sub_dir, fmt, book)
+
+        # a split of new files interrupted before the manifest lists them is undone
+        begin_split(dir_, ['outputs'], fmt, weeks, {'outputs': ['new.csv']}, n_addresses)
+        write(sub_dir, fmt, book, new, weeks)
+        book.save()
+        assert read(sub_dir, fmt, book) != before
+        assert rollback_split(dir_, {'files': {'outputs': ['old.csv']}})
+        book = AddressBook(dir_)
+        assert len(book) == n_addresses
+        assert read(sub_dir, fmt, book) == before
+        assert not rollback_split(dir_, {'files': {'outputs': ['old.csv']}})
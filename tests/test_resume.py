@@ -0,0 +1,60 @@
+import os
+import sys
+import shutil
+import subprocess
+
+import pytest
+
+from partitions import read_split_manifest
+
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NAME = 'btc_test'
+# weeks of the synthetic chain, the first run is stopped after RESUME_WEEK of them
+WEEKS = 20
+RESUME_WEEK = 12
+
+
+def run(script, *args):
+    subprocess.run([sys.executable, os.path.join(HERE, script)] + list(args), check=True,
+            stdout=subprocess.DEVNULL)
+
+
+@pytest.fixture(scope='module')
+def chain(tmp_path_factory):
+    dir_ = str(tmp_path_factory.mktemp('chain'))
+    run('gen_chain.py', '--dir', dir_, '--name', NAME, '--weeks', str(WEEKS), '--rows_per_week',
+            '2000', '--addresses', '500', '--seed', '1')
+    run('split_csv.py', '--dir', dir_, '--name', NAME)
+    return dir_
+
+
+def calc(dir_, engine):
+    run('calc_top_balances.py', '--dir', dir_, '--name', NAME, '--engine', engine, '--top', '50',
+            '--start_date', read_split_manifest(os.path.join(dir_, NAME))['start_date'],
+            '--checkpoint_weeks', '5')
+    with open(os.path.join(dir_, NAME, 'top50_balances.csv'), 'r') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('engine', ['dict', 'array', 'disk'])
+def test_resume(chain, tmp_path, engine):
+    full = str(tmp_path / 'full')
+    shutil.copytree(chain, full)
+    expected = calc(full, engine)
+
+    # the first run sees RESUME_WEEK weeks only, the second one resumes from saved balances
+    resumed = str(tmp_path / 'resumed')
+    shutil.copytree(chain, resumed)
+    for sd in ['inputs', 'outputs']:
+        os.makedirs(os.path.join(resumed, 'hidden', sd))
+        for f in os.listdir(os.path.join(resumed, NAME, sd, 'bin')):
+            if int(f.split('.')[0]) >= RESUME_WEEK:
+                os.replace(os.path.join(resumed, NAME, sd, 'bin', f),
+                        os.path.join(resumed, 'hidden', sd, f))
+    calc(resumed, engine)
+    for sd in ['inputs', 'outputs']:
+        for f in os.listdir(os.path.join(resumed, 'hidden', sd)):
+            os.replace(os.path.join(resumed, 'hidden', sd, f),
+                    os.path.join(resumed, NAME, sd, 'bin', f))
+    assert calc(resumed, engine) == expected
@@ -0,0 +1,34 @@
+import numpy as np
+
+from engines import ArrayBalances
+from sketches import BalanceSketch, holders_above, population_gini
+
+
+def test_dust_is_not_a_holder():
+    # a spent balance of 0.0001 + 0.0002 - 0.0003 ether is float dust below one wei
+    balances = ArrayBalances(10**18)
+    balances.sketch = BalanceSketch(unit=1e-18)
+    addresses = np.array(['0xa', '0xb', '0xc'], dtype=object)
+    balances.update(addresses, np.array([10**14, 5 * 10**17, 10**18], dtype=float))
+    balances.update(addresses[:1], np.array([2 * 10**14], dtype=float))
+    balances.update(addresses[:1], np.array([-3 * 10**14], dtype=float))
+    assert balances.values[0] != 0 and abs(balances.values[0]) < 1e-18
+    sketch = balances.sketch
+    assert sketch.counts[1:].sum() == 2
+    assert sketch.counts.sum() == 2
+    assert (BalanceSketch.of(balances.nonzero_items(), 1e-18).counts == sketch.counts).all()
+
+    # one base unit is a holder
+    sketch = BalanceSketch(unit=1e-8)
+    sketch.add([1e-8, 0.4e-8, -0.4e-8, 3.0])
+    assert sketch.counts[1:].sum() == 2
+    assert holders_above(sketch.counts[None], sketch.sums[None], 1e-9)[0] == 2
+
+
+def test_population_gini():
+    rng = np.random.default_rng(0)
+    values = rng.lognormal(0, 2, size=100000)
+    sketch = BalanceSketch.of((None, values), unit=1e-8)
+    v = np.sort(values)
+    exact = 1 - 2 * np.sum(np.cumsum(v) - v / 2) / (v.shape[0] * v.sum())
+    assert abs(population_gini(sketch.counts[None], sketch.sums[None])[0] - exact) < 0.01
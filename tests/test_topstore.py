@@ -0,0 +1,72 @@
+import numpy as np
+
+from topstore import BLOCK_WEEKS, TopStore
+
+
+def random_tops(rng, n_weeks, top, keep_ids):
+    # weekly top balances (sorted descending, sometimes fewer than TOP) with IDs of addresses,
+    # most of them kept from the previous week
+    weeks = []
+    ids = rng.choice(10 * top, size=top, replace=False)
+    values = rng.lognormal(5, 3, size=top)
+    for w in range(n_weeks):
+        changed = rng.random(top) < 0.2
+        ids = np.where(changed, rng.choice(10**6, size=top, replace=False) + 10 * top, ids)
+        values = np.where(rng.random(top) < 0.3, rng.lognormal(5, 3, size=top), values)
+        n = top if w % 5 else top // 2
+        order = np.argsort(-values[:n], kind='stable')
+        weeks.append(('2020-01-{:02d}'.format(w % 28 + 1), values[:n][order],
+            ids[:n][order] if keep_ids else None))
+    return weeks
+
+
+def expected_frame(weeks, top):
+    values = np.full((len(weeks), top), np.nan)
+    for i, (_, v, _) in enumerate(weeks):
+        values[i, :v.shape[0]] = v
+    return values
+
+
+def test_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    top = 40
+    for keep_ids in [False, True]:
+        path = str(tmp_path / 'store{}'.format(int(keep_ids)))
+        weeks = random_tops(rng, 3 * BLOCK_WEEKS + 5, top, keep_ids)
+        store = TopStore(path, top, keep_ids=keep_ids)
+        for date, values, ids in weeks:
+            store.append(date, values, ids)
+        store.close()
+
+        # values are restored exactly from keyframes and deltas, also after reopening
+        store = TopStore(path)
+        assert len(store) == len(weeks)
+        dates, values, ids = store.read()
+        assert dates.astype(str).tolist() == [w[0] for w in weeks]
+        np.testing.assert_array_equal(values, expected_frame(weeks, top))
+        if keep_ids:
+            for i, (_, _, week_ids) in enumerate(weeks):
+                assert ids[i, :week_ids.shape[0]].tolist() == week_ids.tolist()
+        lo, hi = BLOCK_WEEKS - 3, 2 * BLOCK_WEEKS + 2
+        np.testing.assert_array_equal(store.read(lo, hi)[1], expected_frame(weeks, top)[lo:hi])
+
+
+def test_truncate_and_append(tmp_path):
+    rng = np.random.default_rng(1)
+    top = 25
+    weeks = random_tops(rng, 2 * BLOCK_WEEKS + 7, top, True)
+    store = TopStore(str(tmp_path), top, keep_ids=True)
+    for date, values, ids in weeks:
+        store.append(date, values, ids)
+    store.close()
+
+    # weeks after a checkpoint are calculated again, the truncated block is moved back to the tail
+    for weeks_kept in [2 * BLOCK_WEEKS + 3, BLOCK_WEEKS + 4, BLOCK_WEEKS]:
+        store = TopStore(str(tmp_path), top, keep_ids=True)
+        store.truncate(weeks_kept)
+        for date, values, ids in weeks[weeks_kept:]:
+            store.append(date, values, ids)
+        store.close()
+        store = TopStore(str(tmp_path))
+        assert len(store) == len(weeks)
+        np.testing.assert_array_equal(store.read()[1], expected_frame(weeks, top))
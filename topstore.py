@@ -0,0 +1,319 @@
+# This module contains the store of weekly top balances written by calc_top_balances.py. Top
+# balances of consecutive weeks are mostly the same, so every week is saved as a delta against the
+# previous week: the balances that left the top (exits) and the ones that entered it (entries),
+# and if addresses are kept, the IDs of exits, entries and addresses whose balances changed. Weeks
+# are grouped into blocks of BLOCK_WEEKS weeks whose first week is a keyframe (a delta against an
+# empty top), and every complete block is compressed by zlib (after shuffling the bytes of its
+# 64-bit numbers) and appended to "blocks.bin" with its offset in "index.bin". Weeks of the last
+# incomplete block are appended to "tail.bin" uncompressed, so adding a week never rewrites the
+# previous weeks, and reading any week or range of weeks decompresses only the blocks it falls in.
+# The store is exported to CSV (in the layout of DataFrame.to_csv with one column per week) at the
+# end of the calculation: every week is a column of balances, or a column of addresses followed by
+# a column of balances if addresses are kept (balances that are equal are then ordered by the IDs
+# of their addresses).
+
+import os
+import json
+import zlib
+import numpy as np
+import pandas as pd
+
+
+TOP_DIR = 'top'
+META_FILE = 'meta.json'
+BLOCKS_FILE = 'blocks.bin'
+INDEX_FILE = 'index.bin'
+TAIL_FILE = 'tail.bin'
+DATES_FILE = 'dates.txt'
+BLOCK_WEEKS = 16
+
+
+def _drop(a, b):
+    # elements of A missing in B, both sorted in descending order and counted with multiplicity
+    # (of equal values, the last ones are dropped)
+    rank = np.arange(b.shape[0])
+    # rank of every element of B among the equal elements before it
+    rank -= np.maximum.accumulate(np.where(np.r_[True, b[1:] != b[:-1]], rank, 0))
+    pos = np.searchsorted(-a, -b, side='right') - 1 - rank
+    keep = np.ones(a.shape[0], dtype=bool)
+    keep[pos[pos >= np.searchsorted(-a, -b, side='left')]] = False
+    return a[keep]
+
+
+def _encode(prev, cur, keep_ids):
+    # a week CUR as a delta against the previous week PREV, both given as (IDs, values) sorted by
+    # IDs if KEEP_IDS, otherwise as (None, values) sorted in descending order. IDs are sorted, so
+    # they are saved as differences of consecutive IDs
+    if not keep_ids:
+        exits, entries = _drop(prev[1], cur[1]), _drop(cur[1], prev[1])
+        return np.concatenate([np.array([exits.shape[0], 0, entries.shape[0]], dtype=np.int64),
+            exits.view(np.int64), entries.view(np.int64)]).tobytes()
+    ids, values = cur
+    changed = found = np.zeros(ids.shape[0], dtype=bool)
+    if prev[0].shape[0]:
+        pos = np.minimum(np.searchsorted(prev[0], ids), prev[0].shape[0] - 1)
+        found = prev[0][pos] == ids
+        # values are compared bit by bit
+        changed = found & (prev[1][pos].view(np.int64) != values.view(np.int64))
+    exits = prev[0][~np.isin(prev[0], ids, assume_unique=True)]
+    return np.concatenate([np.array([exits.shape[0], changed.sum(), (~found).sum()],
+        dtype=np.int64),
+        np.diff(exits, prepend=0), np.diff(ids[changed], prepend=0),
+        values[changed].view(np.int64), np.diff(ids[~found], prepend=0),
+        values[~found].view(np.int64)]).tobytes()
+
+
+def _records(data, keep_ids):
+    # splits DATA to the int64 arrays of its records
+    data = np.frombuffer(data, dtype=np.int64)
+    records = []
+    pos = 0
+    while pos + 3 <= data.shape[0]:
+        n_exits, n_changed, n_entries = data[pos:pos + 3].tolist()
+        end = pos + 3 + n_exits + n_entries + keep_ids * (2 * n_changed + n_entries)
+        if end > data.shape[0]:
+            break
+        records.append(data[pos:end])
+        pos = end
+    return records
+
+
+def _apply(prev, record, keep_ids):
+    # the week following PREV, given by RECORD (see _encode)
+    n_exits, n_changed, n_entries = record[:3]
+    parts = np.split(record[3:], np.cumsum([n_exits, n_changed, n_changed, n_entries])
+            if keep_ids else [n_exits])
+    # entries are sorted like the week, so they are merged into it
+    if not keep_ids:
+        kept = _drop(prev[1], parts[0].view(np.float64))
+        entries = parts[1].view(np.float64)
+        return None, np.insert(kept, np.searchsorted(-kept, -entries, side='right'), entries)
+    keep = ~np.isin(prev[0], np.cumsum(parts[0]), assume_unique=True)
+    ids, values = prev[0][keep], prev[1][keep]
+    values[np.searchsorted(ids, np.cumsum(parts[1]))] = parts[2].view(np.float64)
+    entries = np.cumsum(parts[3])
+    pos = np.searchsorted(ids, entries)
+    return np.insert(ids, pos, entries), np.insert(values, pos, parts[4].view(np.float64))
+
+
+def _shuffle(data, inverse=False):
+    # groups the i-th bytes of all 64-bit numbers of DATA together, which zlib compresses better
+    data = np.frombuffer(data, dtype=np.uint8)
+    return (data.reshape(8, -1) if inverse else data.reshape(-1, 8)).T.tobytes()
+
+
+def is_top_store(path):
+    return os.path.isfile(os.path.join(path, META_FILE))
+
+
+class TopStore:
+
+    def __init__(self, path, top=None, keep_ids=False):
+        # TOP and KEEP_IDS of an existing store are read from it
+        self.path = path
+        if is_top_store(path):
+            with open(os.path.join(path, META_FILE), 'r') as f:
+                meta = json.load(f)
+            if top is not None and (meta['top'] != top or meta['keep_ids'] != keep_ids):
+                raise ValueError('Store \"{}\" keeps top {} balances{}!'.format(path, meta['top'],
+                    ' with addresses' * meta['keep_ids']))
+            top, keep_ids = meta['top'], meta['keep_ids']
+            self.block_weeks = meta['block_weeks']
+        elif top is None:
+            raise FileNotFoundError('Store \"{}\" does not exist!'.format(path))
+        else:
+            self.block_weeks = BLOCK_WEEKS
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            with open(os.path.join(path, META_FILE), 'w') as f:
+                json.dump({'top': top, 'keep_ids': keep_ids, 'block_weeks': self.block_weeks}, f)
+        self.top = top
+        self.keep_ids = keep_ids
+        self.empty = (np.empty(0, dtype=np.int64) if keep_ids else None, np.empty(0))
+        self.blocks_file = None
+        self.tail_file = None
+        self.dates_file = None
+        self._load()
+
+    def _load(self):
+        self.dates = []
+        if os.path.isfile(os.path.join(self.path, DATES_FILE)):
+            with open(os.path.join(self.path, DATES_FILE), 'r') as f:
+                self.dates = f.read().split()
+        # offsets and lengths of compressed blocks
+        self.index = np.fromfile(os.path.join(self.path, INDEX_FILE), dtype=np.int64) \
+                if os.path.isfile(os.path.join(self.path, INDEX_FILE)) else np.empty(0, np.int64)
+        self.index = self.index[:self.index.shape[0] // 2 * 2].reshape(-1, 2)
+        # records of the weeks after the last block, the tail starts with its first week (weeks of
+        # a block that was saved before the tail was cleared are skipped)
+        self.tail = []
+        if os.path.isfile(os.path.join(self.path, TAIL_FILE)):
+            with open(os.path.join(self.path, TAIL_FILE), 'rb') as f:
+                data = f.read()
+            if len(data) >= 8:
+                skip = len(self.index) * self.block_weeks - int(np.frombuffer(data[:8],
+                    dtype=np.int64)[0])
+                self.tail = _records(data[8:], self.keep_ids)[skip:] if skip >= 0 else []
+        self.weeks = min(len(self.dates), len(self.index) * self.block_weeks + len(self.tail))
+        self.last = None
+
+    def __len__(self):
+        return self.weeks
+
+    def _open(self):
+        if self.tail_file is None:
+            self.truncate(self.weeks)
+            self.blocks_file = open(os.path.join(self.path, BLOCKS_FILE), 'ab')
+            self.tail_file = open(os.path.join(self.path, TAIL_FILE), 'ab')
+            self.dates_file = open(os.path.join(self.path, DATES_FILE), 'a')
+            # a complete block may be left in the tail if saving it was interrupted
+            if len(self.tail) >= self.block_weeks:
+                self._seal()
+
+    def _block(self, b):
+        # records of the weeks of block B
+        if b == len(self.index):
+            return self.tail
+        offset, length = self.index[b]
+        with open(os.path.join(self.path, BLOCKS_FILE), 'rb') as f:
+            f.seek(offset)
+            data = zlib.decompress(f.read(length))
+        return _records(_shuffle(data, inverse=True), self.keep_ids)
+
+    def append(self, date, values, ids=None):
+        # VALUES are the week's top balances, at most TOP of them, IDS are the IDs of their
+        # addresses
+        self._open()
+        values = np.asarray(values, dtype=np.float64)[:self.top]
+        keep = ~np.isnan(values)
+        if self.keep_ids:
+            ids = np.asarray(ids, dtype=np.int64)[:values.shape[0]][keep]
+            order = np.argsort(ids)
+            cur = ids[order], values[keep][order]
+        else:
+            cur = None, -np.sort(-values[keep])
+        # the first week of a block is a keyframe
+        record = _encode(self.last if len(self.tail) else self.empty, cur, self.keep_ids)
+        self.tail_file.write(record)
+        self.tail.append(np.frombuffer(record, dtype=np.int64))
+        self.last = cur
+        self.dates_file.write(date + '\n')
+        self.dates.append(date)
+        self.weeks += 1
+        if len(self.tail) >= self.block_weeks:
+            self._seal()
+
+    def _seal(self):
+        # the complete block of the tail is compressed and saved, then the tail is cleared
+        data = zlib.compress(_shuffle(np.concatenate(self.tail).tobytes()))
+        offset = self.index[-1].sum() if len(self.index) else 0
+        self.blocks_file.write(data)
+        self.flush()
+        with open(os.path.join(self.path, INDEX_FILE), 'ab') as f:
+            np.array([offset, len(data)], dtype=np.int64).tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        self.index = np.vstack([self.index, [[offset, len(data)]]])
+        self.tail = []
+        self.tail_file.close()
+        self.tail_file = open(os.path.join(self.path, TAIL_FILE), 'wb')
+        np.array([self.weeks], dtype=np.int64).tofile(self.tail_file)
+
+    def flush(self):
+        for f in [self.blocks_file, self.tail_file, self.dates_file]:
+            if f is not None:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def close(self):
+        self.flush()
+        for f in [self.blocks_file, self.tail_file, self.dates_file]:
+            if f is not None:
+                f.close()
+        self.blocks_file = None
+        self.tail_file = None
+        self.dates_file = None
+
+    def truncate(self, weeks):
+        # keeps the first WEEKS weeks only (e.g. weeks saved after the last checkpoint), the
+        # block of the first week removed is moved back to the tail
+        self.close()
+        self.weeks = min(self.weeks, weeks)
+        self.dates = self.dates[:self.weeks]
+        b = min(self.weeks // self.block_weeks, len(self.index))
+        self.tail = self._block(b)[:self.weeks - b * self.block_weeks]
+        self.index = self.index[:b]
+        with open(os.path.join(self.path, INDEX_FILE), 'ab') as f:
+            f.truncate(self.index.size * 8)
+        with open(os.path.join(self.path, BLOCKS_FILE), 'ab') as f:
+            f.truncate(self.index[-1].sum() if len(self.index) else 0)
+        with open(os.path.join(self.path, TAIL_FILE), 'wb') as f:
+            np.concatenate([[b * self.block_weeks]] + self.tail).astype(np.int64).tofile(f)
+        with open(os.path.join(self.path, DATES_FILE), 'w') as f:
+            f.write(''.join(d + '\n' for d in self.dates))
+        # the last week, against which the next week is encoded
+        self.last = self.empty
+        for record in self.tail:
+            self.last = _apply(self.last, record, self.keep_ids)
+
+    def read(self, lo=0, hi=None):
+        # dates, (weeks, TOP) top balances (padded with NaN) and IDs of their addresses (padded
+        # with -1, None if addresses are not kept) of weeks LO to HI. Only the blocks of these
+        # weeks are read
+        hi = self.weeks if hi is None else min(hi, self.weeks)
+        lo = min(lo, hi)
+        dates = np.array(self.dates[lo:hi], dtype='datetime64[D]')
+        values = np.full((hi - lo, self.top), np.nan)
+        ids = np.full((hi - lo, self.top), -1, dtype=np.int64) if self.keep_ids else None
+        for b in range(lo // self.block_weeks, -(-hi // self.block_weeks)):
+            week = self.empty
+            for j, record in enumerate(self._block(b)):
+                i = b * self.block_weeks + j
+                if i >= hi:
+                    break
+                week = _apply(week, record, self.keep_ids)
+                if i < lo:
+                    continue
+                if self.keep_ids:
+                    # balances in descending order, equal ones by IDs (the week is sorted by IDs)
+                    order = np.argsort(-week[1])
+                    n = order.shape[0]
+                    equal = np.r_[False, week[1][order][1:] == week[1][order][:-1]]
+                    order = np.sort(np.cumsum(~equal) * n + order) % n
+                    ids[i - lo, :order.shape[0]] = week[0][order]
+                    values[i - lo, :order.shape[0]] = week[1][order]
+                else:
+                    values[i - lo, :week[1].shape[0]] = week[1]
+        return dates, values, ids
+
+    def to_frame(self, book=None):
+        # if BOOK is given, addresses are looked up by their IDs
+        _, values, ids = self.read()
+        values = values.T
+        # rows that are NaN in all weeks are dropped (fewer than TOP non-zero balances)
+        non_nan = np.flatnonzero(~np.isnan(values).all(axis=1))
+        values = values[:non_nan[-1] + 1 if non_nan.shape[0] else 0]
+        if book is None:
+            return pd.DataFrame(values, columns=self.dates)
+        if not self.weeks:
+            return pd.DataFrame()
+
+        ids = ids.T[:values.shape[0]]
+        # every address is looked up once
+        unique_ids, inverse = np.unique(ids, return_inverse=True)
+        addresses = np.asarray([np.nan] * int((unique_ids < 0).any()) +
+                book.lookup(unique_ids[unique_ids >= 0]), dtype=object)
+        addresses = addresses[inverse.reshape(ids.shape)]
+        return pd.concat([
+            pd.DataFrame({self.dates[j]: addresses[:, j], '': values[:, j]})
+            for j in range(self.weeks)], axis=1)
+
+    def export_csv(self, fname, book=None):
+        self.to_frame(book).to_csv(fname)
+
+    def import_csv(self, fname):
+        # fills an empty store from a CSV file written by older versions of calc_top_balances.py
+        df = pd.read_csv(fname, header=0, float_precision='round_trip')
+        df = df.drop(columns=[c for c in df if c.startswith('Unnamed')])
+        for col in df:
+            self.append(col, df[col].to_numpy()[:self.top])